@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import os
+import hashlib
 import logging
 import json
 import traceback
@@ -77,14 +78,90 @@ class PEAUAgentClient:
             return {"suggestion": "", "recommended_product_ids": [], "error": f"Unexpected error: {e}"}
 
 
+# the longest a changed catalog waits to be written to the snapshot file;
+# a burst of chat messages shares one write
+SNAPSHOT_SAVE_INTERVAL = 5
+
 class ProductCatalogClient:
-    """Client for communicating with the Product Catalog Service via gRPC"""
+    """Client for communicating with the Product Catalog Service via gRPC.
+
+    The last good ListProducts response is kept in memory and, with a
+    snapshot_path, on local disk, so a restarted pod can answer from it
+    before the product catalog is reachable.
+    """
     
-    def __init__(self, catalog_service_addr: str):
+    def __init__(self, catalog_service_addr: str, snapshot_path: str = None):
         self.catalog_service_addr = catalog_service_addr
         self.channel = None
         self.stub = None
+        self.snapshot_path = snapshot_path
+        self.snapshot = None
+        self._snapshot_digest = None
+        self._snapshot_changed = threading.Event()
+        self._save_lock = threading.Lock()
         self._connect()
+        if snapshot_path:
+            self._load_snapshot()
+            threading.Thread(target=self._save_loop, name='catalog-snapshot-saver',
+                             daemon=True).start()
+        threading.Thread(target=self._warm_up, name='catalog-warm-up', daemon=True).start()
+
+    def ready(self) -> bool:
+        """True once a catalog snapshot, local or live, is present"""
+        return self.snapshot is not None
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = f.read()
+            self.snapshot = demo_pb2.ListProductsResponse.FromString(data)
+            self._snapshot_digest = hashlib.sha1(data).digest()
+            logger.info(f"Loaded {len(self.snapshot.products)} products from {self.snapshot_path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not load catalog snapshot from {self.snapshot_path}: {e}")
+
+    def _save_snapshot(self, response):
+        """Keep response as the last good catalog; the saver thread writes it
+        to disk, off the request path"""
+        self.snapshot = response
+        if self.snapshot_path:
+            self._snapshot_changed.set()
+
+    def _save_loop(self):
+        while True:
+            self._snapshot_changed.wait()
+            self._snapshot_changed.clear()
+            self._write_snapshot(self.snapshot)
+            time.sleep(SNAPSHOT_SAVE_INTERVAL)
+
+    def _write_snapshot(self, response):
+        data = response.SerializeToString(deterministic=True)
+        digest = hashlib.sha1(data).digest()
+        with self._save_lock:
+            if digest == self._snapshot_digest:
+                return  # the catalog has not changed since the last write
+            tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.snapshot_path)
+                self._snapshot_digest = digest
+            except Exception as e:
+                logger.warning(f"Could not save catalog snapshot to {self.snapshot_path}: {e}")
+
+    def _warm_up(self):
+        """Fetch the catalog once at startup, retrying until it answers"""
+        while True:
+            try:
+                self._save_snapshot(self.stub.ListProducts(demo_pb2.Empty(), timeout=10))
+                return
+            except Exception as e:
+                logger.warning(f"Product catalog not reachable yet: {e}")
+                time.sleep(5)
     
     def _connect(self):
         """Establish gRPC connection to product catalog service"""
@@ -100,7 +177,14 @@ class ProductCatalogClient:
         """Get all products from the catalog"""
         try:
             request = demo_pb2.Empty()
-            response = self.stub.ListProducts(request)
+            try:
+                response = self.stub.ListProducts(request)
+                self._save_snapshot(response)
+            except grpc.RpcError as e:
+                if self.snapshot is None:
+                    raise
+                logger.warning(f"Product catalog unavailable, serving last good snapshot: {e}")
+                response = self.snapshot
             products = []
             for product in response.products:
                 products.append({
@@ -195,7 +279,8 @@ class ChatbotService:
             # Initialize product catalog client
             catalog_addr = os.getenv('PRODUCT_CATALOG_SERVICE_ADDR', 'productcatalogservice:3550')
             logger.info(f"Connecting to product catalog at: {catalog_addr}")
-            self.catalog_client = ProductCatalogClient(catalog_addr)
+            self.catalog_client = ProductCatalogClient(
+                catalog_addr, snapshot_path=os.getenv('CATALOG_SNAPSHOT_PATH'))
             
             # Initialize PEAU Agent client
             peau_agent_mcp_addr = os.getenv('PEAU_AGENT_MCP_ADDR', 'localhost:8081')
@@ -495,8 +580,17 @@ IMPORTANT: Whenever you mention or recommend a specific product, ALWAYS include
 
 class HealthServicer(health_pb2_grpc.HealthServicer):
     """Health check service for gRPC"""
+
+    def __init__(self, ready=lambda: True):
+        self.ready = ready
     
     def Check(self, request, context):
+        # not ready until a catalog snapshot is present; liveness probes ask
+        # for the "liveness" service and skip that
+        if request.service != 'liveness' and not self.ready():
+            return health_pb2.HealthCheckResponse(
+                status=health_pb2.HealthCheckResponse.NOT_SERVING
+            )
         return health_pb2.HealthCheckResponse(
             status=health_pb2.HealthCheckResponse.SERVING
         )
@@ -515,6 +609,12 @@ def create_flask_app(chatbot_service: ChatbotService) -> Flask:
     def health_check():
         return jsonify({'status': 'healthy'})
 
+    @app.route('/ready', methods=['GET'])
+    def readiness_check():
+        if not chatbot_service.catalog_client.ready():
+            return jsonify({'status': 'waiting for product catalog'}), 503
+        return jsonify({'status': 'ready'})
+
     @app.route('/chat/stream', methods=['POST'])
     def chat_stream():
         """SSE endpoint for streaming chat responses"""
@@ -638,10 +738,10 @@ def create_flask_app(chatbot_service: ChatbotService) -> Flask:
     
     return app
 
-def serve_grpc(port: int = 8080):
+def serve_grpc(port: int = 8080, ready=lambda: True):
     """Serve gRPC health checks"""
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    health_pb2_grpc.add_HealthServicer_to_server(HealthServicer(), server)
+    health_pb2_grpc.add_HealthServicer_to_server(HealthServicer(ready), server)
     
     listen_addr = f'[::]:{port}'
     server.add_insecure_port(listen_addr)
@@ -668,7 +768,8 @@ def main():
     app = create_flask_app(chatbot_service)
     
     # Start gRPC server in a separate thread
-    grpc_thread = threading.Thread(target=serve_grpc, args=(grpc_port,))
+    grpc_thread = threading.Thread(
+        target=serve_grpc, args=(grpc_port, chatbot_service.catalog_client.ready))
     grpc_thread.daemon = True
     grpc_thread.start()
     
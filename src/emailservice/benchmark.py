@@ -0,0 +1,350 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks for the email service. Run from this directory:
+#
+#   python benchmark.py smtp [--pool-sizes 1,2,4,8,16] [--messages 2000] [--smtp-latency 5]
+#   python benchmark.py render [--items 1,10,200]
+#   python benchmark.py load [--modes threadpool,aio] [--concurrency 500] [--durable]
+#
+# `smtp` sends through the outbox and the pooled SMTP sender to a local
+# aiosmtpd server running in a separate process, once per pool size with
+# and without connection reuse, and prints messages per second.
+#
+# `render` compares renders per second of the confirmation pipeline in
+# render.py with rendering the original protobuf-walking template.
+#
+# `load` starts email_server.py in dummy mode once per GRPC_SERVER_MODE and
+# reports SendOrderConfirmation throughput and latency at each number of
+# concurrent callers, with the in-memory outbox or, with --durable, a
+# SQLite one in a temporary directory.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import grpc
+from grpc_health.v1 import health_pb2
+from grpc_health.v1 import health_pb2_grpc
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import demo_pb2
+import demo_pb2_grpc
+import logger
+from outbox import Email, Outbox
+from render import ConfirmationRenderer, view_model
+from smtp_sender import SmtpPool, SmtpSender
+
+# templates/confirmation.html before render.py, the baseline for `render`
+ORIGINAL_TEMPLATE = """<html>
+  <head>
+    <title>Your Order Confirmation</title>
+    <link href="https://fonts.googleapis.com/css2?family=DM+Sans:ital,wght@0,400;0,700;1,400;1,700&display=swap" rel="stylesheet">
+  </head>
+  <style>
+    body{
+      font-family: 'DM Sans', sans-serif;
+    }
+  </style>
+  <body>
+    <h2>Your Order Confirmation</h2>
+    <p>Thanks for shopping with us!<p>
+    <h3>Order ID</h3>
+    <p>#{{ order.order_id }}</p>
+    <h3>Shipping</h3>
+    <p>#{{ order.shipping_tracking_id }}</p>
+    <p>{{ order.shipping_cost.units }}. {{ "%02d" | format(order.shipping_cost.nanos // 10000000) }} {{ order.shipping_cost.currency_code }}</p>
+    <p>{{ order.shipping_address.street_address_1 }}, {{order.shipping_address.street_address_2}}, {{order.shipping_address.city}}, {{order.shipping_address.country}} {{order.shipping_address.zip_code}}</p>
+    <h3>Items</h3>
+    <table style="width:100%">
+        <tr>
+          <th>Item No.</th>
+          <th>Quantity</th> 
+          <th>Price</th>
+        </tr>
+        {% for item in order.items %}
+        <tr>
+          <td>#{{ item.item.product_id }}</td>
+          <td>{{ item.item.quantity }}</td> 
+          <td>{{ item.cost.units }}.{{ "%02d" | format(item.cost.nanos // 10000000) }} {{ item.cost.currency_code }}</td>
+        </tr>
+        {% endfor %}
+    </table>
+  </body>
+</html>"""
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def silence_logs():
+  logger.output_handler.setStream(open(os.devnull, 'w'))
+
+def serve_smtp(args):
+  from aiosmtpd.controller import Controller
+
+  class Handler(object):
+    async def handle_DATA(self, server, session, envelope):
+      if args.latency:
+        await asyncio.sleep(args.latency / 1e3)
+      return '250 OK'
+
+  controller = Controller(Handler(), hostname='127.0.0.1', port=args.port)
+  controller.start()
+  print('ready', flush=True)
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    controller.stop()
+
+def start_smtp_server(latency):
+  port = free_port()
+  server = subprocess.Popen(
+    [sys.executable, __file__, 'smtpd', '--port', str(port), '--latency', str(latency)],
+    stdout=subprocess.PIPE, text=True)
+  if server.stdout.readline().strip() != 'ready':
+    raise RuntimeError('the SMTP server did not start, is aiosmtpd installed?')
+  return server, port
+
+def send_all(port, pool_size, args, max_messages):
+  pool = SmtpPool('127.0.0.1', port, size=pool_size, max_messages=max_messages)
+  sender = SmtpSender(pool, 'no-reply@benchmark.example',
+                      domain_concurrency=args.domain_concurrency)
+  outbox = Outbox(sender, capacity=args.messages, workers=args.outbox_workers,
+                  batch_size=args.batch_size)
+  html = '<p>' + 'x' * args.size + '</p>'
+  start = time.monotonic()
+  for i in range(args.messages):
+    outbox.put(Email('user{}@domain{}.example'.format(i, i % args.domains),
+                     'Your Confirmation Email', html, str(i)))
+  outbox.close()
+  elapsed = time.monotonic() - start
+  sender.close()
+  return dict(outbox.stats(), connects=pool.connects,
+              messages_per_second=round(args.messages / elapsed, 1))
+
+def bench_smtp(args):
+  silence_logs()
+  server, port = start_smtp_server(args.smtp_latency)
+  try:
+    # with and without connection reuse at the same number of connections
+    runs = []
+    for size in args.pool_sizes:
+      runs.append(('unpooled={}'.format(size), size, 1))
+      runs.append(('pool={}'.format(size), size, args.max_messages))
+    print("{:>12} {:>12} {:>10} {:>8}".format('', 'messages/s', 'connects', 'failed'))
+    results = {}
+    for name, size, max_messages in runs:
+      result = send_all(port, size, args, max_messages)
+      results[name] = result
+      print("{:>12} {:>12} {:>10} {:>8}".format(
+        name, result['messages_per_second'], result['connects'], result['failed']))
+    if args.output:
+      with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+  finally:
+    server.terminate()
+    server.wait()
+
+def make_order(items, products=50, rng=random):
+  """An order of `items` items drawn from a catalog of `products`, so
+  large orders repeat rows like real carts do."""
+  return demo_pb2.OrderResult(
+    order_id='{:08x}'.format(rng.getrandbits(32)),
+    shipping_tracking_id='TR-{:06d}'.format(rng.randrange(10**6)),
+    shipping_cost=demo_pb2.Money(currency_code='USD', units=8, nanos=990000000),
+    shipping_address=demo_pb2.Address(
+      street_address='1600 Amphitheatre Parkway', city='Mountain View',
+      state='CA', country='United States', zip_code=94043),
+    items=[demo_pb2.OrderItem(
+      item=demo_pb2.CartItem(product_id='PRODUCT{:04d}'.format(p), quantity=1 + p % 3),
+      cost=demo_pb2.Money(currency_code='USD', units=10 + p, nanos=990000000))
+      for p in (rng.randrange(products) for _ in range(items))])
+
+def bench_render(args):
+  silence_logs()
+  env = Environment(loader=FileSystemLoader('templates'),
+                    autoescape=select_autoescape(['html', 'xml']))
+  original = env.from_string(ORIGINAL_TEMPLATE)
+  renderer = ConfirmationRenderer(env)
+  paths = [
+    ('original', lambda order: original.render(order=order)),
+    ('view model + Jinja', lambda order: renderer.render_jinja(view_model(order))),
+    ('compiled', renderer.render),
+  ]
+  print("{:>6} {:>20} {:>12} {:>8}".format('items', 'path', 'renders/s', 'speedup'))
+  for items in args.items:
+    orders = [make_order(items, args.products) for _ in range(100)]
+    baseline = None
+    for name, render in paths:
+      it = iter(range(10**9))
+      def run():
+        render(orders[next(it) % len(orders)])
+      number, _ = timeit.Timer(run).autorange()
+      rate = number / min(timeit.Timer(run).repeat(repeat=3, number=number))
+      baseline = baseline or rate
+      print("{:>6} {:>20} {:>12.0f} {:>7.1f}x".format(items, name, rate, rate / baseline))
+
+def start_email_server(mode, env=None):
+  port = free_port()
+  server_env = dict(os.environ, PORT=str(port), DISABLE_PROFILER="1",
+                    GRPC_SERVER_MODE=mode, OUTBOX_CAPACITY="100000", **(env or {}))
+  for name in ('ENABLE_TRACING', 'SMTP_HOST', 'WORKERS'):
+    server_env.pop(name, None)
+  process = subprocess.Popen(
+    [sys.executable, 'email_server.py'], env=server_env, stdout=subprocess.DEVNULL)
+  target = '127.0.0.1:{}'.format(port)
+  with grpc.insecure_channel(target) as channel:
+    stub = health_pb2_grpc.HealthStub(channel)
+    deadline = time.monotonic() + 30
+    while True:
+      try:
+        stub.Check(health_pb2.HealthCheckRequest(), timeout=1)
+        return process, target
+      except grpc.RpcError:
+        if process.poll() is not None or time.monotonic() > deadline:
+          process.kill()
+          raise RuntimeError('email server did not start in mode ' + mode)
+        time.sleep(0.2)
+
+def percentile(sorted_values, p):
+  if not sorted_values:
+    return float('nan')
+  return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+async def drive_load(target, concurrency, duration, orders):
+  latencies = []
+  errors = 0
+  async with grpc.aio.insecure_channel(target) as channel:
+    stub = demo_pb2_grpc.EmailServiceStub(channel)
+    stop_at = time.monotonic() + duration
+
+    async def caller(n):
+      nonlocal errors
+      sequence = 0
+      while time.monotonic() < stop_at:
+        order = demo_pb2.OrderResult()
+        order.CopyFrom(orders[sequence % len(orders)])
+        # a new order id every call, or dedup would skip the send
+        order.order_id = '{}-{}'.format(n, sequence)
+        sequence += 1
+        request = demo_pb2.SendOrderConfirmationRequest(
+          email='user{}@example.com'.format(n), order=order)
+        start = time.perf_counter()
+        try:
+          await stub.SendOrderConfirmation(request)
+          latencies.append(time.perf_counter() - start)
+        except grpc.aio.AioRpcError:
+          errors += 1
+
+    await asyncio.gather(*(caller(n) for n in range(concurrency)))
+  latencies.sort()
+  return {
+    'requests': len(latencies),
+    'errors': errors,
+    'throughput': len(latencies) / duration,
+    'p50_ms': percentile(latencies, 0.50) * 1e3,
+    'p99_ms': percentile(latencies, 0.99) * 1e3,
+  }
+
+def bench_load(args):
+  orders = [make_order(args.items, args.products) for _ in range(100)]
+  print("{:>10} {:>12} {:>12} {:>10} {:>10} {:>8}".format(
+    'mode', 'concurrency', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors'))
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    for mode in args.modes:
+      env = {}
+      if args.durable:
+        env['OUTBOX_PATH'] = os.path.join(tmp, mode + '-outbox.db')
+      process, target = start_email_server(mode, env)
+      try:
+        for concurrency in args.concurrency:
+          result = asyncio.run(drive_load(target, concurrency, args.duration, orders))
+          results['{} x{}'.format(mode, concurrency)] = result
+          print("{:>10} {:>12} {:>12.0f} {:>10.2f} {:>10.2f} {:>8}".format(
+            mode, concurrency, result['throughput'], result['p50_ms'],
+            result['p99_ms'], result['errors']))
+      finally:
+        process.terminate()
+        process.wait()
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+
+def main():
+  parser = argparse.ArgumentParser(description='emailservice benchmarks')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  smtp = commands.add_parser('smtp',
+    help='SMTP throughput through the outbox at different pool sizes')
+  smtp.add_argument('--pool-sizes', default='1,2,4,8,16',
+    type=lambda v: [int(x) for x in v.split(',')])
+  smtp.add_argument('--messages', type=int, default=2000)
+  smtp.add_argument('--domains', type=int, default=10, help='recipient domains')
+  smtp.add_argument('--size', type=int, default=4000, help='bytes of HTML per message')
+  smtp.add_argument('--smtp-latency', type=float, default=5,
+    help='ms the server takes to accept each message')
+  smtp.add_argument('--domain-concurrency', type=int, default=4)
+  smtp.add_argument('--max-messages', type=int, default=100,
+    help='messages per pooled connection')
+  smtp.add_argument('--outbox-workers', type=int, default=2)
+  smtp.add_argument('--batch-size', type=int, default=100)
+  smtp.add_argument('--output', help='also write the results as JSON')
+  smtp.set_defaults(func=bench_smtp)
+
+  render = commands.add_parser('render',
+    help='renders per second of the confirmation pipeline and the original template')
+  render.add_argument('--items', default='1,10,200',
+    type=lambda v: [int(x) for x in v.split(',')], help='items per order')
+  render.add_argument('--products', type=int, default=50,
+    help='distinct products the items are drawn from')
+  render.set_defaults(func=bench_render)
+
+  load = commands.add_parser('load',
+    help='SendOrderConfirmation throughput of the server modes under concurrent callers')
+  load.add_argument('--modes', default='threadpool,aio', type=lambda v: v.split(','))
+  load.add_argument('--concurrency', default='500',
+    type=lambda v: [int(x) for x in v.split(',')])
+  load.add_argument('--duration', type=float, default=10, help='seconds per level')
+  load.add_argument('--items', type=int, default=5, help='items per order')
+  load.add_argument('--products', type=int, default=50,
+    help='distinct products the items are drawn from')
+  load.add_argument('--durable', action='store_true',
+    help='use a SQLite outbox, as the Kubernetes manifest does')
+  load.add_argument('--output', help='also write the results as JSON')
+  load.set_defaults(func=bench_load)
+
+  smtpd = commands.add_parser('smtpd', help=argparse.SUPPRESS)
+  smtpd.add_argument('--port', type=int, required=True)
+  smtpd.add_argument('--latency', type=float, default=0)
+  smtpd.set_defaults(func=serve_smtp)
+
+  args = parser.parse_args()
+  args.func(args)
+
+if __name__ == "__main__":
+  main()
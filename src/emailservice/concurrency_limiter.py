@@ -0,0 +1,200 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Adaptive concurrency limiting for the Python gRPC servers.
+#
+# The sync interceptor runs on the server's polling thread, before the call
+# is queued for the thread pool. Calls admitted there but not yet running
+# are the queue depth, and latency is measured from admission so that time
+# spent queued counts. Health checks are never shed.
+#
+# TODO: this module is duplicated since other Python services are not
+# sharing modules.
+
+import math
+import threading
+import time
+
+import grpc
+
+EXEMPT_PREFIX = '/grpc.health.v1.Health/'
+
+class GradientLimiter(object):
+  """Gradient-based concurrency limit, in the style of Netflix's gradient2.
+
+  Every `window` samples the average latency of the window is compared
+  with a slow moving baseline. When recent latency rises above
+  `tolerance` times the baseline the limit shrinks in proportion. When
+  latency stays flat the limit grows by about sqrt(limit) per window, but
+  only while the server actually uses at least half of it.
+  """
+
+  def __init__(self, initial=20, min_limit=4, max_limit=200, window=20,
+               tolerance=1.5, smoothing=0.2, baseline_window=600):
+    self.limit = float(initial)
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self.inflight = 0
+    self.running = 0
+    self.rejected = 0
+    self._window = window
+    self._tolerance = tolerance
+    self._smoothing = smoothing
+    self._baseline_window = baseline_window
+    self._baseline = None
+    self._samples = 0
+    self._latency_sum = 0.0
+    self._max_inflight = 0
+    # reentrant: an _Admission may be collected while the lock is held
+    self._lock = threading.RLock()
+
+  def acquire(self):
+    with self._lock:
+      if self.inflight >= int(self.limit):
+        self.rejected += 1
+        return False
+      self.inflight += 1
+      self._max_inflight = max(self._max_inflight, self.inflight)
+      return True
+
+  def started(self):
+    with self._lock:
+      self.running += 1
+
+  def release(self, latency, running=True):
+    with self._lock:
+      self.inflight -= 1
+      if not running:
+        # cancelled while queued, there is no latency to learn from
+        return
+      self.running -= 1
+      self._samples += 1
+      self._latency_sum += latency
+      if self._samples >= self._window:
+        self._update(self._latency_sum / self._samples)
+        self._samples = 0
+        self._latency_sum = 0.0
+        self._max_inflight = self.inflight
+
+  def _update(self, latency):
+    if self._baseline is None:
+      self._baseline = latency
+    gradient = max(0.5, min(1.0, self._tolerance * self._baseline / latency))
+    limit = self.limit
+    if self._max_inflight < limit / 2:
+      # app-limited, the latency says nothing about a bigger limit
+      headroom = 0
+    else:
+      headroom = math.sqrt(limit)
+    target = limit * gradient + headroom
+    limit = (1 - self._smoothing) * limit + self._smoothing * target
+    self.limit = max(self.min_limit, min(self.max_limit, limit))
+    # let the baseline follow a changing workload, slowly
+    self._baseline += (latency - self._baseline) / self._baseline_window
+    if gradient < 1.0:
+      # do not let the baseline absorb an overload
+      self._baseline = min(self._baseline, latency)
+
+  def stats(self):
+    with self._lock:
+      return {
+        'limit': int(self.limit),
+        'inflight': self.inflight,
+        'queue_depth': self.inflight - self.running,
+        'rejected': self.rejected,
+      }
+
+class _Admission(object):
+  """One admitted call. A call cancelled while still queued never runs
+  its handler, so the slot is also released when the handler is dropped."""
+
+  __slots__ = ('limiter', 'admitted', 'running', 'done')
+
+  def __init__(self, limiter):
+    self.limiter = limiter
+    self.admitted = time.monotonic()
+    self.running = False
+    self.done = False
+
+  def start(self):
+    self.running = True
+    self.limiter.started()
+
+  def finish(self):
+    if not self.done:
+      self.done = True
+      self.limiter.release(time.monotonic() - self.admitted, self.running)
+
+  def __del__(self):
+    self.finish()
+
+def _reject(request, context):
+  context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'server concurrency limit reached')
+
+async def _reject_async(request, context):
+  await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'server concurrency limit reached')
+
+class ConcurrencyLimitInterceptor(grpc.ServerInterceptor):
+  def __init__(self, limiter):
+    self.limiter = limiter
+
+  def intercept_service(self, continuation, handler_call_details):
+    handler = continuation(handler_call_details)
+    if (handler is None or handler.unary_unary is None or
+        handler_call_details.method.startswith(EXEMPT_PREFIX)):
+      return handler
+    limiter = self.limiter
+    if not limiter.acquire():
+      return grpc.unary_unary_rpc_method_handler(_reject)
+    admission = _Admission(limiter)
+    behavior = handler.unary_unary
+
+    def limited(request, context):
+      admission.start()
+      try:
+        return behavior(request, context)
+      finally:
+        admission.finish()
+
+    return grpc.unary_unary_rpc_method_handler(
+      limited, request_deserializer=handler.request_deserializer,
+      response_serializer=handler.response_serializer)
+
+class AioConcurrencyLimitInterceptor(grpc.aio.ServerInterceptor):
+  def __init__(self, limiter):
+    self.limiter = limiter
+
+  async def intercept_service(self, continuation, handler_call_details):
+    handler = await continuation(handler_call_details)
+    if (handler is None or handler.unary_unary is None or
+        handler_call_details.method.startswith(EXEMPT_PREFIX)):
+      return handler
+    limiter = self.limiter
+    if not limiter.acquire():
+      return grpc.unary_unary_rpc_method_handler(_reject_async)
+    admission = _Admission(limiter)
+    behavior = handler.unary_unary
+
+    async def limited(request, context):
+      admission.start()
+      try:
+        return await behavior(request, context)
+      finally:
+        admission.finish()
+
+    return grpc.unary_unary_rpc_method_handler(
+      limited, request_deserializer=handler.request_deserializer,
+      response_serializer=handler.response_serializer)
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Dedup index for SendOrderConfirmation retries.
+#
+# A confirmation is identified by its order id and recipient. A call claims
+# the key while it renders and enqueues, and completes it once the mail is
+# in the outbox; calls with a completed key in the next `ttl` seconds are
+# duplicates and succeed without rendering or sending anything. A call that
+# fails releases its claim, so its retry is sent. Calls that arrive while
+# another holds the claim are told so rather than answered as sent, since
+# the call holding it may still fail.
+#
+# The index keeps at most `capacity` completed keys, dropping the oldest
+# first. With a path, completed keys are also written to a SQLite file once
+# a second and loaded on start, so dedup survives restarts; a crash loses at
+# most the last second.
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from logger import getJSONLogger
+logger = getJSONLogger('emailservice-dedup')
+
+FLUSH_INTERVAL = 1.0
+
+# results of DedupIndex.claim
+NEW = 'new'
+PENDING = 'pending'
+DONE = 'done'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dedup (
+  key TEXT PRIMARY KEY,
+  expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dedup_expires ON dedup (expires);
+"""
+
+def confirmation_key(order_id, email):
+  return order_id + '\x00' + email
+
+class DedupIndex(object):
+  def __init__(self, ttl, capacity=100000, path=None):
+    self._ttl = ttl
+    self._capacity = capacity
+    # completed keys in completion order, which is also expiry order as
+    # the ttl is fixed
+    self._expires = OrderedDict()
+    self._pending = set()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.conflicts = 0
+    self._conn = None
+    if path:
+      self._conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      self._conn.executescript(SCHEMA)
+      self._load()
+      self._written = {}
+      self._flushed = threading.Event()
+      self._flush_lock = threading.Lock()
+      threading.Thread(target=self._flush_loop, name='dedup-flush', daemon=True).start()
+
+  def _load(self):
+    rows = self._conn.execute(
+      'SELECT key, expires FROM dedup WHERE expires > ? ORDER BY expires DESC LIMIT ?',
+      (time.time(), self._capacity)).fetchall()
+    for key, expires in reversed(rows):
+      self._expires[key] = expires
+    if rows:
+      logger.info("loaded {} dedup keys".format(len(rows)))
+
+  def _prune(self, now):
+    expires = self._expires
+    while expires:
+      key, deadline = next(iter(expires.items()))
+      if deadline > now and len(expires) < self._capacity:
+        break
+      expires.popitem(last=False)
+
+  def claim(self, key):
+    """Claims `key` and returns NEW, or returns DONE if it was completed in
+    the last `ttl` seconds and PENDING if another call holds it. A claim
+    must be followed by complete or release."""
+    now = time.time()
+    with self._lock:
+      self._prune(now)
+      if key in self._pending:
+        self.conflicts += 1
+        return PENDING
+      if self._expires.get(key, 0) > now:
+        self.hits += 1
+        return DONE
+      self.misses += 1
+      self._pending.add(key)
+      return NEW
+
+  def complete(self, key):
+    """Marks a claimed key as sent, for `ttl` seconds from now."""
+    expires = time.time() + self._ttl
+    with self._lock:
+      self._pending.discard(key)
+      self._expires[key] = expires
+      self._expires.move_to_end(key)
+      if self._conn is not None:
+        self._written[key] = expires
+
+  def release(self, key):
+    """Drops the claim on `key` after the call that claimed it failed."""
+    with self._lock:
+      self._pending.discard(key)
+
+  def flush(self):
+    if self._conn is None:
+      return
+    with self._flush_lock:
+      with self._lock:
+        written, self._written = self._written, {}
+      if not written:
+        return
+      try:
+        with self._conn:
+          self._conn.execute('BEGIN')
+          self._conn.executemany('INSERT OR REPLACE INTO dedup (key, expires) VALUES (?, ?)',
+                                 written.items())
+          self._conn.execute('DELETE FROM dedup WHERE expires <= ?', (time.time(),))
+      except sqlite3.Error as err:
+        logger.warning("could not persist dedup keys: {}".format(err))
+
+  def _flush_loop(self):
+    while not self._flushed.wait(FLUSH_INTERVAL):
+      self.flush()
+
+  def close(self):
+    if self._conn is not None:
+      self._flushed.set()
+      self.flush()
+
+  def stats(self):
+    with self._lock:
+      return {
+        'entries': len(self._expires),
+        'pending': len(self._pending),
+        'hits': self.hits,
+        'misses': self.misses,
+        'conflicts': self.conflicts,
+      }
@@ -637,6 +637,11 @@ class EmailServiceStub(object):
                 request_serializer=demo__pb2.SendOrderConfirmationRequest.SerializeToString,
                 response_deserializer=demo__pb2.Empty.FromString,
                 )
+        self.SendOrderConfirmations = channel.unary_unary(
+                '/hipstershop.EmailService/SendOrderConfirmations',
+                request_serializer=demo__pb2.SendOrderConfirmationsRequest.SerializeToString,
+                response_deserializer=demo__pb2.SendOrderConfirmationsResponse.FromString,
+                )
 
 
 class EmailServiceServicer(object):
@@ -650,6 +655,12 @@ class EmailServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SendOrderConfirmations(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_EmailServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -658,6 +669,11 @@ def add_EmailServiceServicer_to_server(servicer, server):
                     request_deserializer=demo__pb2.SendOrderConfirmationRequest.FromString,
                     response_serializer=demo__pb2.Empty.SerializeToString,
             ),
+            'SendOrderConfirmations': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendOrderConfirmations,
+                    request_deserializer=demo__pb2.SendOrderConfirmationsRequest.FromString,
+                    response_serializer=demo__pb2.SendOrderConfirmationsResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'hipstershop.EmailService', rpc_method_handlers)
@@ -687,6 +703,23 @@ class EmailService(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def SendOrderConfirmations(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/hipstershop.EmailService/SendOrderConfirmations',
+            demo__pb2.SendOrderConfirmationsRequest.SerializeToString,
+            demo__pb2.SendOrderConfirmationsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
 
 class CheckoutServiceStub(object):
     """-------------Checkout service-----------------
@@ -0,0 +1,349 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Durable outbox for confirmation emails, enabled with OUTBOX_PATH.
+#
+# Emails are committed to a SQLite database in WAL mode before the RPC
+# returns, so a crash or restart does not lose them. A writer thread commits
+# everything enqueued while the previous commit was running in a single
+# transaction (group commit), so one fsync is shared by many requests.
+#
+# Workers claim batches of due rows by moving their `available_at` a lease
+# into the future; the rows of a worker that died become due again when the
+# lease runs out, which is also how mail left over from a previous run is
+# resumed. A worker only completes rows still under its own lease, so a
+# batch that outlived its lease is not also updated by the worker that
+# claimed it next; `lease` should cover the longest a batch can take to
+# send. Failed sends are retried with exponential backoff, and given up
+# on after `max_attempts`, which leaves the row with a NULL `available_at`
+# and its last error for inspection. Deferred sends are put back for their
+# delay without using up an attempt.
+
+import asyncio
+import random
+import sqlite3
+import threading
+import time
+from concurrent import futures
+
+from outbox import Deferred, Email, OutboxFull
+from logger import getJSONLogger
+logger = getJSONLogger('emailservice-durable-outbox')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY,
+  recipient TEXT NOT NULL,
+  subject TEXT NOT NULL,
+  html TEXT NOT NULL,
+  order_id TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  available_at REAL,
+  last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_available_at ON outbox (available_at);
+"""
+
+# longest a worker sleeps without checking the database; rows enqueued by
+# other processes sharing the file do not wake this one up
+MAX_IDLE_WAIT = 1.0
+
+class _Group(object):
+  """Emails committed together by the writer."""
+
+  def __init__(self):
+    self.emails = []
+    # a future so that asyncio callers can await the commit too
+    self.committed = futures.Future()
+    self.error = None
+
+class DurableOutbox(object):
+  """Same interface as outbox.Outbox, backed by the SQLite file at `path`.
+
+  `put` returns once the email is committed. `capacity` bounds the unsent
+  rows in the database, which other processes sharing it may add to or
+  send, plus the ones waiting to be committed here. Claimed rows are leased for `lease`
+  seconds. Backoff after the n-th failed attempt is
+  `backoff` * 2^(n-1) seconds, capped at `max_backoff`, with jitter.
+  """
+
+  def __init__(self, sender, path, capacity=100000, workers=2, batch_size=20,
+               lease=60, backoff=1, max_backoff=300, max_attempts=10):
+    self._sender = sender
+    self._capacity = capacity
+    self._batch_size = batch_size
+    self._lease = lease
+    self._backoff = backoff
+    self._max_backoff = max_backoff
+    self._max_attempts = max_attempts
+
+    # one connection, used under a lock; SQLite serializes writers anyway
+    self._conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                 check_same_thread=False)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute('PRAGMA synchronous=FULL')
+    self._conn.executescript(SCHEMA)
+    self._db = threading.Lock()
+
+    self._cond = threading.Condition()
+    self._group = _Group()
+    self._closed = False
+    self._drain_until = None
+    # unsent rows in the database as last counted, and emails not yet
+    # committed; the count is refreshed whenever this process touches the
+    # rows, since any process may have sent them
+    self._stored = self._count()
+    self._pending = 0
+    self.sent = 0
+    self.retried = 0
+    self.failed = 0
+    self.deferred = 0
+    self.rejected = 0
+    if self._stored:
+      logger.info("resuming {} unsent confirmations from {}".format(self._stored, path))
+
+    self._writer = threading.Thread(target=self._write, name='outbox-writer', daemon=True)
+    self._writer.start()
+    self._workers = [
+      threading.Thread(target=self._run, name='outbox-{}'.format(i), daemon=True)
+      for i in range(workers)]
+    for worker in self._workers:
+      worker.start()
+
+  def put(self, email, timeout=None):
+    if not self.put_many([email], timeout):
+      raise OutboxFull('outbox is full')
+
+  def put_many(self, emails, timeout=None):
+    """Commits `emails` in order, waiting for room for at most `timeout`
+    seconds in all. Returns how many were committed."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    groups = []
+    with self._cond:
+      count = 0
+      while count < len(emails) and not self._closed:
+        added = self._add(emails, count, groups)
+        if not added:
+          remaining = None if deadline is None else deadline - time.monotonic()
+          if remaining is not None and remaining <= 0:
+            break
+          self._cond.wait(remaining)
+          continue
+        count += added
+      self.rejected += len(emails) - count
+    for group, start in groups:
+      group.committed.result()
+    return self._committed(groups, count)
+
+  async def put_async(self, email, timeout=None):
+    if not await self.put_many_async([email], timeout):
+      raise OutboxFull('outbox is full')
+
+  async def put_many_async(self, emails, timeout=None):
+    """put_many for asyncio callers. The commit is awaited, not waited
+    for on a thread; only waiting for room is done on an executor thread."""
+    groups = []
+    with self._cond:
+      count = 0 if self._closed else self._add(emails, 0, groups)
+    for group, start in groups:
+      await asyncio.wrap_future(group.committed)
+    committed = self._committed(groups, count)
+    if committed == count and count < len(emails):
+      committed += await asyncio.get_running_loop().run_in_executor(
+        None, self.put_many, emails[count:], timeout)
+    return committed
+
+  def _add(self, emails, count, groups):
+    # with self._cond held; adds what fits of emails[count:] to the next
+    # commit and records the group and offset in `groups`
+    room = self._capacity - self._stored - self._pending
+    added = emails[count:count + max(0, room)]
+    if not added:
+      return 0
+    group = self._group
+    group.emails.extend(added)
+    if not groups or groups[-1][0] is not group:
+      groups.append((group, count))
+    self._pending += len(added)
+    self._cond.notify_all()
+    return len(added)
+
+  def _count(self):
+    return self._conn.execute(
+      'SELECT COUNT(*) FROM outbox WHERE available_at IS NOT NULL').fetchone()[0]
+
+  def _counted(self, stored, committed=0):
+    # with self._db held, so that counts are applied in the order taken
+    with self._cond:
+      self._stored = stored
+      self._pending -= committed
+      self._cond.notify_all()
+
+  @staticmethod
+  def _committed(groups, count):
+    for group, start in groups:
+      if group.error is not None:
+        if start == 0:
+          raise group.error
+        return start  # what came before the failed commit is stored
+    return count
+
+  def _write(self):
+    while True:
+      with self._cond:
+        while not self._group.emails and not self._closed:
+          self._cond.wait()
+        group, self._group = self._group, _Group()
+      if not group.emails:
+        return  # closed, and everything enqueued is committed
+      now = time.time()
+      try:
+        with self._db:
+          with self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.executemany(
+              'INSERT INTO outbox (recipient, subject, html, order_id, available_at) '
+              'VALUES (?, ?, ?, ?, ?)',
+              [(e.to, e.subject, e.html, e.order_id, now) for e in group.emails])
+            stored = self._count()
+          self._counted(stored, len(group.emails))
+      except sqlite3.Error as err:
+        logger.error("could not store {} confirmations: {}".format(len(group.emails), err))
+        group.error = err
+        with self._cond:
+          self._pending -= len(group.emails)
+          self._cond.notify_all()
+      group.committed.set_result(None)
+
+  def _claim(self):
+    now = time.time()
+    with self._db, self._conn:
+      self._conn.execute('BEGIN IMMEDIATE')
+      rows = self._conn.execute(
+        'SELECT id, recipient, subject, html, order_id, attempts FROM outbox '
+        'WHERE available_at <= ? ORDER BY available_at LIMIT ?',
+        (now, self._batch_size)).fetchall()
+      self._conn.executemany(
+        'UPDATE outbox SET available_at = ? WHERE id = ?',
+        [(now + self._lease, row[0]) for row in rows])
+    return rows, now + self._lease
+
+  def _next_due(self):
+    with self._db:
+      due, stored = self._conn.execute(
+        'SELECT MIN(available_at), COUNT(*) FROM outbox '
+        'WHERE available_at IS NOT NULL').fetchone()
+      self._counted(stored)
+    if due is None:
+      return MAX_IDLE_WAIT
+    return min(MAX_IDLE_WAIT, max(0, due - time.time()))
+
+  def _complete(self, rows, results, leased_until):
+    # every update is conditional on the row still carrying our lease
+    now = time.time()
+    done, deferred, retry, given_up = [], [], [], []
+    for row, err in zip(rows, results):
+      row_id, attempts = row[0], row[5] + 1
+      if err is None:
+        done.append((row_id, leased_until))
+      elif isinstance(err, Deferred):
+        deferred.append((now + err.delay, row_id, leased_until))
+      elif attempts >= self._max_attempts:
+        logger.error("giving up on confirmation for order {} to {} after {} attempts: {}".format(
+          row[4], row[1], attempts, err))
+        given_up.append((attempts, str(err), row_id, leased_until))
+      else:
+        delay = min(self._max_backoff, self._backoff * 2 ** (attempts - 1))
+        delay *= random.uniform(0.5, 1.0)
+        retry.append((attempts, now + delay, str(err), row_id, leased_until))
+    with self._db:
+      with self._conn:
+        self._conn.execute('BEGIN IMMEDIATE')
+        sent_count = self._conn.executemany(
+          'DELETE FROM outbox WHERE id = ? AND available_at = ?', done).rowcount
+        deferred_count = self._conn.executemany(
+          'UPDATE outbox SET available_at = ? WHERE id = ? AND available_at = ?',
+          deferred).rowcount
+        retried_count = self._conn.executemany(
+          'UPDATE outbox SET attempts = ?, available_at = ?, last_error = ? '
+          'WHERE id = ? AND available_at = ?', retry).rowcount
+        failed_count = self._conn.executemany(
+          'UPDATE outbox SET attempts = ?, available_at = NULL, last_error = ? '
+          'WHERE id = ? AND available_at = ?', given_up).rowcount
+        stored = self._count()
+      self._counted(stored)
+    lost = len(rows) - sent_count - deferred_count - retried_count - failed_count
+    if lost:
+      logger.warning("lease on {} confirmations ran out before the batch finished, "
+                     "consider a longer OUTBOX_LEASE_SECONDS".format(lost))
+    with self._cond:
+      self.sent += sent_count
+      self.retried += retried_count
+      self.failed += failed_count
+      self.deferred += deferred_count
+
+  def _run(self):
+    while True:
+      try:
+        rows, leased_until = self._claim()
+        if not rows:
+          wait = self._next_due()
+          with self._cond:
+            if self._closed and not self._writer.is_alive():
+              return  # nothing due and nothing left to commit
+            self._cond.wait(wait)
+          continue
+        batch = [Email(*row[1:5]) for row in rows]
+        try:
+          results = self._sender(batch)
+        except Exception as err:
+          results = [err] * len(batch)
+        self._complete(rows, results, leased_until)
+      except sqlite3.Error as err:
+        logger.warning("outbox worker database error: {}".format(err))
+        time.sleep(MAX_IDLE_WAIT)
+      with self._cond:
+        if self._drain_until is not None and time.monotonic() > self._drain_until:
+          return
+
+  def close(self, timeout=None):
+    """Stops accepting mail and keeps sending what is due for up to
+    `timeout` seconds. Returns the number of unsent rows, which the next
+    run resumes."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self._cond:
+      self._closed = True
+      self._drain_until = deadline
+      self._cond.notify_all()
+    self._writer.join()
+    for worker in self._workers:
+      worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+    with self._db:
+      left = self._count()
+    if left:
+      logger.info("outbox closed with {} unsent confirmations, they will be resumed".format(left))
+    return left
+
+  def stats(self):
+    with self._cond:
+      return {
+        'queued': self._stored + self._pending,
+        'sent': self.sent,
+        'retried': self.retried,
+        'failed': self.failed,
+        'deferred': self.deferred,
+        'rejected': self.rejected,
+      }
@@ -35,5 +35,22 @@ def send_confirmation_email(email, order):
     logger.error(err.details())
     logger.error('{}, {}'.format(err.code().name, err.code().value))
 
+def send_confirmation_emails(confirmations):
+  """Sends (email, order) pairs in one call, for backfills and re-sends.
+  Returns a ConfirmationStatus per pair, or None if the call failed."""
+  channel = grpc.insecure_channel('[::]:8080')
+  stub = demo_pb2_grpc.EmailServiceStub(channel)
+  try:
+    response = stub.SendOrderConfirmations(demo_pb2.SendOrderConfirmationsRequest(
+      confirmations = [
+        demo_pb2.SendOrderConfirmationRequest(email = email, order = order)
+        for email, order in confirmations]
+    ))
+    logger.info('Request sent.')
+    return response.statuses
+  except grpc.RpcError as err:
+    logger.error(err.details())
+    logger.error('{}, {}'.format(err.code().name, err.code().value))
+
 if __name__ == '__main__':
   logger.info('Client for email service.')
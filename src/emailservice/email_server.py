@@ -15,14 +15,18 @@
 # limitations under the License.
 
 from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
 import argparse
+import asyncio
 import os
+import pickle
+import signal
+import sqlite3
 import sys
 import time
 import grpc
 import traceback
-from jinja2 import Environment, FileSystemLoader, select_autoescape, TemplateError
-from google.api_core.exceptions import GoogleAPICallError
+from jinja2 import TemplateError
 from google.auth.exceptions import DefaultCredentialsError
 
 import demo_pb2
@@ -31,25 +35,82 @@ from grpc_health.v1 import health_pb2
 from grpc_health.v1 import health_pb2_grpc
 
 from opentelemetry import trace
-from opentelemetry.instrumentation.grpc import GrpcInstrumentorServer
+from opentelemetry.instrumentation.grpc import GrpcInstrumentorServer, GrpcAioInstrumentorServer
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 
 import googlecloudprofiler
 
-from logger import getJSONLogger
+import prefork
+import startup
+from concurrency_limiter import GradientLimiter
+from concurrency_limiter import ConcurrencyLimitInterceptor, AioConcurrencyLimitInterceptor
+from outbox import Email, Outbox, OutboxFull
+from durable_outbox import DurableOutbox
+from dedup import DedupIndex, confirmation_key, DONE, PENDING
+from rate_limit import DomainScheduler, parse_overrides
+from smtp_sender import SmtpPool, SmtpSender
+from render import ConfirmationRenderer, template_environment
+from render_pool import ProcessPoolRenderer
+from stats import StatsReporter
+from logger import getJSONLogger, getLogStats
 logger = getJSONLogger('emailservice-server')
+startup.timeline.mark('imports')
 
-# Loads confirmation email template from file
-env = Environment(
-    loader=FileSystemLoader('templates'),
-    autoescape=select_autoescape(['html', 'xml'])
-)
-template = env.get_template('confirmation.html')
+# set up by run(): render pool workers import this module as __mp_main__,
+# which must not build a renderer or register stats there
+stats = None
+renderer = None
+
+def create_renderer():
+  # Loads confirmation email templates from files
+  row_cache_size = int(os.environ.get('RENDER_ROW_CACHE_SIZE', "4096"))
+  renderer = ConfirmationRenderer(template_environment('templates'), row_cache_size=row_cache_size)
+  stats.add('render', renderer.stats)
+  processes = int(os.environ.get('RENDER_PROCESSES', "0"))
+  if processes <= 0:
+    return renderer
+  renderer = ProcessPoolRenderer(
+    renderer, processes,
+    min_items=int(os.environ.get('RENDER_PROCESS_MIN_ITEMS', "50")),
+    template_dir='templates', row_cache_size=row_cache_size)
+  stats.add('render_pool', renderer.stats)
+  return renderer
+
+def init_components():
+  global stats, renderer
+  stats = StatsReporter(float(os.environ.get('STATS_LOG_INTERVAL_SECONDS', "60")))
+  stats.add('logging', getLogStats)
+  renderer = create_renderer()
+
+RENDER_ERROR = "An error occurred when preparing the confirmation mail."
+OUTBOX_FULL_ERROR = "Too many confirmation emails are waiting to be sent."
+OUTBOX_UNAVAILABLE_ERROR = "The confirmation email could not be stored, try again."
+IN_FLIGHT_ERROR = "A confirmation for this order is being sent, try again."
+
+# a render pool worker may also die, time out or fail to return the HTML
+RENDER_ERRORS = (TemplateError, BrokenProcessPool, TimeoutError, pickle.PicklingError)
+
+def confirmation_email(request, html):
+  return Email(request.email, "Your Confirmation Email", html, request.order.order_id)
+
+async def render_async(order):
+  if isinstance(renderer, ProcessPoolRenderer) and len(order.items) >= renderer.min_items:
+    # waits for a worker process, which must not hold up the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, renderer.render, order)
+  return renderer.render(order)
 
 class BaseEmailService(demo_pb2_grpc.EmailServiceServicer):
+  def __init__(self, outbox, enqueue_timeout=1, dedup=None):
+    self.outbox = outbox
+    self.enqueue_timeout = enqueue_timeout
+    self.dedup = dedup
+
   def Check(self, request, context):
+    if not prefork.serving():
+      return health_pb2.HealthCheckResponse(
+        status=health_pb2.HealthCheckResponse.NOT_SERVING)
     return health_pb2.HealthCheckResponse(
       status=health_pb2.HealthCheckResponse.SERVING)
   
@@ -57,70 +118,301 @@ class BaseEmailService(demo_pb2_grpc.EmailServiceServicer):
     return health_pb2.HealthCheckResponse(
       status=health_pb2.HealthCheckResponse.UNIMPLEMENTED)
 
-class EmailService(BaseEmailService):
-  def __init__(self):
-    raise Exception('cloud mail client not implemented')
-    super().__init__()
+  def SendOrderConfirmation(self, request, context):
+    key, answered = self._claim(request, context)
+    if answered:
+      return demo_pb2.Empty()
+    sent = False
+    try:
+      sent = self._send_confirmation(request, context)
+      return demo_pb2.Empty()
+    finally:
+      self._settle(key, sent)
 
-  @staticmethod
-  def send_email(client, email_address, content):
-    response = client.send_message(
-      sender = client.sender_path(project_id, region, sender_id),
-      envelope_from_authority = '',
-      header_from_authority = '',
-      envelope_from_address = from_address,
-      simple_message = {
-        "from": {
-          "address_spec": from_address,
-        },
-        "to": [{
-          "address_spec": email_address
-        }],
-        "subject": "Your Confirmation Email",
-        "html_body": content
-      }
-    )
-    logger.info("Message sent: {}".format(response.rfc822_message_id))
+  def _claim(self, request, context):
+    """Claims the dedup key of `request`. Returns the key, None if the call
+    is not deduplicated, and whether the call is answered already."""
+    if self.dedup is None or not request.order.order_id:
+      return None, False
+    key = confirmation_key(request.order.order_id, request.email)
+    claim = self.dedup.claim(key)
+    if claim == DONE:
+      # a checkout retry of a confirmation already on its way
+      return key, True
+    if claim == PENDING:
+      # the first call may still fail, so only its outcome may say sent
+      context.set_details(IN_FLIGHT_ERROR)
+      context.set_code(grpc.StatusCode.ABORTED)
+      return key, True
+    return key, False
 
-  def SendOrderConfirmation(self, request, context):
-    email = request.email
-    order = request.order
+  def _settle(self, key, sent):
+    if key is None:
+      return
+    if sent:
+      self.dedup.complete(key)
+    else:
+      self.dedup.release(key)
 
+  def _send_confirmation(self, request, context):
     try:
-      confirmation = template.render(order = order)
-    except TemplateError as err:
-      context.set_details("An error occurred when preparing the confirmation mail.")
-      logger.error(err.message)
+      email = confirmation_email(request, renderer.render(request.order))
+    except RENDER_ERRORS as err:
+      context.set_details(RENDER_ERROR)
+      logger.error("could not render confirmation for order {}: {!r}".format(
+        request.order.order_id, err))
       context.set_code(grpc.StatusCode.INTERNAL)
+      return False
+
+    # delivery happens on the outbox workers, off the checkout path
+    try:
+      self.outbox.put(email, timeout=self.enqueue_timeout)
+    except OutboxFull as err:
+      context.set_details(OUTBOX_FULL_ERROR)
+      logger.warning(str(err))
+      context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+      return False
+    except sqlite3.Error as err:
+      # the durable outbox's database is locked or full; worth a retry
+      context.set_details(OUTBOX_UNAVAILABLE_ERROR)
+      logger.error("could not store confirmation for order {}: {}".format(
+        email.order_id, err))
+      context.set_code(grpc.StatusCode.UNAVAILABLE)
+      return False
+
+    return True
+
+  def SendOrderConfirmations(self, request, context):
+    # for backfills and re-sends: one call, one outbox operation, and a
+    # status per confirmation instead of failing the whole batch. Not
+    # deduplicated, re-sending is the point.
+    rendered = renderer.render_many([c.order for c in request.confirmations])
+    statuses, emails, positions = self._batch_emails(request, rendered)
+    try:
+      accepted = self.outbox.put_many(emails, timeout=self.enqueue_timeout)
+    except sqlite3.Error as err:
+      return self._batch_unavailable(statuses, positions, err)
+    return self._batch_response(statuses, emails, positions, accepted)
+
+  def _batch_emails(self, request, rendered):
+    statuses = [None] * len(request.confirmations)
+    emails = []
+    positions = []
+    for i, (confirmation, html) in enumerate(zip(request.confirmations, rendered)):
+      if isinstance(html, Exception):
+        logger.error(str(html))
+        statuses[i] = (grpc.StatusCode.INTERNAL, RENDER_ERROR)
+        continue
+      emails.append(confirmation_email(confirmation, html))
+      positions.append(i)
+    return statuses, emails, positions
+
+  def _batch_response(self, statuses, emails, positions, accepted):
+    if accepted < len(emails):
+      logger.warning("outbox is full, {} of {} confirmations rejected".format(
+        len(emails) - accepted, len(emails)))
+    for n, i in enumerate(positions):
+      if n < accepted:
+        statuses[i] = (grpc.StatusCode.OK, "")
+      else:
+        statuses[i] = (grpc.StatusCode.RESOURCE_EXHAUSTED, OUTBOX_FULL_ERROR)
+    return self._statuses_response(statuses)
+
+  def _batch_unavailable(self, statuses, positions, err):
+    logger.error("could not store {} confirmations: {}".format(len(positions), err))
+    for i in positions:
+      statuses[i] = (grpc.StatusCode.UNAVAILABLE, OUTBOX_UNAVAILABLE_ERROR)
+    return self._statuses_response(statuses)
+
+  @staticmethod
+  def _statuses_response(statuses):
+    return demo_pb2.SendOrderConfirmationsResponse(statuses=[
+      demo_pb2.ConfirmationStatus(code=code.value[0], message=message)
+      for code, message in statuses])
+
+class AioEmailService(BaseEmailService):
+  """The same service for a grpc.aio server. The outbox enqueue is
+  awaited, and so is rendering when it runs off the event loop."""
+
+  async def Check(self, request, context):
+    return BaseEmailService.Check(self, request, context)
+
+  async def Watch(self, request, context):
+    await context.abort(grpc.StatusCode.UNIMPLEMENTED, 'Watch is not supported')
+
+  async def SendOrderConfirmation(self, request, context):
+    key, answered = self._claim(request, context)
+    if answered:
+      return demo_pb2.Empty()
+    sent = False
+    try:
+      sent = await self._send_confirmation_async(request, context)
       return demo_pb2.Empty()
+    finally:
+      self._settle(key, sent)
 
+  async def _send_confirmation_async(self, request, context):
     try:
-      EmailService.send_email(self.client, email, confirmation)
-    except GoogleAPICallError as err:
-      context.set_details("An error occurred when sending the email.")
-      print(err.message)
+      email = confirmation_email(request, await render_async(request.order))
+    except RENDER_ERRORS as err:
+      context.set_details(RENDER_ERROR)
+      logger.error("could not render confirmation for order {}: {!r}".format(
+        request.order.order_id, err))
       context.set_code(grpc.StatusCode.INTERNAL)
-      return demo_pb2.Empty()
+      return False
 
-    return demo_pb2.Empty()
+    try:
+      await self.outbox.put_async(email, timeout=self.enqueue_timeout)
+    except OutboxFull as err:
+      context.set_details(OUTBOX_FULL_ERROR)
+      logger.warning(str(err))
+      context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+      return False
+    except sqlite3.Error as err:
+      # the durable outbox's database is locked or full; worth a retry
+      context.set_details(OUTBOX_UNAVAILABLE_ERROR)
+      logger.error("could not store confirmation for order {}: {}".format(
+        email.order_id, err))
+      context.set_code(grpc.StatusCode.UNAVAILABLE)
+      return False
+
+    return True
+
+  async def SendOrderConfirmations(self, request, context):
+    # a batch may take a while to render, do it on an executor thread
+    rendered = await asyncio.get_running_loop().run_in_executor(
+      None, renderer.render_many, [c.order for c in request.confirmations])
+    statuses, emails, positions = self._batch_emails(request, rendered)
+    try:
+      accepted = await self.outbox.put_many_async(emails, timeout=self.enqueue_timeout)
+    except sqlite3.Error as err:
+      return self._batch_unavailable(statuses, positions, err)
+    return self._batch_response(statuses, emails, positions, accepted)
 
 class DummyEmailService(BaseEmailService):
-  def SendOrderConfirmation(self, request, context):
-    logger.info('A request to send order confirmation email to {} has been received.'.format(request.email))
-    return demo_pb2.Empty()
+  @staticmethod
+  def send_batch(emails):
+    for email in emails:
+      logger.info('A request to send order confirmation email to {} has been received.'.format(email.to))
+    return [None] * len(emails)
 
 class HealthCheck():
   def Check(self, request, context):
     return health_pb2.HealthCheckResponse(
       status=health_pb2.HealthCheckResponse.SERVING)
 
-def start(dummy_mode):
-  server = grpc.server(futures.ThreadPoolExecutor(max_workers=10),)
-  service = None
+def create_limiter():
+  if os.environ.get('ADAPTIVE_CONCURRENCY_LIMIT', "0") != "1":
+    return None
+  limiter = GradientLimiter(
+    max_limit=int(os.environ.get('CONCURRENCY_LIMIT_MAX', "200")))
+  stats.add('concurrency_limiter', limiter.stats)
+  return limiter
+
+def default_lease(batch_size):
+  # a batch may send every email twice, each attempt up to the SMTP timeout
+  if "SMTP_HOST" not in os.environ:
+    return 60
+  timeout = float(os.environ.get('SMTP_TIMEOUT_SECONDS', "10"))
+  return max(60, 2 * timeout * batch_size)
+
+def create_outbox(sender):
+  workers = int(os.environ.get('OUTBOX_WORKERS', "2"))
+  batch_size = int(os.environ.get('OUTBOX_BATCH_SIZE', "20"))
+  path = os.environ.get('OUTBOX_PATH')
+  if path:
+    outbox = DurableOutbox(
+      sender, path,
+      capacity=int(os.environ.get('OUTBOX_CAPACITY', "100000")),
+      workers=workers, batch_size=batch_size,
+      lease=float(os.environ.get('OUTBOX_LEASE_SECONDS', default_lease(batch_size))),
+      max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', "10")))
+  else:
+    outbox = Outbox(
+      sender,
+      capacity=int(os.environ.get('OUTBOX_CAPACITY', "1000")),
+      workers=workers, batch_size=batch_size)
+  stats.add('outbox', outbox.stats)
+  return outbox
+
+def create_smtp_sender():
+  pool = SmtpPool(
+    os.environ['SMTP_HOST'],
+    port=int(os.environ.get('SMTP_PORT', "25")),
+    size=int(os.environ.get('SMTP_POOL_SIZE', "16")),
+    timeout=float(os.environ.get('SMTP_TIMEOUT_SECONDS', "10")),
+    starttls=os.environ.get('SMTP_STARTTLS', "0") == "1",
+    username=os.environ.get('SMTP_USERNAME'),
+    password=os.environ.get('SMTP_PASSWORD'),
+    max_messages=int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', "100")))
+  smtp = SmtpSender(
+    pool, os.environ.get('SMTP_FROM', "no-reply@onlineboutique.example"),
+    domain_concurrency=int(os.environ.get('SMTP_DOMAIN_CONCURRENCY', "2")))
+  stats.add('smtp', smtp.stats)
+  return smtp
+
+def create_scheduler(sender):
+  rate = float(os.environ.get('RATE_LIMIT_PER_SECOND', "0"))
+  if rate <= 0:
+    return sender
+  scheduler = DomainScheduler(
+    sender, rate,
+    burst=float(os.environ.get('RATE_LIMIT_BURST', "10")),
+    overrides=parse_overrides(os.environ.get('RATE_LIMIT_DOMAINS', "")),
+    max_wait=float(os.environ.get('RATE_LIMIT_MAX_WAIT_SECONDS', "0.25")))
+  stats.add('rate_limit', scheduler.stats)
+  return scheduler
+
+def create_dedup():
+  ttl = float(os.environ.get('DEDUP_TTL_SECONDS', "600"))
+  if ttl <= 0:
+    return None
+  dedup = DedupIndex(
+    ttl, capacity=int(os.environ.get('DEDUP_CAPACITY', "100000")),
+    path=os.environ.get('DEDUP_PATH'))
+  stats.add('dedup', dedup.stats)
+  return dedup
+
+def create_delivery(dummy_mode):
+  """Returns the outbox, SMTP sender (None in dummy mode) and dedup index."""
+  dedup = create_dedup()
   if dummy_mode:
-    service = DummyEmailService()
+    smtp = None
+    outbox = create_outbox(create_scheduler(DummyEmailService.send_batch))
   else:
-    raise Exception('non-dummy mode not implemented yet')
+    smtp = create_smtp_sender()
+    outbox = create_outbox(create_scheduler(smtp))
+  return outbox, smtp, dedup
+
+def drain(outbox, smtp, dedup):
+  # no new mail can arrive now, send what is queued
+  outbox.close(float(os.environ.get('OUTBOX_DRAIN_SECONDS', "5")))
+  if smtp is not None:
+    smtp.close()
+  if isinstance(renderer, ProcessPoolRenderer):
+    renderer.close()
+  if dedup is not None:
+    dedup.close()
+
+def raise_keyboard_interrupt(signum, frame):
+  raise KeyboardInterrupt()
+
+def start(dummy_mode, shutdown_grace=0, options=None):
+  limiter = create_limiter()
+  interceptors = []
+  if limiter:
+    interceptors.append(ConcurrencyLimitInterceptor(limiter))
+  # innermost, so that shed calls do not count as served
+  interceptors.append(startup.FirstRequestInterceptor(startup.timeline))
+  server = grpc.server(futures.ThreadPoolExecutor(max_workers=10),
+                       interceptors=interceptors, options=options)
+  enqueue_timeout = float(os.environ.get('OUTBOX_ENQUEUE_TIMEOUT_SECONDS', "1"))
+  outbox, smtp, dedup = create_delivery(dummy_mode)
+  if dummy_mode:
+    service = DummyEmailService(outbox, enqueue_timeout, dedup)
+  else:
+    # the SMTP sender belongs to the outbox, see create_delivery
+    service = BaseEmailService(outbox, enqueue_timeout, dedup)
 
   demo_pb2_grpc.add_EmailServiceServicer_to_server(service, server)
   health_pb2_grpc.add_HealthServicer_to_server(service, server)
@@ -129,11 +421,53 @@ def start(dummy_mode):
   logger.info("listening on port: "+port)
   server.add_insecure_port('[::]:'+port)
   server.start()
+  startup.timeline.mark('serving')
+  if isinstance(renderer, ProcessPoolRenderer):
+    startup.timeline.run_in_background('render_pool', renderer.start)
+  stats.start()
+  # Kubernetes stops pods with SIGTERM, which takes the same path as ^C
+  signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
   try:
     while True:
       time.sleep(3600)
   except KeyboardInterrupt:
-    server.stop(0)
+    server.stop(shutdown_grace).wait()
+    drain(outbox, smtp, dedup)
+
+async def start_aio(dummy_mode, shutdown_grace=0, options=None):
+  limiter = create_limiter()
+  interceptors = []
+  if limiter:
+    interceptors.append(AioConcurrencyLimitInterceptor(limiter))
+  # innermost, so that shed calls do not count as served
+  interceptors.append(startup.AioFirstRequestInterceptor(startup.timeline))
+  server = grpc.aio.server(interceptors=interceptors, options=options)
+  enqueue_timeout = float(os.environ.get('OUTBOX_ENQUEUE_TIMEOUT_SECONDS', "1"))
+  outbox, smtp, dedup = create_delivery(dummy_mode)
+  service = AioEmailService(outbox, enqueue_timeout, dedup)
+
+  demo_pb2_grpc.add_EmailServiceServicer_to_server(service, server)
+  health_pb2_grpc.add_HealthServicer_to_server(service, server)
+
+  port = os.environ.get('PORT', "8080")
+  logger.info("listening on port: " + port + " (grpc.aio)")
+  server.add_insecure_port('[::]:'+port)
+  await server.start()
+  startup.timeline.mark('serving')
+  if isinstance(renderer, ProcessPoolRenderer):
+    startup.timeline.run_in_background('render_pool', renderer.start)
+  stats.start()
+
+  # SIGTERM and SIGINT stop the loop's wait instead of interrupting it,
+  # here and in pre-fork workers alike
+  stopping = asyncio.Event()
+  loop = asyncio.get_running_loop()
+  for signum in (signal.SIGTERM, signal.SIGINT):
+    loop.add_signal_handler(signum, stopping.set)
+  await stopping.wait()
+  # in-flight calls finish and their mail is enqueued before the drain
+  await server.stop(shutdown_grace)
+  drain(outbox, smtp, dedup)
 
 def initStackdriverProfiling():
   project_id = None
@@ -145,10 +479,12 @@ def initStackdriverProfiling():
 
   for retry in range(1,4):
     try:
+      # started off the main thread, which wall profiling requires; it only
+      # sampled the main thread, and that thread does not serve requests
       if project_id:
-        googlecloudprofiler.start(service='email_server', service_version='1.0.0', verbose=0, project_id=project_id)
+        googlecloudprofiler.start(service='email_server', service_version='1.0.0', verbose=0, project_id=project_id, disable_wall_profiling=True)
       else:
-        googlecloudprofiler.start(service='email_server', service_version='1.0.0', verbose=0)
+        googlecloudprofiler.start(service='email_server', service_version='1.0.0', verbose=0, disable_wall_profiling=True)
       logger.info("Successfully started Stackdriver Profiler.")
       return
     except (BaseException) as exc:
@@ -161,10 +497,7 @@ def initStackdriverProfiling():
   return
 
 
-if __name__ == '__main__':
-  logger.info('starting the email service in dummy mode.')
-
-  # Profiler
+def initProfiler():
   try:
     if "DISABLE_PROFILER" in os.environ:
       raise KeyError()
@@ -174,7 +507,7 @@ if __name__ == '__main__':
   except KeyError:
       logger.info("Profiler disabled.")
 
-  # Tracing
+def initTracing():
   try:
     if os.environ["ENABLE_TRACING"] == "1":
       otel_endpoint = os.getenv("COLLECTOR_SERVICE_ADDR", "localhost:4317")
@@ -187,12 +520,56 @@ if __name__ == '__main__':
           )
         )
       )
-    grpc_server_instrumentor = GrpcInstrumentorServer()
-    grpc_server_instrumentor.instrument()
-
   except (KeyError, DefaultCredentialsError):
       logger.info("Tracing disabled.")
   except Exception as e:
       logger.warn(f"Exception on Cloud Trace setup: {traceback.format_exc()}, tracing disabled.") 
-  
-  start(dummy_mode = True)
+
+def initTelemetry(server_mode):
+  # the instrumentor patches grpc.server, so it must run before the server
+  # is created; spans go to the real provider once it is set
+  if "ENABLE_TRACING" in os.environ:
+    try:
+      if server_mode == 'aio':
+        GrpcAioInstrumentorServer().instrument()
+      else:
+        grpc_server_instrumentor = GrpcInstrumentorServer()
+        grpc_server_instrumentor.instrument()
+    except Exception as e:
+      logger.warn(f"Exception on gRPC instrumentation: {traceback.format_exc()}")
+  # the profiler retries and the exporter may wait on credentials, neither
+  # should hold up binding the port
+  startup.timeline.run_in_background('profiler', initProfiler)
+  startup.timeline.run_in_background('tracing', initTracing)
+  startup.timeline.mark('telemetry')
+
+def run(server_mode, shutdown_grace, options):
+  # profiler and exporter channels must be created after any fork
+  initTelemetry(server_mode)
+  init_components()
+  dummy_mode = "SMTP_HOST" not in os.environ
+  if server_mode == 'aio':
+    try:
+      asyncio.run(start_aio(dummy_mode, shutdown_grace, options))
+    except KeyboardInterrupt:
+      pass  # interrupted before the signal handlers were installed
+  else:
+    start(dummy_mode = dummy_mode,
+          shutdown_grace = shutdown_grace, options = options)
+
+
+if __name__ == '__main__':
+  if "SMTP_HOST" in os.environ:
+    logger.info('starting the email service, sending through ' + os.environ['SMTP_HOST'])
+  else:
+    logger.info('starting the email service in dummy mode.')
+  shutdown_grace = float(os.environ.get('SHUTDOWN_GRACE_SECONDS', "0"))
+  server_mode = os.environ.get('GRPC_SERVER_MODE', 'threadpool')
+
+  workers = int(os.environ.get('WORKERS', "1"))
+  if workers > 1:
+    prefork.Supervisor(
+      lambda: run(server_mode, shutdown_grace, prefork.SERVER_OPTIONS),
+      workers, grace = shutdown_grace).run()
+  else:
+    run(server_mode, shutdown_grace, None)
@@ -14,10 +14,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# Logging goes through a bounded queue to a single writer thread, so request
+# threads only build the record. When the queue is full records are dropped
+# and counted rather than blocking the caller. Configuration:
+#
+#   LOG_ASYNC          "0" writes synchronously from the calling thread
+#   LOG_BUFFER_SIZE    records held before dropping, default 10000
+#   LOG_SAMPLE_RATES   per-logger fraction of INFO and DEBUG records kept,
+#                      e.g. "recommendationservice-server=0.1"; warnings
+#                      and errors are never sampled
+
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
 import sys
+import threading
 from pythonjsonlogger import jsonlogger
 
+LOG_ASYNC = os.environ.get('LOG_ASYNC', "1") != "0"
+LOG_BUFFER_SIZE = int(os.environ.get('LOG_BUFFER_SIZE', "10000"))
+SAMPLE_RATES = {
+  name.strip(): float(rate)
+  for name, _, rate in (entry.partition('=') for entry in
+                        os.environ.get('LOG_SAMPLE_RATES', '').split(',') if entry)}
+
+# LogRecord attributes that are not `extra` fields
+RESERVED_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
 # TODO(yoshifumi) this class is duplicated since other Python services are
 # not sharing the modules for logging.
 class CustomJsonFormatter(jsonlogger.JsonFormatter):
@@ -30,12 +57,117 @@ class CustomJsonFormatter(jsonlogger.JsonFormatter):
     else:
       log_record['severity'] = record.levelname
 
+class FastJsonFormatter(logging.Formatter):
+  """Same output as CustomJsonFormatter, from a single json encoder call."""
+
+  encoder = json.JSONEncoder(default=str)
+
+  def format(self, record):
+    entry = {
+      'timestamp': record.created,
+      'severity': str(getattr(record, 'severity', record.levelname)).upper(),
+      'name': record.name,
+      'message': record.getMessage(),
+    }
+    for key, value in record.__dict__.items():
+      if key not in RESERVED_ATTRS and key not in entry:
+        entry[key] = value
+    if record.exc_info and not record.exc_text:
+      record.exc_text = self.formatException(record.exc_info)
+    if record.exc_text:
+      entry['exc_info'] = record.exc_text
+    return self.encoder.encode(entry)
+
+class _Counters(object):
+  def __init__(self):
+    self.dropped = 0
+    self.sampled_out = 0
+    self.lock = threading.Lock()
+
+_counters = _Counters()
+
+class _Sampler(logging.Filter):
+  def __init__(self, rate):
+    super(_Sampler, self).__init__()
+    self.rate = rate
+
+  def filter(self, record):
+    if record.levelno >= logging.WARNING or random.random() < self.rate:
+      return True
+    with _counters.lock:
+      _counters.sampled_out += 1
+    return False
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+  def prepare(self, record):
+    # Merge the arguments now, since they may change after the call returns,
+    # but leave the JSON encoding to the writer thread.
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info:
+      record.exc_text = output_handler.formatter.formatException(record.exc_info)
+      record.exc_info = None
+    return record
+
+  def enqueue(self, record):
+    # SimpleQueue is unbounded but much cheaper than queue.Queue, so the
+    # bound is checked here; it may be overshot by a few concurrent callers
+    if self.queue.qsize() >= LOG_BUFFER_SIZE:
+      with _counters.lock:
+        _counters.dropped += 1
+      return
+    self.queue.put(record)
+
+output_handler = logging.StreamHandler(sys.stdout)
+output_handler.setFormatter(FastJsonFormatter())
+_queue_handlers = []
+_pipeline = {}
+
+def _start_pipeline():
+  _pipeline['queue'] = queue.SimpleQueue()
+  _pipeline['listener'] = logging.handlers.QueueListener(_pipeline['queue'], output_handler)
+  _pipeline['listener'].start()
+  for handler in _queue_handlers:
+    handler.queue = _pipeline['queue']
+
+def _restart_pipeline_in_child():
+  # The writer thread does not survive fork() and the queue's lock may have
+  # been held by it; start over, the parent writes its own pending records.
+  if _pipeline:
+    _start_pipeline()
+
+def flush():
+  """Writes out queued records and stops the writer thread."""
+  listener = _pipeline.pop('listener', None)
+  if listener is not None:
+    listener.stop()
+
+def getLogStats():
+  with _counters.lock:
+    return {
+      'dropped': _counters.dropped,
+      'sampled_out': _counters.sampled_out,
+      'queued': _pipeline['queue'].qsize() if _pipeline else 0,
+    }
+
+os.register_at_fork(after_in_child=_restart_pipeline_in_child)
+
 def getJSONLogger(name):
   logger = logging.getLogger(name)
-  handler = logging.StreamHandler(sys.stdout)
-  formatter = CustomJsonFormatter('%(timestamp)s %(severity)s %(name)s %(message)s')
-  handler.setFormatter(formatter)
+  if LOG_ASYNC:
+    if not _pipeline:
+      _start_pipeline()
+      atexit.register(flush)
+    handler = _DroppingQueueHandler(_pipeline['queue'])
+    _queue_handlers.append(handler)
+  else:
+    handler = logging.StreamHandler(sys.stdout)
+    formatter = CustomJsonFormatter('%(timestamp)s %(severity)s %(name)s %(message)s')
+    handler.setFormatter(formatter)
   logger.addHandler(handler)
+  rate = SAMPLE_RATES.get(name)
+  if rate is not None and rate < 1:
+    logger.addFilter(_Sampler(rate))
   logger.setLevel(logging.INFO)
   logger.propagate = False
   return logger
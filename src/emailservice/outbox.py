@@ -0,0 +1,203 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-process outbox for confirmation emails. SendOrderConfirmation renders
+# the message and enqueues it; worker threads drain the queue in batches and
+# hand them to a sender, so checkout does not wait for mail delivery.
+#
+# A sender is a callable taking a list of Emails and returning a list of the
+# same length with None for each message sent, or the exception it failed
+# with. A Deferred exception means the message was not attempted and should
+# be sent again after its delay; it does not count as a failure.
+
+import asyncio
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+from logger import getJSONLogger
+logger = getJSONLogger('emailservice-outbox')
+
+Email = collections.namedtuple('Email', ['to', 'subject', 'html', 'order_id'])
+
+class OutboxFull(Exception):
+  pass
+
+class Deferred(Exception):
+  def __init__(self, message, delay):
+    super().__init__(message)
+    self.delay = delay
+
+class Outbox(object):
+  """Bounded in-memory queue drained by `workers` threads.
+
+  `put` blocks while the queue is full, for at most `timeout` seconds, and
+  then raises OutboxFull so callers can push back on their clients. Workers
+  take up to `batch_size` messages at once, waiting up to `linger` seconds
+  for a batch to fill when the queue is short. `close` stops accepting mail
+  and waits for the queue to drain.
+  """
+
+  def __init__(self, sender, capacity=1000, workers=2, batch_size=20, linger=0.01):
+    self._sender = sender
+    self._capacity = capacity
+    self._batch_size = batch_size
+    self._linger = linger
+    self._queue = collections.deque()
+    # deferred emails as (due, seq, email), counted against the capacity
+    self._delayed = []
+    self._seq = itertools.count()
+    self._cond = threading.Condition()
+    self._closed = False
+    self.sent = 0
+    self.failed = 0
+    self.deferred = 0
+    self.rejected = 0
+    self._workers = [
+      threading.Thread(target=self._run, name='outbox-{}'.format(i), daemon=True)
+      for i in range(workers)]
+    for worker in self._workers:
+      worker.start()
+
+  def put(self, email, timeout=None):
+    if not self.put_many([email], timeout):
+      raise OutboxFull('outbox is full')
+
+  def put_many(self, emails, timeout=None):
+    """Enqueues `emails` in order, waiting for room for at most `timeout`
+    seconds in all. Returns how many were enqueued."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self._cond:
+      count = 0
+      while count < len(emails) and not self._closed:
+        added = self._add(emails[count:])
+        if not added:
+          remaining = None if deadline is None else deadline - time.monotonic()
+          if remaining is not None and remaining <= 0:
+            break
+          self._cond.wait(remaining)
+          continue
+        count += added
+      self.rejected += len(emails) - count
+      return count
+
+  async def put_async(self, email, timeout=None):
+    if not await self.put_many_async([email], timeout):
+      raise OutboxFull('outbox is full')
+
+  async def put_many_async(self, emails, timeout=None):
+    """put_many for asyncio callers. What fits is enqueued without leaving
+    the event loop; only waiting for room is done on an executor thread."""
+    with self._cond:
+      count = 0 if self._closed else self._add(emails)
+    if count < len(emails):
+      count += await asyncio.get_running_loop().run_in_executor(
+        None, self.put_many, emails[count:], timeout)
+    return count
+
+  def _add(self, emails):
+    # with self._cond held
+    room = self._capacity - len(self._queue) - len(self._delayed)
+    added = emails[:max(0, room)]
+    if added:
+      self._queue.extend(added)
+      self._cond.notify_all()
+    return len(added)
+
+  def _promote(self):
+    now = time.monotonic()
+    delayed = self._delayed
+    while delayed and delayed[0][0] <= now:
+      self._queue.append(heapq.heappop(delayed)[2])
+    return delayed[0][0] - now if delayed else None
+
+  def _take(self):
+    """Returns the next batch, or None once closed and drained."""
+    with self._cond:
+      lingered = False
+      while True:
+        wait = self._promote()
+        if not self._queue:
+          if self._closed and wait is None:
+            return None
+          # another worker may have taken the queue while we lingered
+          lingered = False
+          self._cond.wait(wait)
+          continue
+        if (not lingered and len(self._queue) < self._batch_size and
+            not self._closed and self._linger):
+          # a short wait lets a burst share one batch
+          lingered = True
+          self._cond.wait(self._linger)
+          continue
+        break
+      count = min(self._batch_size, len(self._queue))
+      batch = [self._queue.popleft() for _ in range(count)]
+      self._cond.notify_all()
+      return batch
+
+  def _run(self):
+    while True:
+      batch = self._take()
+      if batch is None:
+        return  # closed and drained
+      try:
+        results = self._sender(batch)
+      except Exception as err:
+        results = [err] * len(batch)
+      deferred = [(email, err) for email, err in zip(batch, results)
+                  if isinstance(err, Deferred)]
+      failures = [(email, err) for email, err in zip(batch, results)
+                  if err is not None and not isinstance(err, Deferred)]
+      for email, err in failures:
+        logger.error("could not send confirmation for order {} to {}: {}".format(
+          email.order_id, email.to, err))
+      with self._cond:
+        self.sent += len(batch) - len(failures) - len(deferred)
+        self.failed += len(failures)
+        self.deferred += len(deferred)
+        now = time.monotonic()
+        for email, err in deferred:
+          heapq.heappush(self._delayed, (now + err.delay, next(self._seq), email))
+        if deferred:
+          self._cond.notify_all()
+
+  def close(self, timeout=None):
+    """Stops accepting mail and waits up to `timeout` seconds for the
+    queued messages to be sent. Returns the number left unsent."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for worker in self._workers:
+      worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+    with self._cond:
+      left = len(self._queue) + len(self._delayed)
+    if left:
+      logger.warning("outbox closed with {} unsent confirmations".format(left))
+    return left
+
+  def stats(self):
+    with self._cond:
+      return {
+        'queued': len(self._queue) + len(self._delayed),
+        'sent': self.sent,
+        'failed': self.failed,
+        'deferred': self.deferred,
+        'rejected': self.rejected,
+      }
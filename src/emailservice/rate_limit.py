@@ -0,0 +1,198 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-recipient-domain rate limiting, enabled with RATE_LIMIT_PER_SECOND.
+#
+# Every recipient domain has a token bucket. A batch from the outbox is
+# reordered to take one message per domain in turn, and each message takes
+# a token from its domain's bucket. Messages with a token are sent at once;
+# a message whose token is due within `max_wait` seconds is sent when it is
+# due, which holds the outbox worker for at most that long. The others are
+# returned as RateLimited, which outboxes take as a deferral rather than a
+# failure: the message is put back until its domain has tokens again, and
+# the mail queued behind it for other domains goes out in the meantime.
+#
+# Buckets that are full again are the same as new ones, and are dropped
+# once more than `max_domains` domains have buckets. Every domain without a
+# token to spare, or with messages deferred, is reported as throttled.
+
+import heapq
+import threading
+import time
+
+from outbox import Deferred
+from smtp_sender import recipient_domain
+
+class RateLimited(Deferred):
+  pass
+
+class TokenBucket(object):
+  """`rate` tokens a second, up to `burst`."""
+
+  def __init__(self, rate, burst, now):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self._updated = now
+    # messages the latest batch deferred, back in the outbox for tokens
+    self.waiting = 0
+
+  def refill(self, now):
+    self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+  def reserve(self, now, max_wait):
+    """Takes a token and returns the seconds until it is due, or returns
+    None without taking one if that is more than `max_wait`."""
+    self.refill(now)
+    wait = max(0.0, (1 - self.tokens) / self.rate)
+    if wait > max_wait:
+      return None
+    self.tokens -= 1
+    return wait
+
+  def available_in(self, now, position):
+    """Seconds until the token after `position` more are taken is due."""
+    return max(0.0, (1 + position - self.tokens) / self.rate)
+
+def check_limit(rate, burst, name='rate limit'):
+  # a zero rate would divide by zero, and a burst under one never fills
+  if not rate > 0:
+    raise ValueError("{}: rate must be above 0, got {}".format(name, rate))
+  if burst is not None and not burst >= 1:
+    raise ValueError("{}: burst must be at least 1, got {}".format(name, burst))
+
+def parse_overrides(value):
+  """Parses "domain=rate[:burst],..." into {domain: (rate, burst or None)}."""
+  overrides = {}
+  for entry in filter(None, (e.strip() for e in value.split(','))):
+    domain, _, limit = entry.partition('=')
+    rate, _, burst = limit.partition(':')
+    rate, burst = float(rate), float(burst) if burst else None
+    check_limit(rate, burst, domain.strip())
+    overrides[domain.strip().lower()] = (rate, burst)
+  return overrides
+
+class DomainScheduler(object):
+  """Outbox sender that passes batches on to `sender` at no more than
+  `rate` messages a second per recipient domain, with bursts of `burst`.
+  `overrides` maps domains to their own (rate, burst)."""
+
+  def __init__(self, sender, rate, burst=10, overrides=None, max_wait=0.25,
+               max_domains=10000):
+    check_limit(rate, burst)
+    for domain, (domain_rate, domain_burst) in (overrides or {}).items():
+      check_limit(domain_rate, domain_burst, domain)
+    self._sender = sender
+    self._rate = rate
+    self._burst = burst
+    self._overrides = overrides or {}
+    self._max_wait = max_wait
+    self._max_domains = max_domains
+    self._buckets = {}
+    self._lock = threading.Lock()
+    self.immediate = 0
+    self.waited = 0
+    self.deferred = 0
+
+  def _bucket(self, domain, now):
+    bucket = self._buckets.get(domain)
+    if bucket is None:
+      if len(self._buckets) >= self._max_domains:
+        self._prune(now)
+      rate, burst = self._overrides.get(domain, (self._rate, None))
+      bucket = self._buckets[domain] = TokenBucket(rate, burst or self._burst, now)
+    return bucket
+
+  def _prune(self, now):
+    for domain, bucket in list(self._buckets.items()):
+      bucket.refill(now)
+      if bucket.tokens >= bucket.burst and not bucket.waiting:
+        del self._buckets[domain]
+
+  def __call__(self, emails):
+    by_domain = {}
+    for i, email in enumerate(emails):
+      by_domain.setdefault(recipient_domain(email.to), []).append(i)
+    # one message per domain in turn, so every domain in the batch gets a
+    # share of the tokens and of the sends before any domain's second message
+    runs = list(by_domain.items())
+    order = [(domain, indexes[n]) for n in range(max(map(len, by_domain.values()), default=0))
+             for domain, indexes in runs if n < len(indexes)]
+
+    results = [None] * len(emails)
+    due = []
+    now = time.monotonic()
+    with self._lock:
+      refused = {}
+      for seq, (domain, i) in enumerate(order):
+        bucket = self._bucket(domain, now)
+        wait = bucket.reserve(now, self._max_wait) if domain not in refused else None
+        if wait is None:
+          # later messages of the domain queue behind this one
+          position = refused.get(domain, 0)
+          refused[domain] = position + 1
+          results[i] = RateLimited(
+            'rate limited sending to {}'.format(domain), bucket.available_in(now, position))
+        else:
+          heapq.heappush(due, (now + wait, seq, i))
+      for domain in by_domain:
+        self._buckets[domain].waiting = refused.get(domain, 0)
+      self.deferred += len(emails) - len(due)
+      self.waited += sum(1 for when, _, _ in due if when > now)
+      self.immediate += sum(1 for when, _, _ in due if when <= now)
+
+    while due:
+      wait = due[0][0] - time.monotonic()
+      if wait > 0:
+        time.sleep(wait)
+      now = time.monotonic()
+      ready = []
+      while due and due[0][0] <= now:
+        ready.append(heapq.heappop(due)[2])
+      try:
+        sent = self._sender([emails[i] for i in ready])
+      except Exception as err:
+        sent = [err] * len(ready)
+      for i, result in zip(ready, sent):
+        results[i] = result
+    return results
+
+  def buckets(self):
+    """Current tokens, rate, burst and waiting messages of every domain
+    with a bucket."""
+    now = time.monotonic()
+    with self._lock:
+      state = {}
+      for domain, bucket in self._buckets.items():
+        bucket.refill(now)
+        state[domain] = {
+          'tokens': round(bucket.tokens, 2), 'rate': bucket.rate, 'burst': bucket.burst,
+          'waiting': bucket.waiting}
+      return state
+
+  def stats(self):
+    buckets = self.buckets()
+    with self._lock:
+      return {
+        'domains': len(buckets),
+        'immediate': self.immediate,
+        'waited': self.waited,
+        'deferred': self.deferred,
+        'throttled': {domain: {'tokens': state['tokens'], 'waiting': state['waiting']}
+                      for domain, state in buckets.items()
+                      if state['tokens'] < 1 or state['waiting']},
+      }
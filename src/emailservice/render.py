@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Confirmation email rendering.
+#
+# An OrderResult is first flattened into a view model of strings, with the
+# money amounts formatted once, and the templates only print those fields.
+# That lets each template be compiled once into its static text and the
+# fields in between: rendering it with a marker for every field and
+# splitting on the markers. A render is then a join of the static parts
+# with the escaped values. Item rows come from their own template and are
+# memoized by the item's wire bytes, since a product at a given quantity
+# and price renders the same row in every order; serializing an item costs
+# less than reading its fields through the protobuf API.
+#
+# Templates must print fields as they are, without filters or conditions on
+# them. The renderer checks at startup that the compiled templates render
+# like Jinja does, and uses Jinja if not.
+
+import functools
+import re
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import Markup, escape
+
+import demo_pb2
+
+from logger import getJSONLogger
+logger = getJSONLogger('emailservice-render')
+
+PAGE_FIELDS = ('order_id', 'tracking_id', 'shipping_cost', 'shipping_address', 'rows')
+ROW_FIELDS = ('product_id', 'quantity', 'price')
+_MARKER = re.compile('\x00([a-z_]+)\x00')
+
+def template_environment(path='templates'):
+  return Environment(
+    loader=FileSystemLoader(path),
+    autoescape=select_autoescape(['html', 'xml'])
+  )
+
+def format_money(money):
+  return "{}.{:02d} {}".format(money.units, money.nanos // 10000000, money.currency_code)
+
+def order_view(order):
+  address = order.shipping_address
+  return {
+    'order_id': order.order_id,
+    'tracking_id': order.shipping_tracking_id,
+    'shipping_cost': format_money(order.shipping_cost),
+    'shipping_address': "{}, {}, {} {}".format(
+      address.street_address, address.city, address.country, address.zip_code),
+  }
+
+def item_view(item):
+  return item.item.product_id, item.item.quantity, format_money(item.cost)
+
+def view_model(order):
+  return dict(order_view(order), items=[item_view(item) for item in order.items])
+
+class CompiledTemplate(object):
+  """A template rendered once with a marker per field, split into the
+  static text around the fields."""
+
+  def __init__(self, template, fields):
+    text = template.render({f: Markup('\x00{}\x00'.format(f)) for f in fields})
+    parts = _MARKER.split(text)
+    self.static = parts[0::2]
+    self.fields = parts[1::2]
+    missing = set(fields) - set(self.fields)
+    if missing:
+      raise ValueError("{} does not print {}".format(template.name, ', '.join(sorted(missing))))
+
+  def render(self, values):
+    static = self.static
+    out = [static[0]]
+    for i, field in enumerate(self.fields):
+      out.append(values[field])
+      out.append(static[i + 1])
+    return ''.join(out)
+
+def _sample_model():
+  return {
+    'order_id': '<id>', 'tracking_id': 'a&b', 'shipping_cost': '1.00 USD',
+    'shipping_address': '"1 Main St", City, US 1',
+    'items': [('P1', 2, '3.50 USD'), ('<P2>', 1, '0.99 EUR')],
+  }
+
+class ConfirmationRenderer(object):
+  """Renders confirmation emails from `env`, caching up to `row_cache_size`
+  item rows."""
+
+  def __init__(self, env, name='confirmation.html', row_name='confirmation_item.html',
+               row_cache_size=4096):
+    self.page = env.get_template(name)
+    self.row = env.get_template(row_name)
+    self._item_row = functools.lru_cache(maxsize=row_cache_size)(self._render_item)
+    self.compiled = False
+    try:
+      self._page = CompiledTemplate(self.page, PAGE_FIELDS)
+      self._row = CompiledTemplate(self.row, ROW_FIELDS)
+      self.compiled = True
+      sample = _sample_model()
+      if self.render_model(sample) != self.render_jinja(sample):
+        raise ValueError("compiled output differs from Jinja's")
+    except ValueError as err:
+      logger.warning("rendering confirmations with Jinja: {}".format(err))
+      self.compiled = False
+
+  def _render_row(self, product_id, quantity, price):
+    if self.compiled:
+      return self._row.render({
+        'product_id': escape(product_id), 'quantity': str(quantity), 'price': escape(price)})
+    return self.row.render(product_id=product_id, quantity=quantity, price=price)
+
+  def _render_item(self, data):
+    return self._render_row(*item_view(demo_pb2.OrderItem.FromString(data)))
+
+  def _render_page(self, view, rows):
+    if not self.compiled:
+      return self.page.render(dict(view, rows=Markup(rows)))
+    return self._page.render({
+      'order_id': escape(view['order_id']),
+      'tracking_id': escape(view['tracking_id']),
+      'shipping_cost': escape(view['shipping_cost']),
+      'shipping_address': escape(view['shipping_address']),
+      'rows': rows,
+    })
+
+  def render_jinja(self, model):
+    """Renders a view model with Jinja alone, for checks and comparisons."""
+    rows = ''.join(self.row.render(product_id=p, quantity=q, price=c)
+                   for p, q, c in model['items'])
+    return self.page.render(dict(model, rows=Markup(rows)))
+
+  def render_model(self, model):
+    rows = ''.join([self._render_row(*item) for item in model['items']])
+    return self._render_page(model, rows)
+
+  def render(self, order):
+    item_row = self._item_row
+    rows = ''.join([item_row(item.SerializeToString()) for item in order.items])
+    return self._render_page(order_view(order), rows)
+
+  def render_many(self, orders):
+    """Returns the HTML, or the exception raised, for each order."""
+    results = []
+    for order in orders:
+      try:
+        results.append(self.render(order))
+      except Exception as err:
+        results.append(err)
+    return results
+
+  def stats(self):
+    info = self._item_row.cache_info()
+    return {
+      'compiled': self.compiled,
+      'row_cache_hits': info.hits,
+      'row_cache_misses': info.misses,
+      'row_cache_size': info.currsize,
+    }
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Process-pool rendering for large orders, enabled with RENDER_PROCESSES.
+#
+# Rendering holds the GIL, so a burst of large orders renders one at a time
+# however many server threads are busy with it. Orders with at least
+# `min_items` items are sent as serialized OrderResults to worker processes
+# with their own renderer, and only the HTML comes back. Smaller orders are
+# cheaper to render than to ship, and stay in-process.
+#
+# Workers are spawned rather than forked: the server has gRPC and logging
+# threads running, which a forked child would inherit in an unknown state.
+# Spawned workers import the server's main module as __mp_main__, which
+# leaves its setup to run(); the pool's own code is in render_worker.
+
+import multiprocessing
+import threading
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+
+import render_worker
+from logger import getJSONLogger
+logger = getJSONLogger('emailservice-render-pool')
+
+class ProcessPoolRenderer(object):
+  """Renders like `renderer`, sending orders with at least `min_items`
+  items to a pool of `processes` workers, started on first use."""
+
+  def __init__(self, renderer, processes, min_items=50, template_dir='templates',
+               row_cache_size=4096):
+    self.renderer = renderer
+    self.min_items = min_items
+    self._processes = processes
+    self._initargs = (template_dir, row_cache_size)
+    self._pool = None
+    self._lock = threading.Lock()
+    self.offloaded = 0
+    self.inline = 0
+    self.fallbacks = 0
+
+  def _get_pool(self):
+    with self._lock:
+      if self._pool is None:
+        self._pool = futures.ProcessPoolExecutor(
+          self._processes, mp_context=multiprocessing.get_context('spawn'),
+          initializer=render_worker.init, initargs=self._initargs)
+      return self._pool
+
+  def start(self):
+    """Starts the workers ahead of the first large order."""
+    pool = self._get_pool()
+    for done in [pool.submit(render_worker.ready) for _ in range(self._processes)]:
+      done.result()
+
+  def _broken(self, pool, err):
+    with self._lock:
+      if self._pool is pool:
+        logger.warning("render pool failed, rendering in-process: {}".format(err))
+        self._pool = None  # the next large order starts a new pool
+    pool.shutdown(wait=False)
+
+  def _render_inline(self, order, fallback=False):
+    with self._lock:
+      if fallback:
+        self.fallbacks += 1
+      else:
+        self.inline += 1
+    try:
+      return self.renderer.render(order)
+    except Exception as err:
+      return err
+
+  def render(self, order):
+    html = self.render_many([order])[0]
+    if isinstance(html, Exception):
+      raise html
+    return html
+
+  def render_many(self, orders):
+    """Renders `orders`, the large ones in parallel. Returns a list with
+    the HTML, or the exception raised, for each order."""
+    results = [None] * len(orders)
+    pending = []
+    for i, order in enumerate(orders):
+      if len(order.items) >= self.min_items:
+        pool = self._get_pool()
+        try:
+          pending.append((i, pool, pool.submit(render_worker.render_serialized, order.SerializeToString())))
+          continue
+        except BrokenProcessPool as err:
+          self._broken(pool, err)
+          results[i] = self._render_inline(order, fallback=True)
+          continue
+      # small orders render here while the workers take the large ones
+      results[i] = self._render_inline(order)
+    for i, pool, future in pending:
+      try:
+        results[i] = future.result()
+        with self._lock:
+          self.offloaded += 1
+      except BrokenProcessPool as err:
+        self._broken(pool, err)
+        results[i] = self._render_inline(orders[i], fallback=True)
+      except Exception as err:
+        results[i] = err
+    return results
+
+  def close(self):
+    with self._lock:
+      pool, self._pool = self._pool, None
+    if pool is not None:
+      pool.shutdown()
+
+  def stats(self):
+    with self._lock:
+      return {
+        'processes': self._processes,
+        'offloaded': self.offloaded,
+        'inline': self.inline,
+        'fallbacks': self.fallbacks,
+      }
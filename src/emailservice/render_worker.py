@@ -0,0 +1,34 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Code run by the render pool's worker processes, see render_pool. It only
+# imports what rendering needs.
+
+import demo_pb2
+from render import ConfirmationRenderer, template_environment
+
+_renderer = None
+
+def init(template_dir, row_cache_size):
+  global _renderer
+  _renderer = ConfirmationRenderer(
+    template_environment(template_dir), row_cache_size=row_cache_size)
+
+def render_serialized(data):
+  return _renderer.render(demo_pb2.OrderResult.FromString(data))
+
+def ready():
+  return True
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Periodically logs counters from the service's components as one JSON
+# line, e.g. {"message": "stats", "response_cache": {"hits": ...}}.
+#
+# TODO: this module is duplicated since other Python services are not
+# sharing modules.
+
+import threading
+
+from logger import getJSONLogger
+logger = getJSONLogger('emailservice-stats')
+
+class StatsReporter(object):
+  def __init__(self, interval):
+    self._interval = interval
+    self._sources = {}
+
+  def add(self, name, stats):
+    """Registers `stats`, a callable returning a dict of counters."""
+    self._sources[name] = stats
+
+  def collect(self):
+    return {name: stats() for name, stats in self._sources.items()}
+
+  def start(self):
+    if self._interval <= 0:
+      return
+    threading.Thread(target=self._run, name='stats-reporter', daemon=True).start()
+
+  def _run(self):
+    stopped = threading.Event()
+    while not stopped.wait(self._interval):
+      if not self._sources:
+        continue
+      try:
+        stats = self.collect()
+      except Exception as err:
+        logger.warning("failed to collect stats: %s", err)
+        continue
+      logger.info("stats", extra=stats)
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from this directory with: python -m unittest test_dedup
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import grpc
+
+import demo_pb2
+import email_server
+from dedup import DedupIndex, confirmation_key, DONE, NEW, PENDING
+
+class Clock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class Context(object):
+  code = None
+  details = None
+
+  def set_code(self, code):
+    self.code = code
+
+  def set_details(self, details):
+    self.details = details
+
+class DedupIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.clock = Clock()
+    patcher = mock.patch('dedup.time.time', self.clock)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_claim_complete_release(self):
+    dedup = DedupIndex(ttl=60)
+    self.assertEqual(NEW, dedup.claim('a'))
+    self.assertEqual(PENDING, dedup.claim('a'))
+    dedup.complete('a')
+    self.assertEqual(DONE, dedup.claim('a'))
+
+    self.assertEqual(NEW, dedup.claim('b'))
+    dedup.release('b')
+    # a failed call does not count, its retry is sent
+    self.assertEqual(NEW, dedup.claim('b'))
+    self.assertEqual(
+      {'entries': 1, 'pending': 1, 'hits': 1, 'misses': 3, 'conflicts': 1}, dedup.stats())
+
+  def test_keys_expire_after_ttl(self):
+    dedup = DedupIndex(ttl=60)
+    dedup.claim('a')
+    dedup.complete('a')
+    self.clock.now += 59
+    self.assertEqual(DONE, dedup.claim('a'))
+    self.clock.now += 1
+    self.assertEqual(NEW, dedup.claim('a'))
+    self.assertEqual(0, dedup.stats()['entries'])
+
+  def test_oldest_keys_are_dropped_at_capacity(self):
+    dedup = DedupIndex(ttl=60, capacity=2)
+    for key in 'abc':
+      dedup.claim(key)
+      dedup.complete(key)
+      self.clock.now += 1
+    self.assertEqual(NEW, dedup.claim('a'))
+    self.assertEqual(DONE, dedup.claim('c'))
+
+  def test_completed_keys_survive_a_restart(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    path = os.path.join(directory, 'dedup.db')
+    dedup = DedupIndex(ttl=60, path=path)
+    for key in ('sent', 'expiring'):
+      dedup.claim(key)
+      dedup.complete(key)
+      self.clock.now += 30
+    dedup.claim('failed')
+    dedup.release('failed')
+    dedup.claim('running')
+    dedup.close()
+
+    self.clock.now += 1
+    reloaded = DedupIndex(ttl=60, path=path)
+    self.addCleanup(reloaded.close)
+    self.assertEqual(NEW, reloaded.claim('sent'))
+    self.assertEqual(DONE, reloaded.claim('expiring'))
+    self.assertEqual(NEW, reloaded.claim('failed'))
+    self.assertEqual(NEW, reloaded.claim('running'))
+
+class SendOrderConfirmationDedupTest(unittest.TestCase):
+  def test_duplicate_of_a_running_call_is_aborted(self):
+    dedup = DedupIndex(ttl=60)
+    service = email_server.DummyEmailService(outbox=None, dedup=dedup)
+    request = demo_pb2.SendOrderConfirmationRequest(
+      email='user@example.com', order=demo_pb2.OrderResult(order_id='order-1'))
+    key = confirmation_key('order-1', 'user@example.com')
+    self.assertEqual(NEW, dedup.claim(key))
+
+    context = Context()
+    service.SendOrderConfirmation(request, context)
+    self.assertEqual(grpc.StatusCode.ABORTED, context.code)
+    self.assertEqual(email_server.IN_FLIGHT_ERROR, context.details)
+
+    # the running call succeeds, and a retry is answered as sent
+    dedup.complete(key)
+    context = Context()
+    service.SendOrderConfirmation(request, context)
+    self.assertIsNone(context.code)
+
+if __name__ == '__main__':
+  unittest.main()
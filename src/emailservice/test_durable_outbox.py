@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from this directory with: python -m unittest test_durable_outbox
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from durable_outbox import DurableOutbox
+from outbox import Deferred, Email
+
+def emails(count, start=0):
+  return [Email('user@example.com', 'subject', 'html', str(i))
+          for i in range(start, start + count)]
+
+def wait_for(condition, timeout=10):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      raise AssertionError('timed out')
+    time.sleep(0.01)
+
+class Recorder(object):
+  """Sender that records the order ids of every email it is given."""
+
+  def __init__(self, results=None, delay=0):
+    self.sent = []
+    self._results = results
+    self._delay = delay
+    self._lock = threading.Lock()
+
+  def __call__(self, batch):
+    time.sleep(self._delay)
+    with self._lock:
+      self.sent.extend(email.order_id for email in batch)
+      calls = len(self.sent)
+    if self._results is None:
+      return [None] * len(batch)
+    return [self._results(calls) for _ in batch]
+
+class DurableOutboxTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'outbox.db')
+    self.outboxes = []
+
+  def tearDown(self):
+    for outbox in self.outboxes:
+      outbox.close(timeout=1)
+    shutil.rmtree(self.dir)
+
+  def outbox(self, sender, **kwargs):
+    outbox = DurableOutbox(sender, self.path, **kwargs)
+    self.outboxes.append(outbox)
+    return outbox
+
+  def rows(self):
+    with sqlite3.connect(self.path) as conn:
+      return conn.execute(
+        'SELECT order_id, attempts, available_at, last_error FROM outbox').fetchall()
+
+  def test_resumes_rows_left_by_a_closed_instance(self):
+    first = self.outbox(Recorder(), workers=0)
+    self.assertEqual(5, first.put_many(emails(5)))
+    self.assertEqual(5, first.close(timeout=0))
+
+    sender = Recorder()
+    second = self.outbox(sender, workers=1)
+    self.assertEqual(5, second.stats()['queued'])
+    wait_for(lambda: second.stats()['sent'] == 5)
+    self.assertEqual([str(i) for i in range(5)], sorted(sender.sent))
+    self.assertEqual([], self.rows())
+
+  def test_expired_lease_is_not_completed_twice(self):
+    resent = threading.Event()
+    calls = []
+
+    def sender(batch):
+      calls.append(batch)
+      if len(calls) == 1:
+        # outlive the lease until the other worker has sent the row again
+        resent.wait(10)
+      else:
+        resent.set()
+      return [None] * len(batch)
+
+    outbox = self.outbox(sender, workers=2, lease=0.1)
+    outbox.put(emails(1)[0])
+    self.assertTrue(resent.wait(10))
+    wait_for(lambda: outbox.stats()['sent'] == 1)
+    # the first worker's completion finds another lease on the row
+    time.sleep(0.2)
+    self.assertEqual(2, len(calls))
+    self.assertEqual(1, outbox.stats()['sent'])
+    self.assertEqual(0, outbox.stats()['queued'])
+    self.assertEqual([], self.rows())
+
+  def test_retries_then_gives_up(self):
+    sender = Recorder(lambda calls: RuntimeError('relay said no'))
+    outbox = self.outbox(sender, workers=1, backoff=0.01, max_attempts=3)
+    outbox.put(emails(1)[0])
+    wait_for(lambda: outbox.stats()['failed'] == 1)
+    stats = outbox.stats()
+    self.assertEqual(2, stats['retried'])
+    self.assertEqual(0, stats['queued'])
+    self.assertEqual(['0'] * 3, sender.sent)
+    self.assertEqual([('0', 3, None, 'relay said no')], self.rows())
+
+  def test_deferred_rows_keep_their_attempts(self):
+    sender = Recorder(lambda calls: Deferred('rate limited', 0.05) if calls == 1 else None)
+    outbox = self.outbox(sender, workers=1)
+    outbox.put(emails(1)[0])
+    wait_for(lambda: outbox.stats()['sent'] == 1)
+    stats = outbox.stats()
+    self.assertEqual(1, stats['deferred'])
+    self.assertEqual(0, stats['retried'])
+    self.assertEqual(['0', '0'], sender.sent)
+
+  def test_instances_sharing_a_file_count_the_same_rows(self):
+    # every process of a pre-fork pod sends from the same database
+    first = self.outbox(Recorder(delay=0.01), workers=1, batch_size=5, capacity=60)
+    second = self.outbox(Recorder(delay=0.01), workers=1, batch_size=5, capacity=60)
+    self.assertEqual(50, first.put_many(emails(50)))
+    wait_for(lambda: first.stats()['sent'] + second.stats()['sent'] == 50)
+    wait_for(lambda: first.stats()['queued'] == 0 and second.stats()['queued'] == 0)
+    self.assertGreater(second.stats()['sent'], 0)
+    self.assertEqual(60, first.put_many(emails(60, start=50), timeout=0))
+
+if __name__ == '__main__':
+  unittest.main()
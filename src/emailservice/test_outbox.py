@@ -0,0 +1,41 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from this directory with: python -m unittest test_outbox
+
+import time
+import unittest
+
+from outbox import Email, Outbox
+
+def send_all(emails):
+  return [None] * len(emails)
+
+class OutboxTest(unittest.TestCase):
+  def test_workers_survive_an_emptied_queue(self):
+    # each put wakes every worker, one takes the email during the others'
+    # linger and the rest find the queue empty
+    outbox = Outbox(send_all, workers=4, batch_size=20, linger=0.05)
+    for i in range(5):
+      outbox.put(Email('user@example.com', 'subject', 'html', str(i)))
+      time.sleep(0.1)
+    self.assertEqual(4, sum(worker.is_alive() for worker in outbox._workers))
+    self.assertEqual(0, outbox.close(timeout=5))
+    self.assertEqual(5, outbox.stats()['sent'])
+    self.assertFalse(any(worker.is_alive() for worker in outbox._workers))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from this directory with: python -m unittest test_rate_limit
+
+import unittest
+from unittest import mock
+
+from outbox import Email
+from rate_limit import DomainScheduler, RateLimited, parse_overrides
+
+class Clock(object):
+  """time.monotonic and time.sleep for the scheduler; sleeping advances
+  the clock and is recorded."""
+
+  def __init__(self):
+    self.now = 100.0
+    self.sleeps = []
+
+  def monotonic(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.sleeps.append(round(seconds, 6))
+    self.now += seconds
+
+class Sender(object):
+  def __init__(self):
+    self.batches = []
+
+  def __call__(self, emails):
+    self.batches.append([email.to for email in emails])
+    return [None] * len(emails)
+
+def emails(*recipients):
+  return [Email(to, 'subject', 'html', str(i)) for i, to in enumerate(recipients)]
+
+class DomainSchedulerTest(unittest.TestCase):
+  def setUp(self):
+    self.clock = Clock()
+    for name in ('monotonic', 'sleep'):
+      patcher = mock.patch('rate_limit.time.' + name, getattr(self.clock, name))
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.sender = Sender()
+
+  def test_domains_take_turns(self):
+    scheduler = DomainScheduler(self.sender, rate=1, burst=10)
+    results = scheduler(emails('a1@a.com', 'a2@a.com', 'a3@a.com', 'b1@b.com', 'b2@b.com', 'c1@c.com'))
+    self.assertEqual([None] * 6, results)
+    self.assertEqual(
+      [['a1@a.com', 'b1@b.com', 'c1@c.com', 'a2@a.com', 'b2@b.com', 'a3@a.com']],
+      self.sender.batches)
+    self.assertEqual([], self.clock.sleeps)
+
+  def test_waits_up_to_max_wait_for_a_token(self):
+    scheduler = DomainScheduler(self.sender, rate=10, burst=1, max_wait=0.25)
+    results = scheduler(emails('1@a.com', '2@a.com', '3@a.com'))
+    self.assertEqual([None] * 3, results)
+    self.assertEqual([['1@a.com'], ['2@a.com'], ['3@a.com']], self.sender.batches)
+    self.assertEqual([0.1, 0.1], self.clock.sleeps)
+    stats = scheduler.stats()
+    self.assertEqual((1, 2, 0), (stats['immediate'], stats['waited'], stats['deferred']))
+
+  def test_defers_past_max_wait_until_the_token_is_due(self):
+    scheduler = DomainScheduler(self.sender, rate=1, burst=1, max_wait=0)
+    results = scheduler(emails('1@a.com', '2@a.com', '3@a.com', '1@b.com'))
+    self.assertEqual([None, None], [results[0], results[3]])
+    for result, delay in ((results[1], 1.0), (results[2], 2.0)):
+      self.assertIsInstance(result, RateLimited)
+      self.assertAlmostEqual(delay, result.delay)
+    self.assertEqual([['1@a.com', '1@b.com']], self.sender.batches)
+    self.assertEqual(
+      {'a.com': {'tokens': 0.0, 'waiting': 2}, 'b.com': {'tokens': 0.0, 'waiting': 0}},
+      scheduler.stats()['throttled'])
+
+    # each deferred email comes back when its token is due
+    self.clock.now += 1
+    self.assertEqual([None], scheduler(emails('2@a.com')))
+    self.clock.now += 1
+    self.assertEqual([None], scheduler(emails('3@a.com')))
+    self.assertEqual(0, scheduler.stats()['throttled']['a.com']['waiting'])
+
+  def test_domains_may_have_their_own_limits(self):
+    scheduler = DomainScheduler(
+      self.sender, rate=1, burst=1, max_wait=0, overrides={'big.com': (100, 3)})
+    results = scheduler(emails('1@big.com', '2@big.com', '3@big.com', '1@a.com', '2@a.com'))
+    self.assertEqual([None] * 4, results[:4])
+    self.assertIsInstance(results[4], RateLimited)
+
+class LimitsTest(unittest.TestCase):
+  def test_parse_overrides(self):
+    self.assertEqual(
+      {'gmail.com': (50.0, 200.0), 'yahoo.com': (20.0, None)},
+      parse_overrides(' gmail.com=50:200, Yahoo.com=20,'))
+    self.assertEqual({}, parse_overrides(''))
+
+  def test_rejects_bad_limits(self):
+    for value in ('a.com=0', 'a.com=-1', 'a.com=5:0.5', 'a.com=nan'):
+      with self.assertRaises(ValueError, msg=value):
+        parse_overrides(value)
+    with self.assertRaises(ValueError):
+      DomainScheduler(Sender(), rate=0)
+    with self.assertRaises(ValueError):
+      DomainScheduler(Sender(), rate=1, burst=0)
+    with self.assertRaises(ValueError):
+      DomainScheduler(Sender(), rate=1, overrides={'a.com': (0, None)})
+
+if __name__ == '__main__':
+  unittest.main()
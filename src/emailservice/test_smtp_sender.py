@@ -0,0 +1,83 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from this directory with: python -m unittest test_smtp_sender, after
+# pip install -r requirements-dev.txt
+
+import socket
+import unittest
+
+from aiosmtpd.controller import Controller
+
+from outbox import Email
+from smtp_sender import SmtpPool, SmtpSender
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+class Handler(object):
+  def __init__(self):
+    self.recipients = []
+
+  async def handle_DATA(self, server, session, envelope):
+    self.recipients.extend(envelope.rcpt_tos)
+    return '250 OK'
+
+def emails(count, start=0):
+  return [Email('user{}@example.com'.format(i), 'subject', '<p>html</p>', str(i))
+          for i in range(start, start + count)]
+
+class SmtpSenderTest(unittest.TestCase):
+  def setUp(self):
+    self.handler = Handler()
+    self.port = free_port()
+    self.controller = Controller(self.handler, hostname='127.0.0.1', port=self.port)
+    self.controller.start()
+    self.pool = SmtpPool('127.0.0.1', self.port, size=1, timeout=5)
+    self.sender = SmtpSender(self.pool, 'no-reply@example.com', domain_concurrency=1)
+
+  def tearDown(self):
+    self.sender.close()
+    self.controller.stop()
+
+  def test_reuses_connections(self):
+    self.assertEqual([None] * 5, self.sender(emails(5)))
+    self.assertEqual([None] * 5, self.sender(emails(5, start=5)))
+    self.assertEqual(1, self.pool.connects)
+    self.assertEqual(1, self.pool.open)
+    self.assertEqual(10, len(self.handler.recipients))
+
+  def test_reconnects_after_a_dropped_connection(self):
+    self.assertEqual([None], self.sender(emails(1)))
+    # the relay restarts and drops the pooled connection
+    self.controller.stop()
+    self.controller = Controller(self.handler, hostname='127.0.0.1', port=self.port)
+    self.controller.start()
+    self.assertEqual([None] * 3, self.sender(emails(3, start=1)))
+    self.assertEqual(2, self.pool.connects)
+    self.assertEqual(1, self.pool.open)
+    self.assertEqual(
+      ['user{}@example.com'.format(i) for i in range(4)], self.handler.recipients)
+
+  def test_replaces_connections_after_max_messages(self):
+    self.pool.max_messages = 2
+    self.assertEqual([None] * 5, self.sender(emails(5)))
+    self.assertEqual(3, self.pool.connects)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,373 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks for the recommendation service. Run from this directory:
+#
+#   python benchmark.py sampling [--sizes 1000,100000,1000000]
+#   python benchmark.py load [--modes threadpool,aio] [--concurrency 50,200,1000]
+#   python benchmark.py suite [--sizes 1000,100000] [--rates 100,500] [--output results.json]
+#
+# `load` starts recommendation_server.py once per server mode against an
+# in-process fake product catalog and drives it over real gRPC.
+#
+# `suite` runs the threaded server and a fake catalog with injectable latency
+# in this process, and drives them at fixed request rates from a separate
+# load generator process, so client work does not compete for this GIL.
+# Latency is measured from each request's scheduled send time, so a stalled
+# server cannot hide its backlog. The results, including memory measured in
+# the server process, are written as JSON to compare runs between releases.
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from concurrent import futures
+
+import grpc
+
+import demo_pb2
+import demo_pb2_grpc
+from grpc_health.v1 import health_pb2
+from grpc_health.v1 import health_pb2_grpc
+from sampling import ProductIndex
+
+def sample_by_set_difference(product_ids, excluded, k):
+  # The original ListRecommendations path, kept here for comparison.
+  filtered_products = list(set(product_ids)-set(excluded))
+  num_return = min(k, len(filtered_products))
+  indices = random.sample(range(len(filtered_products)), num_return)
+  return [filtered_products[i] for i in indices]
+
+def bench_sampling(args):
+  print("{:>10} {:>16} {:>16} {:>10}".format(
+    "products", "set diff (us)", "index (us)", "speedup"))
+  for size in args.sizes:
+    product_ids = ["PRODUCT{:08d}".format(i) for i in range(size)]
+    index = ProductIndex(product_ids)
+    excluded = random.sample(product_ids, min(args.excluded, size))
+    number = max(1, args.budget // size)
+    baseline = min(timeit.repeat(
+      lambda: sample_by_set_difference(product_ids, excluded, args.k),
+      number=number, repeat=3)) / number
+    indexed = min(timeit.repeat(
+      lambda: index.sample(args.k, excluded),
+      number=args.number, repeat=3)) / args.number
+    print("{:>10} {:>16.1f} {:>16.2f} {:>9.0f}x".format(
+      size, baseline * 1e6, indexed * 1e6, baseline / indexed))
+
+class FakeProductCatalog(demo_pb2_grpc.ProductCatalogServiceServicer):
+  def __init__(self, size, latency=0.0, jitter=0.0):
+    self.latency = latency
+    self.jitter = jitter
+    self.calls = 0
+    # no names or descriptions, so 100k products fit the default 4MB message
+    self.response = demo_pb2.ListProductsResponse(products=[
+      demo_pb2.Product(id="PRODUCT{:08d}".format(i),
+                       categories=["category{}".format(i % 10)])
+      for i in range(size)])
+
+  def ListProducts(self, request, context):
+    self.calls += 1
+    delay = self.latency + random.uniform(0, self.jitter)
+    if delay > 0:
+      time.sleep(delay)
+    return self.response
+
+def start_fake_catalog(size, latency=0.0, jitter=0.0):
+  server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+  demo_pb2_grpc.add_ProductCatalogServiceServicer_to_server(
+    FakeProductCatalog(size, latency, jitter), server)
+  port = server.add_insecure_port('localhost:0')
+  server.start()
+  return server, 'localhost:{}'.format(port)
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('localhost', 0))
+    return s.getsockname()[1]
+
+def start_recommendation_server(catalog_addr, mode, env=None):
+  port = free_port()
+  server_env = dict(os.environ, PORT=str(port), DISABLE_PROFILER="1",
+                    PRODUCT_CATALOG_SERVICE_ADDR=catalog_addr,
+                    GRPC_SERVER_MODE=mode, **(env or {}))
+  server_env.pop('ENABLE_TRACING', None)
+  process = subprocess.Popen(
+    [sys.executable, 'recommendation_server.py'], env=server_env,
+    stdout=subprocess.DEVNULL)
+  target = 'localhost:{}'.format(port)
+  with grpc.insecure_channel(target) as channel:
+    stub = health_pb2_grpc.HealthStub(channel)
+    deadline = time.monotonic() + 30
+    while True:
+      try:
+        stub.Check(health_pb2.HealthCheckRequest(), timeout=1)
+        return process, target
+      except grpc.RpcError:
+        if process.poll() is not None or time.monotonic() > deadline:
+          process.kill()
+          raise Exception('recommendation server did not start in mode ' + mode)
+        time.sleep(0.2)
+
+def percentile(sorted_values, p):
+  if not sorted_values:
+    return float('nan')
+  return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+async def drive_load(target, concurrency, duration, product_ids):
+  latencies = []
+  errors = 0
+  async with grpc.aio.insecure_channel(target) as channel:
+    stub = demo_pb2_grpc.RecommendationServiceStub(channel)
+    stop_at = time.monotonic() + duration
+
+    async def caller():
+      nonlocal errors
+      while time.monotonic() < stop_at:
+        request = demo_pb2.ListRecommendationsRequest(
+          user_id="bench", product_ids=random.sample(product_ids, 2))
+        start = time.perf_counter()
+        try:
+          await stub.ListRecommendations(request)
+          latencies.append(time.perf_counter() - start)
+        except grpc.aio.AioRpcError:
+          errors += 1
+
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+  latencies.sort()
+  return {
+    'requests': len(latencies),
+    'errors': errors,
+    'throughput': len(latencies) / duration,
+    'p50_ms': percentile(latencies, 0.50) * 1e3,
+    'p99_ms': percentile(latencies, 0.99) * 1e3,
+  }
+
+def bench_load(args):
+  catalog, catalog_addr = start_fake_catalog(args.products)
+  product_ids = ["PRODUCT{:08d}".format(i) for i in range(args.products)]
+  print("{:>10} {:>12} {:>12} {:>10} {:>10} {:>8}".format(
+    "mode", "concurrency", "req/s", "p50 (ms)", "p99 (ms)", "errors"))
+  try:
+    for mode in args.modes:
+      process, target = start_recommendation_server(catalog_addr, mode)
+      try:
+        for concurrency in args.concurrency:
+          result = asyncio.run(drive_load(
+            target, concurrency, args.duration, product_ids))
+          print("{:>10} {:>12} {:>12.0f} {:>10.2f} {:>10.2f} {:>8}".format(
+            mode, concurrency, result['throughput'], result['p50_ms'],
+            result['p99_ms'], result['errors']))
+      finally:
+        process.terminate()
+        process.wait()
+  finally:
+    catalog.stop(0)
+
+async def drive_rate(target, rate, duration, product_ids):
+  latencies = []
+  errors = {}
+  async with grpc.aio.insecure_channel(target) as channel:
+    stub = demo_pb2_grpc.RecommendationServiceStub(channel)
+
+    async def call(scheduled, request):
+      try:
+        await stub.ListRecommendations(request)
+        latencies.append(time.monotonic() - scheduled)
+      except grpc.aio.AioRpcError as err:
+        errors[err.code().name] = errors.get(err.code().name, 0) + 1
+
+    tasks = []
+    start = time.monotonic()
+    for i in range(int(rate * duration)):
+      scheduled = start + i / rate
+      delay = scheduled - time.monotonic()
+      if delay > 0:
+        await asyncio.sleep(delay)
+      request = demo_pb2.ListRecommendationsRequest(
+        user_id="bench", product_ids=random.sample(product_ids, 2))
+      tasks.append(asyncio.ensure_future(call(scheduled, request)))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - start
+  latencies.sort()
+  return {
+    'sent': len(tasks),
+    'ok': len(latencies),
+    'errors': errors,
+    'throughput': len(latencies) / elapsed,
+    'p50_ms': percentile(latencies, 0.50) * 1e3,
+    'p99_ms': percentile(latencies, 0.99) * 1e3,
+    'p999_ms': percentile(latencies, 0.999) * 1e3,
+  }
+
+def bench_drive(args):
+  # load generator half of `suite`, runs in its own process
+  product_ids = ["PRODUCT{:08d}".format(i) for i in range(args.products)]
+  result = asyncio.run(drive_rate(args.target, args.rate, args.duration, product_ids))
+  json.dump(result, sys.stdout)
+
+def silence_server_logs():
+  # keep the cost of formatting log lines, but not the terminal output
+  import logging
+  import logger
+  devnull = open(os.devnull, 'w')
+  logger.output_handler.setStream(devnull)
+  for name in list(logging.root.manager.loggerDict):
+    if name.startswith('recommendationservice'):
+      for handler in logging.getLogger(name).handlers:
+        if isinstance(handler, logging.StreamHandler):
+          handler.setStream(devnull)
+
+def measure_handler_memory(service, product_ids, count=200):
+  # transient memory a single ListRecommendations call needs, in bytes
+  tracemalloc.start()
+  peaks = []
+  for _ in range(count):
+    request = demo_pb2.ListRecommendationsRequest(
+      user_id="bench", product_ids=random.sample(product_ids, 2))
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    service.recommend(service.catalog.get(), request)
+    peaks.append(tracemalloc.get_traced_memory()[1] - before)
+  tracemalloc.stop()
+  return sum(peaks) / len(peaks)
+
+def bench_suite(args):
+  import recommendation_server
+  silence_server_logs()
+  results = []
+  print("{:>10} {:>8} {:>10} {:>9} {:>9} {:>9} {:>12} {:>12}".format(
+    "products", "rate", "req/s", "p50 ms", "p99 ms", "p999 ms", "peak B/req", "kept blk/req"))
+  for size in args.sizes:
+    product_ids = ["PRODUCT{:08d}".format(i) for i in range(size)]
+    for rate in args.rates:
+      catalog_server, catalog_addr = start_fake_catalog(
+        size, args.catalog_latency / 1e3, args.catalog_jitter / 1e3)
+      server, catalog, service = recommendation_server.create_server(
+        catalog_addr, args.catalog_ttl)
+      # engines import their modules, and create their loggers, lazily
+      silence_server_logs()
+      port = server.add_insecure_port('localhost:0')
+      server.start()
+      target = 'localhost:{}'.format(port)
+      try:
+        # warm up the catalog snapshot and the connection
+        with grpc.insecure_channel(target) as channel:
+          stub = demo_pb2_grpc.RecommendationServiceStub(channel)
+          for _ in range(20):
+            stub.ListRecommendations(demo_pb2.ListRecommendationsRequest(
+              user_id="bench", product_ids=product_ids[:1]))
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        output = subprocess.run(
+          [sys.executable, __file__, 'drive', '--target', target,
+           '--rate', str(rate), '--duration', str(args.duration),
+           '--products', str(size)],
+          check=True, capture_output=True).stdout
+        result = json.loads(output)
+        gc.collect()
+        result['retained_blocks_per_request'] = (
+          (sys.getallocatedblocks() - blocks) / max(1, result['ok']))
+        result['peak_bytes_per_request'] = measure_handler_memory(service, product_ids)
+      finally:
+        catalog.stop()
+        server.stop(0).wait()
+        catalog_server.stop(0)
+      result.update(products=size, rate=rate)
+      results.append(result)
+      print("{:>10} {:>8} {:>10.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>12.0f} {:>12.3f}".format(
+        size, rate, result['throughput'], result['p50_ms'], result['p99_ms'],
+        result['p999_ms'], result['peak_bytes_per_request'],
+        result['retained_blocks_per_request']))
+
+  report = {
+    'timestamp': time.time(),
+    'python': platform.python_version(),
+    'grpc': grpc.__version__,
+    'config': {
+      'duration': args.duration,
+      'catalog_latency_ms': args.catalog_latency,
+      'catalog_jitter_ms': args.catalog_jitter,
+      'catalog_ttl': args.catalog_ttl,
+      'environment': {k: v for k, v in os.environ.items()
+                      if k.startswith(('RECOMMENDATION_', 'RESPONSE_CACHE_',
+                                       'CATALOG_', 'ADAPTIVE_CONCURRENCY'))},
+    },
+    'results': results,
+  }
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=2)
+  print("results written to " + args.output)
+
+def main():
+  parser = argparse.ArgumentParser(description='recommendationservice benchmarks')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  sampling = commands.add_parser('sampling',
+    help='compare set-difference sampling with the product index')
+  sampling.add_argument('--sizes', default='1000,100000,1000000',
+    type=lambda v: [int(x) for x in v.split(',')])
+  sampling.add_argument('--k', type=int, default=5)
+  sampling.add_argument('--excluded', type=int, default=3)
+  sampling.add_argument('--number', type=int, default=20000)
+  # total products touched per baseline measurement, bounds its run time
+  sampling.add_argument('--budget', type=int, default=5000000)
+  sampling.set_defaults(func=bench_sampling)
+
+  load = commands.add_parser('load',
+    help='compare server modes at increasing numbers of concurrent callers')
+  load.add_argument('--modes', default='threadpool,aio', type=lambda v: v.split(','))
+  load.add_argument('--concurrency', default='50,200,1000',
+    type=lambda v: [int(x) for x in v.split(',')])
+  load.add_argument('--duration', type=float, default=10, help='seconds per level')
+  load.add_argument('--products', type=int, default=1000)
+  load.set_defaults(func=bench_load)
+
+  suite = commands.add_parser('suite',
+    help='drive an in-process server at fixed request rates, write JSON results')
+  suite.add_argument('--sizes', default='1000,100000',
+    type=lambda v: [int(x) for x in v.split(',')])
+  suite.add_argument('--rates', default='100,500',
+    type=lambda v: [int(x) for x in v.split(',')], help='requests per second')
+  suite.add_argument('--duration', type=float, default=10, help='seconds per run')
+  suite.add_argument('--catalog-latency', type=float, default=0, help='ms per ListProducts')
+  suite.add_argument('--catalog-jitter', type=float, default=0, help='extra random ms')
+  suite.add_argument('--catalog-ttl', type=float,
+    default=float(os.environ.get('CATALOG_CACHE_TTL_SECONDS', "60")))
+  suite.add_argument('--output', default='benchmark-results.json')
+  suite.set_defaults(func=bench_suite)
+
+  drive = commands.add_parser('drive', help=argparse.SUPPRESS)
+  drive.add_argument('--target', required=True)
+  drive.add_argument('--rate', type=float, required=True)
+  drive.add_argument('--duration', type=float, required=True)
+  drive.add_argument('--products', type=int, required=True)
+  drive.set_defaults(func=bench_drive)
+
+  args = parser.parse_args()
+  args.func(args)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+import demo_pb2
+
+from logger import getJSONLogger
+from sampling import ProductIndex
+logger = getJSONLogger('recommendationservice-catalog')
+
+class CatalogSnapshot(object):
+  """The product list from one ListProducts response."""
+
+  def __init__(self, products, version, digest, fetched_at):
+    self.products = products
+    self.product_ids = [p.id for p in products]
+    self.index = ProductIndex(self.product_ids)
+    self.version = version
+    self.digest = digest
+    self.fetched_at = fetched_at
+
+  def age(self):
+    return time.monotonic() - self.fetched_at
+
+class CatalogCache(object):
+  """Holds the last good catalog snapshot and refreshes it in the background.
+
+  `fetch` is called with a timeout in seconds, the remaining deadline of the
+  request waiting on it or None from the refresh thread, and must return a
+  ListProductsResponse.
+  Requests are served from memory; once a snapshot is older than `ttl` the
+  stale copy is still returned while a refresh runs on the background thread.
+  If the catalog is unavailable the last good snapshot keeps being served.
+  A `ttl` of 0 disables caching and fetches on every call.
+
+  Under grpc.aio, `get_async` serves the same snapshot to coroutines and
+  awaits `fetch_async` instead of blocking the event loop on a cold cache.
+
+  Listeners are called with the new snapshot whenever the catalog content
+  changes, on whichever thread stored it, so they should hand off any heavy
+  work rather than do it inline.
+
+  With a `snapshot_path`, every new catalog is also written there as a
+  serialized ListProductsResponse, and a restarted process serves that file
+  until its first live refresh succeeds.
+  """
+
+  def __init__(self, fetch, ttl=60, refresh_interval=None, retry_interval=5,
+               fetch_async=None, snapshot_path=None):
+    self._fetch = fetch
+    self._snapshot_path = snapshot_path
+    self._fetch_async = fetch_async
+    self._cold_fetch = None
+    self._ttl = ttl
+    self._refresh_interval = refresh_interval or ttl
+    self._retry_interval = retry_interval
+    self._snapshot = None
+    self._version = 0
+    self._lock = threading.Lock()
+    # orders saving and listener calls, which happen outside self._lock
+    self._publish_lock = threading.Lock()
+    self._published = 0
+    self._wakeup = threading.Event()
+    self._stopped = threading.Event()
+    self._thread = None
+    self._listeners = []
+
+  def add_listener(self, listener):
+    self._listeners.append(listener)
+    if self._snapshot is not None:
+      listener(self._snapshot)
+
+  def start(self):
+    if self._ttl <= 0 or self._thread is not None:
+      return
+    if self._snapshot_path:
+      self._load()
+    # fetch right away, ready() should not wait for the first request
+    self._wakeup.set()
+    self._thread = threading.Thread(
+      target=self._run, name='catalog-refresh', daemon=True)
+    self._thread.start()
+
+  def ready(self):
+    """True once a snapshot, from disk or live, can be served."""
+    return self._ttl <= 0 or self._snapshot is not None
+
+  def stop(self):
+    self._stopped.set()
+    self._wakeup.set()
+
+  def get(self, timeout=None):
+    if self._ttl <= 0:
+      return self._build(self._fetch(timeout))
+    snapshot = self._snapshot
+    if snapshot is None:
+      # Cold cache: the first caller fetches, everyone else waits on the lock
+      # for as long as their own deadline allows.
+      # without a deadline, sync servers report a huge time remaining
+      if not self._lock.acquire(timeout=-1 if timeout is None else
+                                max(0, min(timeout, threading.TIMEOUT_MAX))):
+        raise TimeoutError('deadline exceeded waiting for the catalog')
+      stored = None
+      try:
+        if self._snapshot is None:
+          stored = self._store(self._fetch(timeout))
+        snapshot = self._snapshot
+      finally:
+        self._lock.release()
+      self._publish(stored)
+      return snapshot
+    if snapshot.age() > self._ttl:
+      self._wakeup.set()
+    return snapshot
+
+  async def get_async(self, timeout=None):
+    if self._ttl <= 0:
+      return self._build(await self._fetch_async(timeout))
+    snapshot = self._snapshot
+    if snapshot is None:
+      # Cold cache: concurrent callers share a single in-flight fetch, each
+      # waiting for it only as long as their own deadline allows.
+      if self._cold_fetch is None:
+        self._cold_fetch = asyncio.ensure_future(self._fetch_async(None))
+      try:
+        response = await asyncio.wait_for(asyncio.shield(self._cold_fetch), timeout)
+      finally:
+        if self._cold_fetch is not None and self._cold_fetch.done():
+          self._cold_fetch = None
+      stored = None
+      with self._lock:
+        if self._snapshot is None:
+          stored = self._store(response)
+        snapshot = self._snapshot
+      if stored is not None:
+        # the file write and listeners must not block the event loop
+        asyncio.get_running_loop().run_in_executor(None, self._publish, stored)
+      return snapshot
+    if snapshot.age() > self._ttl:
+      self._wakeup.set()
+    return snapshot
+
+  def refresh(self):
+    response = self._fetch(None)
+    with self._lock:
+      stored = self._store(response)
+    self._publish(stored)
+
+  def _build(self, response):
+    self._version += 1
+    return CatalogSnapshot(
+      list(response.products), self._version, None, time.monotonic())
+
+  def _load(self):
+    try:
+      with open(self._snapshot_path, 'rb') as f:
+        data = f.read()
+      response = demo_pb2.ListProductsResponse.FromString(data)
+    except FileNotFoundError:
+      return
+    except Exception as err:
+      logger.warning("could not load catalog snapshot from {}: {}".format(
+        self._snapshot_path, err))
+      return
+    stored = None
+    with self._lock:
+      if self._snapshot is None:
+        stored = self._store(response, data, source=self._snapshot_path)
+        # stale from the start, so requests keep asking for a live refresh
+        self._snapshot.fetched_at -= self._ttl
+    self._publish(stored)
+
+  def _save(self, data):
+    # one temporary file per process, workers may share the path
+    tmp_path = '{}.{}.tmp'.format(self._snapshot_path, os.getpid())
+    try:
+      with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp_path, self._snapshot_path)
+    except Exception as err:
+      logger.warning("could not save catalog snapshot to {}: {}".format(
+        self._snapshot_path, err))
+
+  def _store(self, response, data=None, source=None):
+    """Swaps in the snapshot for `response`, with self._lock held. Returns
+    what _publish needs once the lock is released, or None if the catalog
+    did not change."""
+    if data is None:
+      data = response.SerializeToString(deterministic=True)
+    digest = hashlib.sha1(data).hexdigest()
+    current = self._snapshot
+    if current is not None and current.digest == digest:
+      current.fetched_at = time.monotonic()
+      return None
+    self._version += 1
+    self._snapshot = CatalogSnapshot(
+      list(response.products), self._version, digest, time.monotonic())
+    logger.info("catalog snapshot v{} loaded from {} with {} products".format(
+      self._version, source or 'product catalog', len(self._snapshot.products)))
+    return self._snapshot, data if self._snapshot_path and source is None else None
+
+  def _publish(self, stored):
+    # saving to disk and the listeners can be slow, and run without
+    # self._lock, which get_async takes on the event loop
+    if stored is None:
+      return
+    snapshot, data = stored
+    with self._publish_lock:
+      if snapshot.version <= self._published:
+        return  # a newer snapshot went out first
+      self._published = snapshot.version
+      if data is not None:
+        self._save(data)
+      for listener in self._listeners:
+        try:
+          listener(snapshot)
+        except Exception as err:
+          logger.warning("catalog snapshot listener failed: {}".format(err))
+
+  def _run(self):
+    interval = self._refresh_interval
+    while not self._stopped.is_set():
+      self._wakeup.wait(interval)
+      self._wakeup.clear()
+      if self._stopped.is_set():
+        return
+      try:
+        self.refresh()
+        interval = self._refresh_interval
+      except Exception as err:
+        # Keep serving the last good snapshot and retry sooner.
+        logger.warning("catalog refresh failed, serving last good snapshot: {}".format(err))
+        interval = min(self._retry_interval, self._refresh_interval)
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Deadline-aware, optionally hedged ListProducts calls.
+#
+# Every call gets a deadline: the caller's remaining time when a request is
+# waiting on it, capped by `timeout`. With hedging enabled, a second call is
+# sent when the first has not answered after the recent p95 latency (or
+# whichever percentile is configured), and whichever answers first wins.
+
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+
+import grpc
+
+import demo_pb2
+
+# a replica that is down fails fast, hedge right away instead of waiting
+HEDGEABLE_CODES = (grpc.StatusCode.UNAVAILABLE,)
+# latencies to see before the percentile replaces the configured delay
+MIN_SAMPLES = 20
+
+class CatalogClient(object):
+  """Wraps a ProductCatalogService stub. `hedge_delay` (seconds) enables
+  hedging and is used until MIN_SAMPLES latencies have been seen; after
+  that the delay is the `hedge_percentile` of the last `window` calls."""
+
+  def __init__(self, stub, timeout=5, hedge_delay=None, hedge_percentile=95,
+               window=100):
+    self._stub = stub
+    self._timeout = timeout
+    self._hedge_delay = hedge_delay
+    self._hedge_percentile = hedge_percentile
+    self._latencies = deque(maxlen=window)
+    self._lock = threading.Lock()
+    self.calls = 0
+    self.hedges_fired = 0
+    self.hedges_won = 0
+
+  def deadline(self, timeout=None):
+    if timeout is None:
+      return self._timeout
+    return min(timeout, self._timeout)
+
+  def hedge_delay(self):
+    if not self._hedge_delay:
+      return None
+    with self._lock:
+      if len(self._latencies) < MIN_SAMPLES:
+        return self._hedge_delay
+      ordered = sorted(self._latencies)
+    return ordered[int(self._hedge_percentile / 100.0 * (len(ordered) - 1))]
+
+  def _record(self, latency, hedge_won=False):
+    with self._lock:
+      self._latencies.append(latency)
+      if hedge_won:
+        self.hedges_won += 1
+
+  def _count_call(self, hedge=False):
+    with self._lock:
+      if hedge:
+        self.hedges_fired += 1
+      else:
+        self.calls += 1
+
+  def list_products(self, timeout=None):
+    timeout = self.deadline(timeout)
+    delay = self.hedge_delay()
+    start = time.monotonic()
+    self._count_call()
+    if delay is None or delay >= timeout:
+      response = self._stub.ListProducts(demo_pb2.Empty(), timeout=timeout)
+      self._record(time.monotonic() - start)
+      return response
+
+    done = queue.Queue()
+    started = {}
+
+    def launch():
+      call = self._stub.ListProducts.future(
+        demo_pb2.Empty(), timeout=max(0, timeout - (time.monotonic() - start)))
+      started[call] = time.monotonic()
+      call.add_done_callback(done.put)
+      return call
+
+    primary = launch()
+    hedged = False
+    finished = 0
+    while True:
+      try:
+        call = done.get(timeout=None if hedged else delay)
+      except queue.Empty:
+        call = None
+      if not hedged and (call is None or call.code() in HEDGEABLE_CODES):
+        hedged = True
+        self._count_call(hedge=True)
+        launch()
+      if call is None:
+        continue
+      finished += 1
+      if call.code() == grpc.StatusCode.OK:
+        now = time.monotonic()
+        for other in started:
+          if other is not call and not other.done():
+            other.cancel()
+            # a lower bound, but it keeps the slow replica in the percentile
+            self._record(now - started[other])
+        self._record(now - started[call], hedge_won=call is not primary)
+        return call.result()
+      if finished == len(started):
+        return call.result()  # raises the last error
+
+  async def list_products_async(self, timeout=None):
+    timeout = self.deadline(timeout)
+    delay = self.hedge_delay()
+    start = time.monotonic()
+    self._count_call()
+    if delay is None or delay >= timeout:
+      response = await self._stub.ListProducts(demo_pb2.Empty(), timeout=timeout)
+      self._record(time.monotonic() - start)
+      return response
+
+    started = {}
+
+    def launch():
+      call = asyncio.ensure_future(self._stub.ListProducts(
+        demo_pb2.Empty(), timeout=max(0, timeout - (time.monotonic() - start))))
+      started[call] = time.monotonic()
+      return call
+
+    primary = launch()
+    pending = {primary}
+    hedged = False
+    try:
+      while pending:
+        done, pending = await asyncio.wait(
+          pending, timeout=None if hedged else delay,
+          return_when=asyncio.FIRST_COMPLETED)
+        failed = [c for c in done if c.exception() is not None]
+        if not hedged and (not done or any(
+            isinstance(c.exception(), grpc.aio.AioRpcError) and
+            c.exception().code() in HEDGEABLE_CODES for c in failed)):
+          hedged = True
+          self._count_call(hedge=True)
+          pending.add(launch())
+        for call in done:
+          if call.exception() is None:
+            now = time.monotonic()
+            for other in pending:
+              self._record(now - started[other])
+            self._record(now - started[call], hedge_won=call is not primary)
+            return call.result()
+        if not pending:
+          raise failed[-1].exception()
+    finally:
+      for call in pending:
+        call.cancel()
+
+  def stats(self):
+    delay = self.hedge_delay()
+    with self._lock:
+      return {
+        'calls': self.calls,
+        'hedges_fired': self.hedges_fired,
+        'hedges_won': self.hedges_won,
+        'hedge_delay_ms': None if delay is None else round(delay * 1e3, 1),
+      }
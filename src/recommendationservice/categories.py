@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Category-aware recommendations, enabled with RECOMMENDATION_ENGINE=category.
+#
+# Products that have every category of some cart item are preferred, then
+# products sharing any category with the cart. Both pools are set operations
+# over sorted position arrays, one per category, so a request touches only
+# the posting lists of the cart's categories. Unions are never materialized
+# unless they are small: a pool is kept as the list of arrays it is the
+# union of, and sampled by drawing from the arrays in proportion to their
+# length, which also favors products sharing more than one category.
+
+import random
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-categories')
+
+def intersect(a, b):
+  """Intersection of two sorted arrays of unique values in
+  O(len(a) log len(b)), for `a` the shorter one."""
+  if len(a) == 0 or len(b) == 0:
+    return a[:0]
+  found = np.searchsorted(b, a)
+  found[found == len(b)] = 0
+  return a[b[found] == a]
+
+class CategoryIndex(object):
+  """Inverted index from category to the sorted positions of its products
+  in a snapshot's ProductIndex."""
+
+  def __init__(self, snapshot, cache_size=1024):
+    self.products = snapshot.index
+    positions = self.products.positions
+    self.categories_of = [()] * len(self.products)
+    postings = {}
+    for product in snapshot.products:
+      i = positions[product.id]
+      if self.categories_of[i]:
+        continue  # duplicate id, the first one wins as in ProductIndex
+      categories = tuple(sorted(set(product.categories)))
+      self.categories_of[i] = categories
+      for category in categories:
+        postings.setdefault(category, []).append(i)
+    # positions are appended in increasing order, so the arrays are sorted
+    self.postings = {c: np.array(p, dtype=np.uint32) for c, p in postings.items()}
+    self._cache_size = cache_size
+    self._pools = OrderedDict()
+    self._lock = threading.Lock()
+    logger.info("category index built for {} products in {} categories".format(
+      len(self.products), len(self.postings)))
+
+  def pools(self, product_ids):
+    """Returns (strong, weak) pools, each a list of sorted position arrays
+    whose union is the pool: products with all the categories of at least
+    one cart item, and products with any of them."""
+    positions = self.products.positions
+    key = frozenset(self.categories_of[positions[p]]
+                    for p in product_ids if p in positions) - {()}
+    with self._lock:
+      pools = self._pools.get(key)
+      if pools is not None:
+        self._pools.move_to_end(key)
+        return pools
+    pools = self._compute(key)
+    with self._lock:
+      self._pools[key] = pools
+      while len(self._pools) > self._cache_size:
+        self._pools.popitem(last=False)
+    return pools
+
+  def _compute(self, groups):
+    postings = self.postings
+    strong = []
+    for categories in groups:
+      # smallest list first keeps every intermediate result small
+      lists = sorted((postings[c] for c in categories), key=len)
+      common = lists[0]
+      for other in lists[1:]:
+        common = intersect(common, other)
+      if len(common):
+        strong.append(common)
+    weak = [postings[c] for c in sorted({c for g in groups for c in g})]
+    return strong, weak
+
+def pool_size(pool):
+  # an upper bound, products in several arrays count more than once
+  return sum(len(a) for a in pool)
+
+def sample_pool(pool, k, seen, rng=random):
+  """Draws up to k positions from the union of the sorted arrays in
+  `pool` that are not in `seen`, adding them to `seen`."""
+  n = pool_size(pool)
+  if k <= 0 or n == 0:
+    return []
+  if 2 * (len(seen) + k) > n:
+    # most draws would be rejected, a single pass over the pool is cheaper
+    union = pool[0] if len(pool) == 1 else np.unique(np.concatenate(pool))
+    candidates = [i for i in union.tolist() if i not in seen]
+    chosen = rng.sample(candidates, min(k, len(candidates)))
+    seen.update(chosen)
+    return chosen
+  chosen = []
+  randbelow = rng.randrange
+  # cumulative lengths map a draw over all arrays to one element
+  ends = np.cumsum([len(a) for a in pool]).tolist()
+  attempts = 20 * k + 20
+  while len(chosen) < k and attempts > 0:
+    attempts -= 1
+    r = randbelow(n)
+    a = 0
+    while r >= ends[a]:
+      a += 1
+    i = int(pool[a][r - (ends[a - 1] if a else 0)])
+    if i not in seen:
+      seen.add(i)
+      chosen.append(i)
+  return chosen
+
+class CategoryRecommender(object):
+  name = 'category'
+
+  def __init__(self, min_pool=1):
+    self.min_pool = min_pool
+    self.index = None
+    self._pending = None
+    self._ready = threading.Condition()
+    threading.Thread(target=self._run, name='category-index', daemon=True).start()
+
+  def on_snapshot(self, snapshot):
+    # only the latest snapshot matters if several arrive during a build
+    with self._ready:
+      self._pending = snapshot
+      self._ready.notify()
+
+  def recommend(self, snapshot, product_ids, k):
+    index = self.index
+    if index is None:
+      return []
+    strong, weak = index.pools(product_ids)
+    seen = index.products.excluded_positions(product_ids)
+    if pool_size(weak) - len(seen) < self.min_pool:
+      # too few related products, leave the list to global random sampling
+      return []
+    chosen = sample_pool(strong, k, seen)
+    chosen += sample_pool(weak, k - len(chosen), seen)
+    ids = index.products.ids
+    picked = [ids[i] for i in chosen]
+    if index.products is not snapshot.index:
+      # the index may still be catching up with the newest snapshot
+      picked = [p for p in picked if p in snapshot.index]
+    return picked
+
+  def _run(self):
+    while True:
+      with self._ready:
+        while self._pending is None:
+          self._ready.wait()
+        snapshot, self._pending = self._pending, None
+      try:
+        self.index = CategoryIndex(snapshot)
+      except Exception as err:
+        logger.warning("category index build failed: {}".format(err))
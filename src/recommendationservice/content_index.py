@@ -0,0 +1,214 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Content-based recommendations from product names, descriptions and
+# categories, enabled with RECOMMENDATION_ENGINE=content.
+
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-content')
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# bytes of similarity scores computed at once while building the table, so
+# that a large catalog never holds an n x n matrix; ranking a block takes a
+# few times as much again in temporaries
+BLOCK_BYTES = 8 << 20
+
+def block_rows(columns):
+  return max(1, BLOCK_BYTES // (4 * max(1, columns)))
+
+def product_features(product):
+  # Name words count twice and categories three times as much as description
+  # words. Categories are prefixed so they never collide with plain words.
+  name = TOKEN_RE.findall(product.name.lower())
+  words = name + name + TOKEN_RE.findall(product.description.lower())
+  words += ['category:' + c.lower() for c in product.categories] * 3
+  return words
+
+def embed(products, dims):
+  """Hashing vectorizer: signed feature hashing of word counts into `dims`
+  float32 columns, with sublinear term frequency and unit-length rows."""
+  matrix = np.zeros((len(products), dims), dtype=np.float32)
+  for row, product in enumerate(products):
+    counts = {}
+    for word in product_features(product):
+      h = zlib.crc32(word.encode('utf-8'))
+      column = (h >> 1) % dims
+      counts[column] = counts.get(column, 0.0) + (1.0 if h & 1 else -1.0)
+    for column, count in counts.items():
+      matrix[row, column] = np.sign(count) * (1.0 + np.log(abs(count))) if count else 0.0
+  norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+  norms[norms == 0] = 1.0
+  return matrix / norms
+
+def fingerprint(product):
+  return zlib.crc32('\x00'.join(
+    [product.name, product.description] + list(product.categories)).encode('utf-8'))
+
+def top_neighbors(similarity, count, exclude=None):
+  """Returns (columns, scores) of the `count` best columns per row, best
+  first, padded with -1 when a row has fewer candidates."""
+  rows, cols = similarity.shape
+  if exclude is not None:
+    similarity[np.arange(rows), exclude] = -np.inf
+  take = min(count, cols)
+  if take < cols:
+    columns = np.argpartition(-similarity, take - 1, axis=1)[:, :take]
+  else:
+    columns = np.tile(np.arange(cols), (rows, 1))
+  scores = np.take_along_axis(similarity, columns, axis=1)
+  order = np.argsort(-scores, axis=1, kind='stable')
+  columns = np.take_along_axis(columns, order, axis=1)
+  scores = np.take_along_axis(scores, order, axis=1)
+  columns[~np.isfinite(scores)] = -1
+  if take < count:
+    columns = np.pad(columns, ((0, 0), (0, count - take)), constant_values=-1)
+    scores = np.pad(scores, ((0, 0), (0, count - take)), constant_values=-np.inf)
+  return columns.astype(np.int32), scores.astype(np.float32)
+
+class ContentIndex(object):
+  """Product embeddings plus a precomputed top-N cosine neighbor table."""
+
+  def __init__(self, ids, fingerprints, embeddings, neighbors, scores):
+    self.ids = ids
+    self.positions = {pid: i for i, pid in enumerate(ids)}
+    self.fingerprints = fingerprints
+    self.embeddings = embeddings
+    self.neighbors = neighbors
+    self.scores = scores
+
+  @classmethod
+  def build(cls, products, dims, count, previous=None):
+    """Builds the index for `products`. With a `previous` index, unchanged
+    products keep their embeddings and only the rows that can be affected
+    by added, changed or removed products are recomputed."""
+    products = list({p.id: p for p in products}.values())
+    ids = [p.id for p in products]
+    fingerprints = np.array([fingerprint(p) for p in products], dtype=np.uint32)
+    n = len(products)
+
+    # new position -> old position for products whose text did not change
+    old_of_new = np.full(n, -1, dtype=np.int64)
+    if previous is not None:
+      for i, pid in enumerate(ids):
+        j = previous.positions.get(pid)
+        if j is not None and previous.fingerprints[j] == fingerprints[i]:
+          old_of_new[i] = j
+    kept = np.flatnonzero(old_of_new >= 0)
+    changed = np.flatnonzero(old_of_new < 0)
+
+    embeddings = np.empty((n, dims), dtype=np.float32)
+    if kept.size:
+      embeddings[kept] = previous.embeddings[old_of_new[kept]]
+    if changed.size:
+      embeddings[changed] = embed([products[i] for i in changed], dims)
+
+    neighbors = np.full((n, count), -1, dtype=np.int32)
+    scores = np.full((n, count), -np.inf, dtype=np.float32)
+    dirty = changed
+    if kept.size:
+      # old neighbor positions -> new positions, -1 if removed or changed;
+      # the extra last slot keeps -1 padding mapped to -1
+      new_of_old = np.full(len(previous.ids) + 1, -1, dtype=np.int64)
+      new_of_old[old_of_new[kept]] = kept
+      old_neighbors = previous.neighbors[old_of_new[kept]]
+      mapped = new_of_old[old_neighbors]
+      lost = ((mapped < 0) & (old_neighbors >= 0)).any(axis=1)
+      # rows that lost a neighbor cannot know their next best, rebuild them
+      dirty = np.concatenate([changed, kept[lost]])
+      clean = kept[~lost]
+      clean_neighbors = mapped[~lost]
+      clean_scores = previous.scores[old_of_new[clean]]
+      if changed.size:
+        # merge the old lists with similarities to the changed products
+        step = block_rows(count + changed.size)
+        for start in range(0, clean.size, step):
+          block = slice(start, start + step)
+          rows = clean[block]
+          candidates = np.concatenate(
+            [clean_neighbors[block], np.broadcast_to(changed, (rows.size, changed.size))], axis=1)
+          similarity = np.concatenate(
+            [clean_scores[block], embeddings[rows] @ embeddings[changed].T], axis=1)
+          similarity[candidates < 0] = -np.inf
+          best, best_scores = top_neighbors(similarity, count)
+          clean_neighbors[block] = np.where(
+            best >= 0, np.take_along_axis(candidates, np.maximum(best, 0), axis=1), -1)
+          clean_scores[block] = best_scores
+      neighbors[clean] = clean_neighbors
+      scores[clean] = clean_scores
+
+    step = block_rows(n)
+    for start in range(0, dirty.size, step):
+      rows = dirty[start:start + step]
+      neighbors[rows], scores[rows] = top_neighbors(
+        embeddings[rows] @ embeddings.T, count, exclude=rows)
+
+    logger.info("content index built for {} products, {} rows recomputed".format(
+      n, dirty.size))
+    return cls(ids, fingerprints, embeddings, neighbors, scores)
+
+  def query(self, product_ids, k):
+    totals = {}
+    positions = self.positions
+    request = {positions[p] for p in product_ids if p in positions}
+    for row in request:
+      for column, score in zip(self.neighbors[row].tolist(), self.scores[row].tolist()):
+        if column >= 0 and column not in request:
+          totals[column] = totals.get(column, 0.0) + score
+    best = sorted(totals, key=totals.get, reverse=True)[:k]
+    return [self.ids[i] for i in best]
+
+class ContentRecommender(object):
+  name = 'content'
+
+  def __init__(self, dims=128, neighbors=20):
+    self.dims = dims
+    self.count = neighbors
+    self.index = None
+    self._pending = None
+    self._ready = threading.Condition()
+    threading.Thread(target=self._run, name='content-index', daemon=True).start()
+
+  def on_snapshot(self, snapshot):
+    # only the latest snapshot matters if several arrive during a build
+    with self._ready:
+      self._pending = snapshot
+      self._ready.notify()
+
+  def recommend(self, snapshot, product_ids, k):
+    index = self.index
+    if index is None:
+      return []
+    # the index may still be catching up with the newest snapshot
+    return [p for p in index.query(product_ids, 2 * k) if p in snapshot.index][:k]
+
+  def _run(self):
+    while True:
+      with self._ready:
+        while self._pending is None:
+          self._ready.wait()
+        snapshot, self._pending = self._pending, None
+      try:
+        self.index = ContentIndex.build(
+          snapshot.products, self.dims, self.count, previous=self.index)
+      except Exception as err:
+        logger.warning("content index build failed: {}".format(err))
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Item-to-item co-occurrence recommendations.
+#
+# The matrix is built offline from order or cart events, one JSON object per
+# line with a "product_ids" list:
+#
+#   python cooccurrence.py events.jsonl cooccurrence.npz
+#
+# and loaded at startup with RECOMMENDATION_ENGINE=cooccurrence and
+# COOCCURRENCE_MATRIX_PATH=cooccurrence.npz.
+
+import argparse
+import json
+
+import numpy as np
+
+class CooccurrenceMatrix(object):
+  """Sparse item-item scores in CSR form.
+
+  Row i holds the neighbors of ids[i]: columns indices[indptr[i]:indptr[i+1]]
+  with scores data[indptr[i]:indptr[i+1]], at most `max_neighbors` per row.
+  """
+
+  def __init__(self, ids, indptr, indices, data):
+    self.ids = ids
+    self.indptr = indptr
+    self.indices = indices
+    self.data = data
+    self.rows = {pid: i for i, pid in enumerate(ids.tolist())}
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path, allow_pickle=False) as f:
+      return cls(f['ids'], f['indptr'], f['indices'], f['data'])
+
+  def save(self, path):
+    with open(path, 'wb') as f:
+      np.savez(f, ids=self.ids, indptr=self.indptr,
+               indices=self.indices, data=self.data)
+
+  def top_k(self, product_ids, k):
+    rows = [self.rows[p] for p in product_ids if p in self.rows]
+    if not rows:
+      return []
+    indptr = self.indptr
+    cols = np.concatenate([self.indices[indptr[r]:indptr[r+1]] for r in rows])
+    if cols.size == 0:
+      return []
+    scores = np.concatenate([self.data[indptr[r]:indptr[r+1]] for r in rows])
+    # sum the rows of every product in the request
+    cols, inverse = np.unique(cols, return_inverse=True)
+    scores = np.bincount(inverse, weights=scores)
+    scores[np.isin(cols, rows)] = -np.inf
+    if k < cols.size:
+      top = np.argpartition(-scores, k)[:k]
+    else:
+      top = np.arange(cols.size)
+    top = top[np.argsort(-scores[top], kind='stable')]
+    top = top[np.isfinite(scores[top])]
+    return self.ids[cols[top]].tolist()
+
+def build(baskets, max_neighbors=100):
+  """Builds a CooccurrenceMatrix from an iterable of product id lists.
+
+  Scores are co-occurrence counts normalized by the geometric mean of the
+  two products' basket counts (cosine similarity), so best sellers do not
+  dominate every row. Only the `max_neighbors` best columns of each row are
+  kept, which bounds the cost of a lookup.
+  """
+  positions = {}
+  # group baskets by size so pairs are generated with one broadcast per size
+  by_size = {}
+  for basket in baskets:
+    items = [positions.setdefault(p, len(positions)) for p in set(basket)]
+    if items:
+      by_size.setdefault(len(items), []).extend(items)
+  n = len(positions)
+  ids = np.array(list(positions), dtype=str)
+  if not by_size:
+    return CooccurrenceMatrix(
+      ids, np.zeros(n + 1, dtype=np.int64), np.zeros(0, dtype=np.int32),
+      np.zeros(0, dtype=np.float32))
+
+  pair_rows, pair_cols = [], []
+  for size, items in by_size.items():
+    items = np.array(items, dtype=np.int64).reshape(-1, size)
+    pair_rows.append(np.repeat(items, size, axis=1).ravel())
+    pair_cols.append(np.tile(items, (1, size)).ravel())
+  keys = np.concatenate(pair_rows) * n + np.concatenate(pair_cols)
+  keys, counts = np.unique(keys, return_counts=True)
+  rows, cols = np.divmod(keys, n)
+  # the diagonal holds the number of baskets each product appears in
+  diagonal = rows == cols
+  frequency = np.zeros(n)
+  frequency[rows[diagonal]] = counts[diagonal]
+  rows, cols, counts = rows[~diagonal], cols[~diagonal], counts[~diagonal]
+  scores = counts / np.sqrt(frequency[rows] * frequency[cols])
+
+  # keep the best max_neighbors columns of every row
+  order = np.lexsort((-scores, rows))
+  rows, cols, scores = rows[order], cols[order], scores[order]
+  starts = np.searchsorted(rows, np.arange(n))
+  rank = np.arange(rows.size) - starts[rows]
+  keep = rank < max_neighbors
+  rows, cols, scores = rows[keep], cols[keep], scores[keep]
+
+  indptr = np.zeros(n + 1, dtype=np.int64)
+  np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+  return CooccurrenceMatrix(
+    ids, indptr, cols.astype(np.int32), scores.astype(np.float32))
+
+class CooccurrenceRecommender(object):
+  name = 'cooccurrence'
+
+  def __init__(self, matrix):
+    self.matrix = matrix
+
+  def recommend(self, snapshot, product_ids, k):
+    # ask for a few extra in case some neighbors left the catalog
+    candidates = self.matrix.top_k(product_ids, 2 * k)
+    index = snapshot.index
+    return [p for p in candidates if p in index][:k]
+
+def read_baskets(path):
+  with open(path) as f:
+    for line in f:
+      line = line.strip()
+      if line:
+        yield json.loads(line)['product_ids']
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description='build a co-occurrence matrix from order or cart events')
+  parser.add_argument('events', help='JSON lines file with a product_ids list per event')
+  parser.add_argument('output', help='path of the .npz matrix to write')
+  parser.add_argument('--max-neighbors', type=int, default=100)
+  args = parser.parse_args()
+  matrix = build(read_baskets(args.events), args.max_neighbors)
+  matrix.save(args.output)
+  print("wrote {} products and {} neighbors to {}".format(
+    len(matrix.ids), matrix.indices.size, args.output))
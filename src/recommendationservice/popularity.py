@@ -0,0 +1,186 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Popularity-weighted recommendations, enabled with
+# RECOMMENDATION_ENGINE=popularity. Weights come from either or both of:
+#
+#   POPULARITY_WEIGHTS_PATH  a JSON object {"product_id": count, ...},
+#                            reloaded whenever the file changes
+#   POPULARITY_EVENTS_PATH   an append-only feed of JSON lines with a
+#                            "product_ids" list, read incrementally
+
+import json
+import os
+import random
+import threading
+from array import array
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-popularity')
+
+class AliasTable(object):
+  """Vose's alias method: O(n) to build, O(1) per weighted draw."""
+
+  def __init__(self, ids, weights):
+    n = len(ids)
+    self.ids = ids
+    self.positions = {pid: i for i, pid in enumerate(ids)}
+    self.prob = array('d', bytes(8 * n))
+    self.alias = array('I', bytes(4 * n))
+    total = float(sum(weights))
+    if n == 0:
+      return
+    if total <= 0:
+      # no weight to go by, e.g. no sales yet and no smoothing: uniform
+      for i in range(n):
+        self.prob[i] = 1.0
+      return
+    scaled = [w * n / total for w in weights]
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+      s, l = small.pop(), large.pop()
+      self.prob[s] = scaled[s]
+      self.alias[s] = l
+      scaled[l] = (scaled[l] + scaled[s]) - 1.0
+      (small if scaled[l] < 1.0 else large).append(l)
+    # whatever is left is 1 up to rounding
+    for i in large + small:
+      self.prob[i] = 1.0
+
+  def __len__(self):
+    return len(self.ids)
+
+  def sample(self, k, excluded=(), rng=random, max_attempts=None):
+    """Draws up to k distinct ids, skipping `excluded`, by rejection.
+    Expected O(k) draws unless the excluded items hold most of the weight,
+    in which case fewer than k ids may come back after `max_attempts`."""
+    n = len(self.ids)
+    if n == 0:
+      return []
+    positions = self.positions
+    seen = {positions[p] for p in excluded if p in positions}
+    k = min(k, n - len(seen))
+    picked = []
+    prob, alias = self.prob, self.alias
+    randbelow, uniform = rng.randrange, rng.random
+    attempts = max_attempts or 20 * k + 20
+    while len(picked) < k and attempts > 0:
+      attempts -= 1
+      i = randbelow(n)
+      if uniform() >= prob[i]:
+        i = alias[i]
+      if i not in seen:
+        seen.add(i)
+        picked.append(self.ids[i])
+    return picked
+
+class PopularityRecommender(object):
+  name = 'popularity'
+
+  def __init__(self, weights_path=None, events_path=None, smoothing=1.0,
+               poll_interval=10):
+    self.table = None
+    self._weights_path = weights_path
+    self._events_path = events_path
+    self._smoothing = smoothing
+    self._poll_interval = poll_interval
+    self._file_counts = {}
+    self._event_counts = {}
+    self._weights_mtime = None
+    self._events_offset = 0
+    self._product_ids = None
+    self._wakeup = threading.Event()
+    threading.Thread(target=self._run, name='popularity', daemon=True).start()
+
+  def on_snapshot(self, snapshot):
+    self._product_ids = snapshot.index.ids
+    self._wakeup.set()
+
+  def recommend(self, snapshot, product_ids, k):
+    table = self.table
+    if table is None:
+      return []
+    index = snapshot.index
+    # the table may still be catching up with the newest snapshot
+    return [p for p in table.sample(k, product_ids) if p in index]
+
+  def record(self, product_ids, weight=1):
+    """Adds events to the counts; the table is rebuilt on the next poll."""
+    counts = self._event_counts
+    for pid in product_ids:
+      counts[pid] = counts.get(pid, 0) + weight
+
+  def _load_weights(self):
+    if not self._weights_path:
+      return False
+    mtime = os.stat(self._weights_path).st_mtime_ns
+    if mtime == self._weights_mtime:
+      return False
+    with open(self._weights_path) as f:
+      self._file_counts = {str(k): float(v) for k, v in json.load(f).items()}
+    self._weights_mtime = mtime
+    return True
+
+  def _read_events(self):
+    if not self._events_path:
+      return False
+    size = os.stat(self._events_path).st_size
+    if size < self._events_offset:
+      # the feed was truncated or rotated, start over
+      self._events_offset = 0
+      self._event_counts = {}
+    if size == self._events_offset:
+      return False
+    with open(self._events_path, 'rb') as f:
+      f.seek(self._events_offset)
+      for line in f:
+        if not line.endswith(b'\n'):
+          break  # partially written, read it next time
+        self._events_offset += len(line)
+        if line.strip():
+          self.record(json.loads(line)['product_ids'])
+    return True
+
+  def _rebuild(self):
+    ids = self._product_ids
+    file_counts, event_counts = self._file_counts, self._event_counts
+    smoothing = self._smoothing
+    weights = [file_counts.get(p, 0.0) + event_counts.get(p, 0) + smoothing
+               for p in ids]
+    # in-flight requests keep using the previous table
+    self.table = AliasTable(ids, weights)
+    logger.info("popularity table rebuilt for {} products".format(len(ids)))
+
+  def _run(self):
+    built_for = None
+    while True:
+      self._wakeup.wait(self._poll_interval)
+      self._wakeup.clear()
+      changed = False
+      try:
+        changed = self._load_weights()
+      except Exception as err:
+        logger.warning("could not load popularity weights: {}".format(err))
+      try:
+        changed = self._read_events() or changed
+      except Exception as err:
+        logger.warning("could not read popularity events: {}".format(err))
+      if self._product_ids is None:
+        continue
+      if changed or built_for is not self._product_ids:
+        built_for = self._product_ids
+        self._rebuild()
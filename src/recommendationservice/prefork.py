@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Pre-fork supervisor for the Python gRPC services. Each worker process runs
+# its own gRPC server on the same port with SO_REUSEPORT, so the kernel
+# spreads connections across processes and the GIL no longer caps a pod at
+# one core.
+#
+# gRPC does not survive fork(), so the supervisor must fork before any
+# channel, server or exporter is created; everything happens in `target`.
+#
+# TODO: this module is duplicated since other Python services are not
+# sharing modules.
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from logger import getJSONLogger, flush as flush_logs
+logger = getJSONLogger('recommendationservice-prefork')
+
+HEARTBEAT_INTERVAL = 1
+MAX_RESTART_BACKOFF = 30
+
+# grpc.server / grpc.aio.server options for workers sharing a port
+SERVER_OPTIONS = [('grpc.so_reuseport', 1)]
+
+# set in worker processes only
+_worker = None
+
+class _Worker(object):
+  def __init__(self, slot, serving, heartbeats, supervisor_pid):
+    self.slot = slot
+    self.serving = serving
+    self.heartbeats = heartbeats
+    self.supervisor_pid = supervisor_pid
+
+def serving():
+  """Aggregated health as seen by this process: always True outside of a
+  supervisor, otherwise the supervisor's view of all workers."""
+  return _worker is None or bool(_worker.serving.value)
+
+def _heartbeat():
+  while True:
+    _worker.heartbeats[_worker.slot] = time.monotonic()
+    if os.getppid() != _worker.supervisor_pid:
+      # the supervisor is gone, nobody will restart or stop us
+      logger.warning("supervisor exited, stopping worker")
+      os.kill(os.getpid(), signal.SIGTERM)
+      return
+    time.sleep(HEARTBEAT_INTERVAL)
+
+def _raise_keyboard_interrupt(signum, frame):
+  raise KeyboardInterrupt()
+
+def _bootstrap(target, worker):
+  global _worker
+  _worker = worker
+  # the servers already shut down on KeyboardInterrupt
+  signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+  signal.signal(signal.SIGINT, _raise_keyboard_interrupt)
+  threading.Thread(target=_heartbeat, name='prefork-heartbeat', daemon=True).start()
+  try:
+    target()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    # worker processes exit without running atexit handlers
+    flush_logs()
+
+class Supervisor(object):
+  """Starts `workers` processes running `target`, restarts any that die or
+  stop sending heartbeats, and drains all of them on SIGTERM."""
+
+  def __init__(self, target, workers, grace=5, heartbeat_timeout=30):
+    self._context = multiprocessing.get_context('fork')
+    self._target = target
+    self._workers = workers
+    self._grace = grace
+    self._heartbeat_timeout = heartbeat_timeout
+    self._serving = self._context.Value('b', 0, lock=False)
+    self._heartbeats = self._context.Array('d', workers, lock=False)
+    self._processes = [None] * workers
+    self._restart_at = [0.0] * workers
+    self._failures = [0] * workers
+    self._draining = False
+
+  def run(self):
+    signal.signal(signal.SIGTERM, self._drain)
+    signal.signal(signal.SIGINT, self._drain)
+    logger.info("starting {} worker processes".format(self._workers))
+    while not self._draining:
+      now = time.monotonic()
+      healthy = 0
+      for slot, process in enumerate(self._processes):
+        if process is not None and process.is_alive():
+          if now - self._heartbeats[slot] > self._heartbeat_timeout:
+            logger.warning("worker {} (pid {}) missed heartbeats, killing it".format(
+              slot, process.pid))
+            process.kill()
+          else:
+            healthy += 1
+            if now - process.started_at > MAX_RESTART_BACKOFF:
+              self._failures[slot] = 0
+          continue
+        if process is not None:
+          process.join()
+          self._failures[slot] += 1
+          backoff = min(2 ** (self._failures[slot] - 1), MAX_RESTART_BACKOFF)
+          logger.warning("worker {} (pid {}) exited with {}, restarting in {}s".format(
+            slot, process.pid, process.exitcode, backoff))
+          self._processes[slot] = None
+          self._restart_at[slot] = now + backoff
+        if now >= self._restart_at[slot]:
+          self._start(slot)
+      self._serving.value = 1 if healthy > 0 else 0
+      time.sleep(HEARTBEAT_INTERVAL)
+    self._stop()
+
+  def _start(self, slot):
+    self._heartbeats[slot] = time.monotonic()
+    worker = _Worker(slot, self._serving, self._heartbeats, os.getpid())
+    process = self._context.Process(
+      target=_bootstrap, args=(self._target, worker), name='worker-{}'.format(slot))
+    process.start()
+    process.started_at = time.monotonic()
+    self._processes[slot] = process
+
+  def _drain(self, signum, frame):
+    self._draining = True
+    # fail health checks first so load balancers stop sending traffic
+    self._serving.value = 0
+
+  def _stop(self):
+    # health checks fail from now on; keep serving for the grace period so
+    # load balancers see that and stop routing here before workers stop
+    logger.info("draining {} worker processes in {}s".format(self._workers, self._grace))
+    time.sleep(self._grace)
+    running = [p for p in self._processes if p is not None and p.is_alive()]
+    for process in running:
+      process.terminate()
+    deadline = time.monotonic() + self._grace + 1
+    for process in running:
+      process.join(max(0, deadline - time.monotonic()))
+      if process.is_alive():
+        logger.warning("worker pid {} did not stop in time, killing it".format(process.pid))
+        process.kill()
+        process.join()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Precomputed top-N recommendations served from a memory-mapped file.
+#
+# The table is built offline, from JSON lines of
+# {"product_id": ..., "neighbors": [...]} or from a co-occurrence matrix:
+#
+#   python rec_table.py --jsonl neighbors.jsonl table.bin
+#   python rec_table.py --cooccurrence cooccurrence.npz table.bin
+#
+# and served with RECOMMENDATION_ENGINE=table and
+# RECOMMENDATION_TABLE_PATH=table.bin. Writing a new file over the old one
+# (the builder renames a temporary file into place) swaps it in atomically.
+#
+# File layout, little-endian:
+#   header     magic, count n, width w, slots s   (HEADER)
+#   offsets    n + 1 uint64 offsets into the id blob
+#   id blob    the n product ids, UTF-8, sorted
+#   slots      s uint32 positions, an open-addressing hash table of the ids
+#   neighbors  n rows of w uint32 positions of sorted ids, EMPTY padded
+#
+# Products are found through the hash slots, keyed by the CRC-32 of the id
+# and at most half full, so a lookup reads about one slot. Only an id of
+# the requested length is copied out of the mapping to be compared, rather
+# than one id per step of a binary search.
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-table')
+
+MAGIC = b'RECTBL02'
+HEADER = struct.Struct('<8sIII')
+EMPTY = 0xFFFFFFFF
+
+def write_table(path, neighbors_by_id, width):
+  """Writes `neighbors_by_id` (product id -> ordered neighbor ids) to `path`
+  atomically, keeping at most `width` neighbors per product."""
+  ids = set(neighbors_by_id)
+  for neighbors in neighbors_by_id.values():
+    ids.update(neighbors[:width])
+  encoded = sorted(pid.encode('utf-8') for pid in ids)
+  positions = {pid.decode('utf-8'): i for i, pid in enumerate(encoded)}
+
+  offsets = [0]
+  for pid in encoded:
+    offsets.append(offsets[-1] + len(pid))
+  slot_count = 1
+  while slot_count < 2 * len(encoded):
+    slot_count *= 2
+  slots = [EMPTY] * slot_count
+  for i, pid in enumerate(encoded):
+    slot = zlib.crc32(pid) & (slot_count - 1)
+    while slots[slot] != EMPTY:
+      slot = (slot + 1) & (slot_count - 1)
+    slots[slot] = i
+  rows = bytearray(len(encoded) * width * 4)
+  row_format = struct.Struct('<{}I'.format(width))
+  for pid, neighbors in neighbors_by_id.items():
+    row = [positions[p] for p in neighbors[:width]]
+    row += [EMPTY] * (width - len(row))
+    row_format.pack_into(rows, positions[pid] * row_format.size, *row)
+
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(HEADER.pack(MAGIC, len(encoded), width, slot_count))
+    f.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+    f.write(b''.join(encoded))
+    # align the slots and neighbor rows for memoryview.cast
+    f.write(b'\0' * (-f.tell() % 4))
+    f.write(struct.pack('<{}I'.format(slot_count), *slots))
+    f.write(rows)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+
+class RecommendationTable(object):
+  """A read-only view of a table file. Pages are shared through the page
+  cache by every process that maps the same file."""
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      stat = os.fstat(f.fileno())
+      self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.count, self.width, slot_count = HEADER.unpack_from(self._mmap, 0)
+    if magic != MAGIC:
+      raise Exception('{} is not a recommendation table'.format(path))
+    view = memoryview(self._mmap)
+    start = HEADER.size
+    end = start + (self.count + 1) * 8
+    self._offsets = view[start:end].cast('Q')
+    self._blob = end
+    start = end + self._offsets[self.count]
+    start += -start % 4
+    self._slots = view[start:start + slot_count * 4].cast('I')
+    self._mask = slot_count - 1
+    start += slot_count * 4
+    self._neighbors = view[start:start + self.count * self.width * 4].cast('I')
+
+  def _id(self, i):
+    start = self._blob
+    return self._mmap[start + self._offsets[i]:start + self._offsets[i + 1]]
+
+  def find(self, product_id):
+    key = product_id.encode('utf-8')
+    offsets = self._offsets
+    slots = self._slots
+    mask = self._mask
+    slot = zlib.crc32(key) & mask
+    while True:
+      i = slots[slot]
+      if i == EMPTY:
+        return -1
+      # ids of another length differ without being copied
+      if offsets[i + 1] - offsets[i] == len(key) and self._id(i) == key:
+        return i
+      slot = (slot + 1) & mask
+
+  def recommend(self, product_ids, k):
+    """Merges the neighbor rows of `product_ids` round-robin, best first,
+    skipping the requested products themselves."""
+    rows = [r for r in map(self.find, product_ids) if r >= 0]
+    if not rows:
+      return []
+    skip = set(rows)
+    picked = []
+    width = self.width
+    neighbors = self._neighbors
+    for column in range(width):
+      for row in rows:
+        n = neighbors[row * width + column]
+        if n != EMPTY and n not in skip:
+          skip.add(n)
+          picked.append(n)
+          if len(picked) == k:
+            return [self._id(i).decode('utf-8') for i in picked]
+    return [self._id(i).decode('utf-8') for i in picked]
+
+class TableRecommender(object):
+  name = 'table'
+
+  def __init__(self, path, reload_interval=10):
+    self.path = path
+    self.table = RecommendationTable(path)
+    logger.info("recommendation table loaded with {} products".format(self.table.count))
+    self._reload_interval = reload_interval
+    threading.Thread(target=self._watch, name='table-watch', daemon=True).start()
+
+  def recommend(self, snapshot, product_ids, k):
+    candidates = self.table.recommend(product_ids, 2 * k)
+    index = snapshot.index
+    return [p for p in candidates if p in index][:k]
+
+  def _watch(self):
+    event = threading.Event()
+    while not event.wait(self._reload_interval):
+      try:
+        stat = os.stat(self.path)
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == self.table.identity:
+          continue
+        # in-flight requests keep the old mapping alive until they finish
+        self.table = RecommendationTable(self.path)
+        logger.info("recommendation table reloaded with {} products".format(
+          self.table.count))
+      except Exception as err:
+        logger.warning("could not reload recommendation table: {}".format(err))
+
+def read_jsonl(path):
+  neighbors_by_id = {}
+  with open(path) as f:
+    for line in f:
+      line = line.strip()
+      if line:
+        row = json.loads(line)
+        neighbors_by_id[row['product_id']] = row['neighbors']
+  return neighbors_by_id
+
+def read_cooccurrence(path, width):
+  from cooccurrence import CooccurrenceMatrix
+  matrix = CooccurrenceMatrix.load(path)
+  return {pid: matrix.top_k([pid], width) for pid in matrix.rows}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='build a recommendation table file')
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument('--jsonl', help='JSON lines with product_id and neighbors')
+  source.add_argument('--cooccurrence', help='co-occurrence matrix (.npz)')
+  parser.add_argument('output', help='path of the table file to write')
+  parser.add_argument('--width', type=int, default=20, help='neighbors per product')
+  args = parser.parse_args()
+  if args.jsonl:
+    neighbors_by_id = read_jsonl(args.jsonl)
+  else:
+    neighbors_by_id = read_cooccurrence(args.cooccurrence, args.width)
+  write_table(args.output, neighbors_by_id, args.width)
+  print("wrote {} products to {}".format(len(neighbors_by_id), args.output))
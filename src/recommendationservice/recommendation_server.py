@@ -14,8 +14,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import os
-import random
+import signal
 import time
 import traceback
 from concurrent import futures
@@ -31,12 +32,25 @@ from grpc_health.v1 import health_pb2_grpc
 
 from opentelemetry import trace
 from opentelemetry.instrumentation.grpc import GrpcInstrumentorClient, GrpcInstrumentorServer
+from opentelemetry.instrumentation.grpc import GrpcAioInstrumentorClient, GrpcAioInstrumentorServer
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 
-from logger import getJSONLogger
+import prefork
+import startup
+from catalog_cache import CatalogCache
+from catalog_client import CatalogClient
+from concurrency_limiter import GradientLimiter
+from concurrency_limiter import ConcurrencyLimitInterceptor, AioConcurrencyLimitInterceptor
+from response_cache import ResponseCache
+from stats import StatsReporter
+from logger import getJSONLogger, getLogStats
 logger = getJSONLogger('recommendationservice-server')
+startup.timeline.mark('imports')
+
+stats = StatsReporter(float(os.environ.get('STATS_LOG_INTERVAL_SECONDS', "60")))
+stats.add('logging', getLogStats)
 
 def initStackdriverProfiling():
   project_id = None
@@ -48,10 +62,12 @@ def initStackdriverProfiling():
 
   for retry in range(1,4):
     try:
+      # started off the main thread, which wall profiling requires; it only
+      # sampled the main thread, and that thread does not serve requests
       if project_id:
-        googlecloudprofiler.start(service='recommendation_server', service_version='1.0.0', verbose=0, project_id=project_id)
+        googlecloudprofiler.start(service='recommendation_server', service_version='1.0.0', verbose=0, project_id=project_id, disable_wall_profiling=True)
       else:
-        googlecloudprofiler.start(service='recommendation_server', service_version='1.0.0', verbose=0)
+        googlecloudprofiler.start(service='recommendation_server', service_version='1.0.0', verbose=0, disable_wall_profiling=True)
       logger.info("Successfully started Stackdriver Profiler.")
       return
     except (BaseException) as exc:
@@ -63,26 +79,92 @@ def initStackdriverProfiling():
         logger.warning("Could not initialize Stackdriver Profiler after retrying, giving up")
   return
 
+class RandomRecommender(object):
+    name = 'random'
+
+    def recommend(self, snapshot, product_ids, k):
+        # sample product ids that are not already in the request
+        return snapshot.index.sample(k, product_ids)
+
+def create_recommender(engine):
+    if engine == 'random':
+        return RandomRecommender()
+    if engine == 'cooccurrence':
+        from cooccurrence import CooccurrenceMatrix, CooccurrenceRecommender
+        path = os.environ.get('COOCCURRENCE_MATRIX_PATH', '')
+        if path == "":
+            raise Exception('COOCCURRENCE_MATRIX_PATH environment variable not set')
+        return CooccurrenceRecommender(CooccurrenceMatrix.load(path))
+    if engine == 'content':
+        from content_index import ContentRecommender
+        return ContentRecommender(
+            dims=int(os.environ.get('CONTENT_INDEX_DIMS', "128")),
+            neighbors=int(os.environ.get('CONTENT_INDEX_NEIGHBORS', "20")))
+    if engine == 'table':
+        from rec_table import TableRecommender
+        path = os.environ.get('RECOMMENDATION_TABLE_PATH', '')
+        if path == "":
+            raise Exception('RECOMMENDATION_TABLE_PATH environment variable not set')
+        return TableRecommender(path)
+    if engine == 'popularity':
+        from popularity import PopularityRecommender
+        return PopularityRecommender(
+            weights_path=os.environ.get('POPULARITY_WEIGHTS_PATH'),
+            events_path=os.environ.get('POPULARITY_EVENTS_PATH'),
+            smoothing=float(os.environ.get('POPULARITY_SMOOTHING', "1")))
+    if engine == 'category':
+        from categories import CategoryRecommender
+        return CategoryRecommender(
+            min_pool=int(os.environ.get('CATEGORY_MIN_POOL', "1")))
+    raise Exception('unknown recommendation engine: ' + engine)
+
 class RecommendationService(demo_pb2_grpc.RecommendationServiceServicer):
+    def __init__(self, catalog, recommender=None, cache=None):
+        self.catalog = catalog
+        self.recommender = recommender or RandomRecommender()
+        self.cache = cache
+
     def ListRecommendations(self, request, context):
-        max_responses = 5
-        # fetch list of products from product catalog stub
-        cat_response = product_catalog_stub.ListProducts(demo_pb2.Empty())
-        product_ids = [x.id for x in cat_response.products]
-        filtered_products = list(set(product_ids)-set(request.product_ids))
-        num_products = len(filtered_products)
-        num_return = min(max_responses, num_products)
-        # sample list of indicies to return
-        indices = random.sample(range(num_products), num_return)
-        # fetch product ids from indices
-        prod_list = [filtered_products[i] for i in indices]
+        # fetch the cached catalog snapshot, within the caller's deadline
+        try:
+            snapshot = self.catalog.get(context.time_remaining())
+        except grpc.RpcError as err:
+            context.abort(err.code(), 'product catalog: {}'.format(err.details()))
+        except TimeoutError:
+            context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, 'product catalog not loaded yet')
+        return self.recommend(snapshot, request)
+
+    def recommend(self, snapshot, request):
+        if self.cache is not None:
+            prod_list = self.cache.get(
+                snapshot.version, request.product_ids,
+                lambda: self.pick(snapshot, request.product_ids))
+        else:
+            prod_list = self.pick(snapshot, request.product_ids)
         logger.info("[Recv ListRecommendations] product_ids={}".format(prod_list))
         # build and return response
         response = demo_pb2.ListRecommendationsResponse()
         response.product_ids.extend(prod_list)
         return response
 
+    def pick(self, snapshot, product_ids):
+        max_responses = 5
+        prod_list = self.recommender.recommend(
+            snapshot, product_ids, max_responses)
+        if len(prod_list) < max_responses:
+            # fill any gaps left by the engine with random products
+            prod_list += snapshot.index.sample(
+                max_responses - len(prod_list),
+                list(product_ids) + prod_list)
+        return prod_list
+
     def Check(self, request, context):
+        # not ready until a catalog snapshot, from disk or live, is loaded;
+        # liveness probes ask for the "liveness" service and skip that
+        ready = request.service == 'liveness' or self.catalog.ready()
+        if not prefork.serving() or not ready:
+            return health_pb2.HealthCheckResponse(
+                status=health_pb2.HealthCheckResponse.NOT_SERVING)
         return health_pb2.HealthCheckResponse(
             status=health_pb2.HealthCheckResponse.SERVING)
 
@@ -90,10 +172,150 @@ class RecommendationService(demo_pb2_grpc.RecommendationServiceServicer):
         return health_pb2.HealthCheckResponse(
             status=health_pb2.HealthCheckResponse.UNIMPLEMENTED)
 
+class AioRecommendationService(RecommendationService):
+    async def ListRecommendations(self, request, context):
+        try:
+            snapshot = await self.catalog.get_async(context.time_remaining())
+        except grpc.aio.AioRpcError as err:
+            await context.abort(err.code(), 'product catalog: {}'.format(err.details()))
+        except asyncio.TimeoutError:
+            await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, 'product catalog not loaded yet')
+        return self.recommend(snapshot, request)
 
-if __name__ == "__main__":
-    logger.info("initializing recommendationservice")
+    async def Check(self, request, context):
+        return RecommendationService.Check(self, request, context)
+
+    async def Watch(self, request, context):
+        await context.abort(grpc.StatusCode.UNIMPLEMENTED, 'Watch is not supported')
+
+def create_service(service_class, catalog):
+    engine = os.environ.get('RECOMMENDATION_ENGINE', 'random')
+    logger.info("recommendation engine: " + engine)
+    recommender = create_recommender(engine)
+    if hasattr(recommender, 'on_snapshot'):
+        catalog.add_listener(recommender.on_snapshot)
+    cache = None
+    cache_size = int(os.environ.get('RESPONSE_CACHE_SIZE', "0"))
+    if cache_size > 0:
+        cache = ResponseCache(
+            cache_size,
+            ttl=float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', "30")),
+            reshuffle_rate=float(os.environ.get('RESPONSE_CACHE_RESHUFFLE_RATE', "0.1")))
+        catalog.add_listener(cache.invalidate)
+        stats.add('response_cache', cache.stats)
+    return service_class(catalog, recommender, cache)
+
+def create_limiter():
+    if os.environ.get('ADAPTIVE_CONCURRENCY_LIMIT', "0") != "1":
+        return None
+    limiter = GradientLimiter(
+        max_limit=int(os.environ.get('CONCURRENCY_LIMIT_MAX', "200")))
+    stats.add('concurrency_limiter', limiter.stats)
+    return limiter
+
+def create_catalog_client(stub):
+    hedge_delay_ms = float(os.environ.get('CATALOG_HEDGE_DELAY_MS', "0"))
+    client = CatalogClient(
+        stub,
+        timeout=float(os.environ.get('CATALOG_TIMEOUT_SECONDS', "5")),
+        hedge_delay=hedge_delay_ms / 1000 if hedge_delay_ms > 0 else None,
+        hedge_percentile=float(os.environ.get('CATALOG_HEDGE_PERCENTILE', "95")))
+    stats.add('catalog_client', client.stats)
+    return client
+
+def create_server(catalog_addr, catalog_ttl, options=None):
+    channel = grpc.insecure_channel(catalog_addr)
+    product_catalog_stub = demo_pb2_grpc.ProductCatalogServiceStub(channel)
+    catalog_client = create_catalog_client(product_catalog_stub)
+    catalog = CatalogCache(catalog_client.list_products, ttl=catalog_ttl,
+                           snapshot_path=os.environ.get('CATALOG_SNAPSHOT_PATH'))
+    catalog.add_listener(lambda snapshot: startup.timeline.mark('catalog'))
+    catalog.start()
+
+    # create gRPC server
+    limiter = create_limiter()
+    interceptors = []
+    if limiter:
+        interceptors.append(ConcurrencyLimitInterceptor(limiter))
+    # innermost, so that shed calls do not count as served
+    interceptors.append(startup.FirstRequestInterceptor(startup.timeline))
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10),
+                         interceptors=interceptors, options=options)
+
+    # add class to gRPC server
+    service = create_service(RecommendationService, catalog)
+    demo_pb2_grpc.add_RecommendationServiceServicer_to_server(service, server)
+    health_pb2_grpc.add_HealthServicer_to_server(service, server)
+    return server, catalog, service
+
+def raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+def serve(port, catalog_addr, catalog_ttl, shutdown_grace=0, options=None):
+    server, catalog, service = create_server(catalog_addr, catalog_ttl, options)
+    stats.start()
+
+    # start server
+    logger.info("listening on port: " + port)
+    server.add_insecure_port('[::]:'+port)
+    server.start()
+    startup.timeline.mark('serving')
+
+    # keep alive; Kubernetes stops pods with SIGTERM, which takes the
+    # same path as ^C
+    signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+    try:
+         while True:
+            time.sleep(10000)
+    except KeyboardInterrupt:
+            catalog.stop()
+            server.stop(shutdown_grace).wait()
 
+async def serve_aio(port, catalog_addr, catalog_ttl, shutdown_grace=0, options=None):
+    channel = grpc.aio.insecure_channel(catalog_addr)
+    product_catalog_stub = demo_pb2_grpc.ProductCatalogServiceStub(channel)
+    catalog_client = create_catalog_client(product_catalog_stub)
+    loop = asyncio.get_running_loop()
+    # the refresh thread drives the async stub on the server's event loop
+    catalog = CatalogCache(
+        lambda timeout: asyncio.run_coroutine_threadsafe(
+            catalog_client.list_products_async(timeout), loop).result(),
+        ttl=catalog_ttl,
+        fetch_async=catalog_client.list_products_async,
+        snapshot_path=os.environ.get('CATALOG_SNAPSHOT_PATH'))
+    catalog.add_listener(lambda snapshot: startup.timeline.mark('catalog'))
+    catalog.start()
+
+    limiter = create_limiter()
+    interceptors = []
+    if limiter:
+        interceptors.append(AioConcurrencyLimitInterceptor(limiter))
+    # innermost, so that shed calls do not count as served
+    interceptors.append(startup.AioFirstRequestInterceptor(startup.timeline))
+    server = grpc.aio.server(interceptors=interceptors, options=options)
+    service = create_service(AioRecommendationService, catalog)
+    demo_pb2_grpc.add_RecommendationServiceServicer_to_server(service, server)
+    health_pb2_grpc.add_HealthServicer_to_server(service, server)
+
+    stats.start()
+
+    logger.info("listening on port: " + port + " (grpc.aio)")
+    server.add_insecure_port('[::]:'+port)
+    await server.start()
+    startup.timeline.mark('serving')
+
+    # SIGTERM and SIGINT stop the loop's wait instead of interrupting it,
+    # here and in pre-fork workers alike
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+    await server.stop(shutdown_grace)
+    catalog.stop()
+
+
+def initProfiler():
     try:
       if "DISABLE_PROFILER" in os.environ:
         raise KeyError()
@@ -103,11 +325,8 @@ if __name__ == "__main__":
     except KeyError:
         logger.info("Profiler disabled.")
 
+def initTracing():
     try:
-      grpc_client_instrumentor = GrpcInstrumentorClient()
-      grpc_client_instrumentor.instrument()
-      grpc_server_instrumentor = GrpcInstrumentorServer()
-      grpc_server_instrumentor.instrument()
       if os.environ["ENABLE_TRACING"] == "1":
         trace.set_tracer_provider(TracerProvider())
         otel_endpoint = os.getenv("COLLECTOR_SERVICE_ADDR", "localhost:4317")
@@ -124,30 +343,56 @@ if __name__ == "__main__":
     except Exception as e:
         logger.warn(f"Exception on Cloud Trace setup: {traceback.format_exc()}, tracing disabled.") 
 
+def initTelemetry(server_mode):
+    # the instrumentors patch grpc, so they must run before any channel or
+    # server is created; spans go to the real provider once it is set
+    try:
+      if server_mode == 'aio':
+        GrpcAioInstrumentorClient().instrument()
+        GrpcAioInstrumentorServer().instrument()
+      else:
+        grpc_client_instrumentor = GrpcInstrumentorClient()
+        grpc_client_instrumentor.instrument()
+        grpc_server_instrumentor = GrpcInstrumentorServer()
+        grpc_server_instrumentor.instrument()
+    except Exception as e:
+        logger.warn(f"Exception on gRPC instrumentation: {traceback.format_exc()}")
+    # the profiler retries and the exporter may wait on credentials, neither
+    # should hold up binding the port
+    startup.timeline.run_in_background('profiler', initProfiler)
+    startup.timeline.run_in_background('tracing', initTracing)
+    startup.timeline.mark('telemetry')
+
+def run(server_mode, port, catalog_addr, catalog_ttl, shutdown_grace, options):
+    # profiler and exporter channels must be created after any fork
+    initTelemetry(server_mode)
+    if server_mode == 'aio':
+        try:
+            asyncio.run(serve_aio(port, catalog_addr, catalog_ttl, shutdown_grace, options))
+        except KeyboardInterrupt:
+            pass  # interrupted before the signal handlers were installed
+    else:
+        serve(port, catalog_addr, catalog_ttl, shutdown_grace, options)
+
+
+if __name__ == "__main__":
+    logger.info("initializing recommendationservice")
+    server_mode = os.environ.get('GRPC_SERVER_MODE', 'threadpool')
+
     port = os.environ.get('PORT', "8080")
     catalog_addr = os.environ.get('PRODUCT_CATALOG_SERVICE_ADDR', '')
     if catalog_addr == "":
         raise Exception('PRODUCT_CATALOG_SERVICE_ADDR environment variable not set')
     logger.info("product catalog address: " + catalog_addr)
-    channel = grpc.insecure_channel(catalog_addr)
-    product_catalog_stub = demo_pb2_grpc.ProductCatalogServiceStub(channel)
-
-    # create gRPC server
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-
-    # add class to gRPC server
-    service = RecommendationService()
-    demo_pb2_grpc.add_RecommendationServiceServicer_to_server(service, server)
-    health_pb2_grpc.add_HealthServicer_to_server(service, server)
+    catalog_ttl = float(os.environ.get('CATALOG_CACHE_TTL_SECONDS', "60"))
+    shutdown_grace = float(os.environ.get('SHUTDOWN_GRACE_SECONDS', "0"))
 
-    # start server
-    logger.info("listening on port: " + port)
-    server.add_insecure_port('[::]:'+port)
-    server.start()
-
-    # keep alive
-    try:
-         while True:
-            time.sleep(10000)
-    except KeyboardInterrupt:
-            server.stop(0)
+    workers = int(os.environ.get('WORKERS', "1"))
+    if workers > 1:
+        # every worker gets its own server, catalog channel and cache
+        prefork.Supervisor(
+            lambda: run(server_mode, port, catalog_addr, catalog_ttl,
+                        shutdown_grace, prefork.SERVER_OPTIONS),
+            workers, grace=shutdown_grace).run()
+    else:
+        run(server_mode, port, catalog_addr, catalog_ttl, shutdown_grace, None)
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import threading
+import time
+from collections import OrderedDict
+
+class ResponseCache(object):
+  """LRU cache with a TTL for recommendation lists.
+
+  Entries are keyed by the catalog version and the sorted, deduplicated
+  request product ids, so a new catalog snapshot never serves old entries;
+  `invalidate` additionally frees them. On a hit the list is drawn again
+  with probability `reshuffle_rate`, which keeps some variety for users
+  looking at the same products.
+  """
+
+  def __init__(self, max_size, ttl=30, reshuffle_rate=0.0, rng=random):
+    self._max_size = max_size
+    self._ttl = ttl
+    self._reshuffle_rate = reshuffle_rate
+    self._rng = rng
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.reshuffles = 0
+
+  def get(self, version, product_ids, compute):
+    key = (version, tuple(sorted(set(product_ids))))
+    now = time.monotonic()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] > now:
+        if self._rng.random() >= self._reshuffle_rate:
+          self._entries.move_to_end(key)
+          self.hits += 1
+          return list(entry[1])
+        self.reshuffles += 1
+      else:
+        self.misses += 1
+    # compute outside the lock, concurrent misses for one key are harmless
+    value = compute()
+    with self._lock:
+      self._entries[key] = (now + self._ttl, tuple(value))
+      self._entries.move_to_end(key)
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+    return value
+
+  def invalidate(self, snapshot=None):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    with self._lock:
+      return {
+        'size': len(self._entries),
+        'hits': self.hits,
+        'misses': self.misses,
+        'reshuffles': self.reshuffles,
+      }
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+class ProductIndex(object):
+  """Array-backed product ids with a position lookup, built once per snapshot.
+
+  `sample` draws k distinct ids that are not in `excluded` by rejection
+  sampling over positions, so a request costs O(k + len(excluded)) instead
+  of a pass over the whole catalog.
+  """
+
+  def __init__(self, product_ids):
+    # dict.fromkeys drops duplicate ids while keeping catalog order
+    self.positions = {pid: i for i, pid in enumerate(dict.fromkeys(product_ids))}
+    self.ids = list(self.positions)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __contains__(self, product_id):
+    return product_id in self.positions
+
+  def excluded_positions(self, excluded):
+    positions = self.positions
+    return {positions[p] for p in excluded if p in positions}
+
+  def sample(self, k, excluded=(), rng=random):
+    return [self.ids[i] for i in self.sample_positions(k, excluded, rng)]
+
+  def sample_positions(self, k, excluded=(), rng=random):
+    n = len(self.ids)
+    seen = self.excluded_positions(excluded)
+    k = min(k, n - len(seen))
+    if k <= 0:
+      return []
+    if 2 * (len(seen) + k) > n:
+      # Most positions would be rejected, a single pass is cheaper.
+      return rng.sample([i for i in range(n) if i not in seen], k)
+    chosen = []
+    randbelow = rng.randrange
+    while len(chosen) < k:
+      i = randbelow(n)
+      if i not in seen:
+        seen.add(i)
+        chosen.append(i)
+    return chosen
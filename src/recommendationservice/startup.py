@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Startup timeline for tracking cold-start regressions. Phases are recorded
+# in seconds since the process started and logged as one JSON line once the
+# first request has been served, e.g.
+#   {"message": "startup timeline", "phases": {"imports": 0.61, "serving": 0.7, ...}}
+#
+# TODO: this module is duplicated since other Python services are not
+# sharing modules.
+
+import os
+import threading
+import time
+
+import grpc
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-startup')
+
+EXEMPT_PREFIX = '/grpc.health.v1.Health/'
+
+def _process_start():
+  # the interpreter itself takes a while to start, count it in when possible
+  try:
+    with open('/proc/self/stat') as f:
+      started_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+    with open('/proc/uptime') as f:
+      uptime = float(f.read().split()[0])
+    return time.monotonic() - (uptime - started_ticks / os.sysconf('SC_CLK_TCK'))
+  except Exception:
+    return time.monotonic()
+
+class Timeline(object):
+  def __init__(self, started=None):
+    self.started = _process_start() if started is None else started
+    self.phases = {}
+    self.logged = False
+    self._lock = threading.Lock()
+
+  def mark(self, phase):
+    """Records the end of `phase`; only the first mark of a phase counts."""
+    with self._lock:
+      self.phases.setdefault(phase, round(time.monotonic() - self.started, 3))
+
+  def run_in_background(self, phase, target):
+    """Runs `target` on a daemon thread and marks `phase` when it returns."""
+    def run():
+      try:
+        target()
+      except Exception as err:
+        logger.warning("{} initialization failed: {}".format(phase, err))
+      self.mark(phase)
+      if self.logged:
+        logger.info("{} initialized {}s after start".format(phase, self.phases[phase]))
+    threading.Thread(target=run, name=phase + '-init', daemon=True).start()
+
+  def served(self):
+    """Marks the first request served and logs the timeline, once."""
+    if self.logged:
+      return
+    with self._lock:
+      if self.logged:
+        return
+      self.logged = True
+    self.mark('first_request')
+    logger.info("startup timeline", extra={'pid': os.getpid(), 'phases': dict(self.phases)})
+
+timeline = Timeline()
+
+class FirstRequestInterceptor(grpc.ServerInterceptor):
+  """Calls timeline.served() after the first non-health request that
+  succeeds. Install it after any interceptor that may reject calls."""
+
+  def __init__(self, timeline):
+    self.timeline = timeline
+
+  def intercept_service(self, continuation, handler_call_details):
+    handler = continuation(handler_call_details)
+    timeline = self.timeline
+    if (timeline.logged or handler is None or handler.unary_unary is None or
+        handler_call_details.method.startswith(EXEMPT_PREFIX)):
+      return handler
+    behavior = handler.unary_unary
+
+    def first(request, context):
+      response = behavior(request, context)
+      timeline.served()
+      return response
+
+    return grpc.unary_unary_rpc_method_handler(
+      first, request_deserializer=handler.request_deserializer,
+      response_serializer=handler.response_serializer)
+
+class AioFirstRequestInterceptor(grpc.aio.ServerInterceptor):
+  def __init__(self, timeline):
+    self.timeline = timeline
+
+  async def intercept_service(self, continuation, handler_call_details):
+    handler = await continuation(handler_call_details)
+    timeline = self.timeline
+    if (timeline.logged or handler is None or handler.unary_unary is None or
+        handler_call_details.method.startswith(EXEMPT_PREFIX)):
+      return handler
+    behavior = handler.unary_unary
+
+    async def first(request, context):
+      response = await behavior(request, context)
+      timeline.served()
+      return response
+
+    return grpc.unary_unary_rpc_method_handler(
+      first, request_deserializer=handler.request_deserializer,
+      response_serializer=handler.response_serializer)
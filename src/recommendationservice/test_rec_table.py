@@ -0,0 +1,98 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from this directory with: python -m unittest test_rec_table
+
+import collections
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from rec_table import RecommendationTable, TableRecommender, write_table
+
+Snapshot = collections.namedtuple('Snapshot', ['index'])
+
+NEIGHBORS = {
+  'OLJCESPC7Z': ['66VCHSJNUP', '1YMWWN1N4O', 'L9ECAV7KIM'],
+  '66VCHSJNUP': ['OLJCESPC7Z'],
+  'café-crème': ['OLJCESPC7Z', 'über-tasse'],
+  'über-tasse': [],
+  '2ZYFJ3GM2N': [],
+}
+
+class RecommendationTableTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.dir)
+    self.path = os.path.join(self.dir, 'table.bin')
+
+  def test_round_trip(self):
+    write_table(self.path, NEIGHBORS, width=2)
+    table = RecommendationTable(self.path)
+    # neighbors count as products too, and rows keep at most `width`
+    self.assertEqual(6, table.count)
+    for pid in list(NEIGHBORS) + ['1YMWWN1N4O']:
+      self.assertEqual(pid, table._id(table.find(pid)).decode('utf-8'))
+    self.assertEqual(-1, table.find('L9ECAV7KIM'))
+    self.assertEqual(-1, table.find('café'))
+    self.assertEqual(-1, table.find(''))
+
+    self.assertEqual(['66VCHSJNUP', '1YMWWN1N4O'], table.recommend(['OLJCESPC7Z'], 5))
+    self.assertEqual(['OLJCESPC7Z', 'über-tasse'], table.recommend(['café-crème'], 5))
+    # round-robin over the rows, without the requested products
+    self.assertEqual(
+      ['über-tasse', '1YMWWN1N4O'],
+      table.recommend(['café-crème', 'OLJCESPC7Z', '66VCHSJNUP'], 5))
+    self.assertEqual([], table.recommend(['über-tasse', '2ZYFJ3GM2N'], 5))
+    self.assertEqual([], table.recommend(['unknown'], 5))
+
+  def test_empty_table(self):
+    write_table(self.path, {}, width=4)
+    table = RecommendationTable(self.path)
+    self.assertEqual(0, table.count)
+    self.assertEqual(-1, table.find('OLJCESPC7Z'))
+    self.assertEqual([], table.recommend(['OLJCESPC7Z'], 5))
+
+  def test_rejects_other_files(self):
+    with open(self.path, 'wb') as f:
+      f.write(b'\0' * 64)
+    with self.assertRaises(Exception):
+      RecommendationTable(self.path)
+
+  def test_recommender_swaps_in_a_new_file(self):
+    write_table(self.path, NEIGHBORS, width=2)
+    recommender = TableRecommender(self.path, reload_interval=0.01)
+    snapshot = Snapshot(index=set(NEIGHBORS) | {'1YMWWN1N4O'})
+    self.assertEqual(['66VCHSJNUP'], recommender.recommend(snapshot, ['OLJCESPC7Z'], 1))
+    # products missing from the catalog snapshot are skipped
+    self.assertEqual(
+      ['1YMWWN1N4O'],
+      recommender.recommend(Snapshot(index={'1YMWWN1N4O'}), ['OLJCESPC7Z'], 1))
+
+    old = recommender.table
+    write_table(self.path, {'OLJCESPC7Z': ['2ZYFJ3GM2N']}, width=2)
+    deadline = time.monotonic() + 10
+    while recommender.table is old and time.monotonic() < deadline:
+      time.sleep(0.01)
+    self.assertIsNot(old, recommender.table)
+    self.assertEqual(['2ZYFJ3GM2N'], recommender.recommend(snapshot, ['OLJCESPC7Z'], 5))
+    # a request still holding the old mapping can finish on it
+    self.assertEqual(['66VCHSJNUP', '1YMWWN1N4O'], old.recommend(['OLJCESPC7Z'], 5))
+
+if __name__ == '__main__':
+  unittest.main()